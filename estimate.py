@@ -6,65 +6,28 @@ Created on Tue Oct  8 13:03:22 2019
 
 This is a collection of functions used to create and estimate the LP model, including for multiple imputation.
 """
-import pandas, numpy, random # import packages
+import collections, concurrent.futures, multiprocessing.shared_memory, pandas, numpy, warnings # import packages
+import scipy.optimize, scipy.sparse
+from scipy.special import gammaln
 from statsmodels.base.model import GenericLikelihoodModel
+from statsmodels.tools.sm_exceptions import ConvergenceWarning
 
-# converts the analytic sample (see the util.get_analytic_sample function) into a form that can be used in estimation
-def get_estimation_sample(analytic_sample,equal_mixing,driver_types,mirep=False):
-    estimation_sample = analytic_sample.copy()
-    
+# converts the analytic sample (see the util.get_analytic_sample function) into a form that can be used in estimation. Crashes are 
+# coded by equal-mixing cell and crash type column (see get_crash_cells), and then counted in one pass. If crash_cells are given 
+# (from get_crash_cells for the same analytic sample and mirep, at a finer equal mixing), they are rolled up to equal_mixing instead
+def get_estimation_sample(analytic_sample,equal_mixing,driver_types,mirep=False,crash_cells=None):
     num_driver_types = len(driver_types)
     
-    if mirep==False:
-        mirep_suf = ''
-    else:
-        mirep_suf = str(mirep)
-    
-    # reset index for unstacking by veh_no, and keep vehicle count and driver_type
-    estimation_sample['veh_no2'] = estimation_sample.groupby(['year','st_case']).cumcount()+1
-    idx_add_veh_no2 = ['year','st_case','veh_no2']
-    if 'all' not in equal_mixing:
-        idx_add_veh_no2 = equal_mixing + idx_add_veh_no2
-    estimation_sample = estimation_sample.reset_index().set_index(idx_add_veh_no2)[['acc_veh_count','driver_type'+mirep_suf]]
-    estimation_sample = estimation_sample.unstack()    
-    
-    # identify one-car crashes, looping over driver types
-    for dt in range(1,num_driver_types+1): 
-        estimation_sample['a_' + str(dt)] = 0
-        estimation_sample.loc[(estimation_sample['acc_veh_count'][1] == 1) & (estimation_sample['driver_type'+mirep_suf][1] == dt),'a_' + str(dt)] = 1
-
-    # identify two-car crashes, looping over driver types
-    for dt1 in range(1,num_driver_types+1): 
-        for dt2 in range(1,num_driver_types+1): 
-            estimation_sample['a_' + str(dt1) + '_' + str(dt2)] = 0
-            estimation_sample.loc[(estimation_sample['acc_veh_count'][1] == 2) & (estimation_sample['driver_type'+mirep_suf][1] == dt1) & (estimation_sample['driver_type'+mirep_suf][2] == dt2),'a_' + str(dt1) + '_' + str(dt2)] = 1
-            if dt1 > dt2: # combine duplicates and drop duplicated columns
-                estimation_sample['a_' + str(dt2) + '_' + str(dt1)] = estimation_sample['a_' + str(dt2) + '_' + str(dt1)] + estimation_sample['a_' + str(dt1) + '_' + str(dt2)]
-                estimation_sample = estimation_sample.drop(columns=['a_' + str(dt1) + '_' + str(dt2)])
-            
-    # clean up dataset and collapse by equal mixing
-    estimation_sample = estimation_sample.drop(columns=['acc_veh_count','driver_type'+mirep_suf])
-    estimation_sample.columns = estimation_sample.columns.droplevel(level='veh_no2')
-    if 'all' not in equal_mixing:
-        estimation_sample = estimation_sample.groupby(equal_mixing).sum()
-    else:
-        estimation_sample = estimation_sample.sum().to_frame().transpose()
+    # count crashes by driver types, and collapse by equal mixing
+    crash_cell, crash_col, cell_index, columns = _get_crash_cells(analytic_sample,equal_mixing,driver_types,mirep,crash_cells)
+    crash_counts = count_crash_cells(crash_cell,crash_col,len(cell_index),len(columns))
     print('Rows of estimation sample after collapsing by equal mixing: ')
-    print(len(estimation_sample.index))
+    print(len(cell_index))
     
     # need to store one-vehicle crash share parameters before dropping missing 
-    one_veh_crash_ratio = numpy.zeros((num_driver_types-1))
-    for i in range(0,(num_driver_types-1)):
-        one_veh_crash_ratio[i] = estimation_sample['a_'+str(i+2)].sum()/estimation_sample['a_1'].sum()
-    
+    keep, one_veh_crash_ratio = _restrict_crash_counts(crash_counts,equal_mixing,num_driver_types)
+    estimation_sample = pandas.DataFrame(crash_counts[keep],index=cell_index[keep],columns=columns)
     if 'all' not in equal_mixing:
-        estimation_sample['a_miss'] = 0
-        # drop observations where there are no (one-vehicle, driver type 1) or no (one-vehicle, driver type 2) crashes [otherwise, model won't converge]
-        for dt in range(1,num_driver_types+1): 
-            estimation_sample.loc[estimation_sample['a_' + str(dt)] == 0,'a_miss'] = 1
-        estimation_sample = estimation_sample[estimation_sample['a_miss'] == 0]
-        estimation_sample = estimation_sample.drop(columns=['a_miss'])
-        
         print('Rows of estimation sample after dropping rows with zero single-car observations of any type: ')
         print(len(estimation_sample.index))
         
@@ -72,57 +35,358 @@ def get_estimation_sample(analytic_sample,equal_mixing,driver_types,mirep=False)
     
     return estimation_sample
 
-# fit the LP model using constructed estimation sample
-#def fit_model(estimation_sample,num_driver_types,bsreps=100):           
-def fit_model(analytic_sample,equal_mixing,driver_types,pairwise=True,init_rel_risk=10,bsreps=100,mirep=False,rseed=1,acc_bs=True):           
-    random.seed(rseed) # for exactly replicating the bootstrapped sample
+# encodes each crash in the analytic sample once, for building estimation samples (including bootstrap replicates) by counting crashes.
+# Returns each crash's equal-mixing cell and its column in the estimation sample (-1 if its driver types don't define a column), along 
+# with the index of equal-mixing cells and the estimation sample column names. If mirep is a list of MI replicates, columns are 
+# returned for each of them (MI replicates x crashes), since the crashes and their cells don't differ across MI replicates
+def get_crash_cells(analytic_sample,equal_mixing,driver_types,mirep=False):
     num_driver_types = len(driver_types)
-    start_params= [[init_rel_risk*numpy.ones(num_driver_types-1)],[init_rel_risk*numpy.ones(num_driver_types-1)]] # initial relative risk parameter value for estimation
-    # dim 1: bootstrap replicate; dim 2: theta, lambda, N, eta; dim 3: driver types relative to type 1
-    boot_results = numpy.zeros((bsreps,4,(num_driver_types-1)))
-    # if not bootstrapping at the accident level, convert to estimation sample now, otherwise convert after bootstrapping
-    if acc_bs==False:
-        real_sample = get_estimation_sample(analytic_sample,equal_mixing,driver_types,mirep)
-        one_veh_crash_ratio = real_sample.one_veh_crash_ratio
+    
+    if isinstance(mirep,list):
+        mirep_sufs = [str(mir) for mir in mirep]
+    elif mirep==False:
+        mirep_sufs = ['']
     else:
-        real_sample = analytic_sample.copy()
-    for bsr in range(0,bsreps):
-        if bsr==0: # use the original sample
-            boot_sample = real_sample.copy()
-        else: # draw random samples for bootstrapping
-            if acc_bs==False:
-                boot_sample = real_sample.sample(frac=1,replace=True)
-            else:                
-                boot_sample = pandas.DataFrame(index=real_sample.index.droplevel('veh_no').unique()).sample(frac=1,replace=True)
-                boot_sample = boot_sample.merge(real_sample.reset_index().set_index(['year','st_case']),on=['year','st_case']).reset_index().set_index(['year','st_case','veh_no'])
-        if acc_bs==False:
-            estimation_sample = boot_sample.copy()
+        mirep_sufs = [str(mirep)]
+    
+    # keep vehicle count and driver types of the first and second vehicles in each crash
+    veh_no2 = analytic_sample.groupby(['year','st_case']).cumcount().to_numpy()
+    crashes = analytic_sample[veh_no2==0].reset_index()
+    dt_columns = ['driver_type' + mirep_suf for mirep_suf in mirep_sufs]
+    dt_veh1 = crashes[dt_columns].to_numpy().T
+    dt_veh2 = analytic_sample.loc[veh_no2==1,dt_columns].droplevel('veh_no').reindex(pandas.MultiIndex.from_frame(crashes[['year','st_case']])).to_numpy().T
+    acc_veh_count = crashes['acc_veh_count'].to_numpy()
+    
+    # identify one-car and two-car crashes by driver types; two-car crashes of types (dt1,dt2) and (dt2,dt1) share a column
+    valid_veh1 = numpy.isin(dt_veh1,range(1,num_driver_types+1))
+    valid_veh2 = numpy.isin(dt_veh2,range(1,num_driver_types+1))
+    col = numpy.full(dt_veh1.shape,-1)
+    one_car = (acc_veh_count==1) & valid_veh1
+    col[one_car] = dt_veh1[one_car]-1
+    two_car = (acc_veh_count==2) & valid_veh1 & valid_veh2
+    col[two_car] = _two_car_cols(num_driver_types)[dt_veh1[two_car].astype(int)-1,dt_veh2[two_car].astype(int)-1]
+    if not isinstance(mirep,list):
+        col = col[0]
+    columns = ['a_' + str(dt) for dt in range(1,num_driver_types+1)]
+    for dt1 in range(1,num_driver_types+1):
+        for dt2 in range(dt1,num_driver_types+1):
+            columns.append('a_' + str(dt1) + '_' + str(dt2))
+    
+    # code equal mixing cells
+    if 'all' not in equal_mixing:
+        crash_groups = crashes.groupby(equal_mixing)
+        cell = crash_groups.ngroup().to_numpy()
+        cell_index = crash_groups.size().index
+    else:
+        cell = numpy.zeros(len(crashes.index),dtype=int)
+        cell_index = pandas.RangeIndex(1)
+    
+    return cell, col, cell_index, columns
+
+# rolls crash_cells (from get_crash_cells) up to a coarser equal_mixing, whose variables are a subset of those of the crash_cells' 
+# equal mixing (or ['all']). Each coarser cell is a group of the finer cells, so the crashes (and the crash counts of any bootstrap 
+# replicate) are the same as those from get_crash_cells at the coarser equal mixing, without encoding the crashes again
+def roll_up_crash_cells(crash_cells,equal_mixing):
+    cell, col, cell_index, columns = crash_cells
+    if 'all' in equal_mixing:
+        cell_map = numpy.zeros(len(cell_index),dtype=int)
+        rolled_cell_index = pandas.RangeIndex(1)
+    else:
+        if not set(equal_mixing) <= set(cell_index.names):
+            raise ValueError('Equal mixing ' + str(equal_mixing) + ' is not coarser than ' + str(list(cell_index.names)) + '.')
+        cell_groups = cell_index.to_frame(index=False).groupby(equal_mixing)
+        cell_map = cell_groups.ngroup().to_numpy()
+        rolled_cell_index = cell_groups.size().index
+    return numpy.where(cell>=0,cell_map[cell],-1), col, rolled_cell_index, columns
+
+# returns get_crash_cells for the analytic sample, or rolls up crash_cells to equal_mixing if given (see roll_up_crash_cells)
+def _get_crash_cells(analytic_sample,equal_mixing,driver_types,mirep,crash_cells):
+    if crash_cells is None:
+        return get_crash_cells(analytic_sample,equal_mixing,driver_types,mirep)
+    return roll_up_crash_cells(crash_cells,equal_mixing)
+
+# counts crashes by equal-mixing cell and estimation sample column (see get_crash_cells). weights are the number of times each crash 
+# is counted, e.g. the number of times it was drawn for a bootstrap replicate
+def count_crash_cells(cell,col,num_cells,num_cols,weights=None):
+    keep = (col>=0) & (cell>=0)
+    if weights is not None:
+        weights = weights[keep]
+    return numpy.bincount(cell[keep]*num_cols+col[keep],weights=weights,minlength=num_cells*num_cols).reshape((num_cells,num_cols))
+
+# sparse indicator matrix (crashes x (MI replicates * cells * columns)) of each crash's estimation sample cell and column in each MI 
+# replicate, from get_crash_cells with a list of MI replicates. Used by count_crash_cells_mi
+def crash_cell_indicator(cell,col_mi,num_cells,num_cols):
+    num_mireps, num_crashes = col_mi.shape
+    keep = (col_mi>=0) & (cell>=0)
+    crash_idx = numpy.broadcast_to(numpy.arange(num_crashes),col_mi.shape)[keep]
+    cell_col_idx = ((numpy.arange(num_mireps)[:,numpy.newaxis]*num_cells + cell)*num_cols + col_mi)[keep]
+    return scipy.sparse.csr_matrix((numpy.ones(len(crash_idx)),(crash_idx,cell_col_idx)),shape=(num_crashes,num_mireps*num_cells*num_cols))
+
+# counts crashes by estimation sample cell and column for all MI replicates and for each set of crash weights (bootstrap replicates x 
+# crashes, see count_crash_cells) at once, as a stacked (MI replicates x bootstrap replicates x cells x columns) tensor of counts
+def count_crash_cells_mi(indicator,num_mireps,num_cells,num_cols,weights=None):
+    if weights is None:
+        weights = numpy.ones((1,indicator.shape[0]))
+    counts = numpy.asarray((indicator.T @ weights.T).T)
+    return counts.reshape((numpy.size(weights,axis=0),num_mireps,num_cells,num_cols)).swapaxes(0,1)
+
+# calculates the one-vehicle crash share parameters from the crash counts, and then flags the rows of the estimation sample to keep
+def _restrict_crash_counts(counts,equal_mixing,num_driver_types):
+    one_veh_crash_ratio = counts[:,1:num_driver_types].sum(axis=0)/counts[:,0].sum()
+    if 'all' not in equal_mixing:
+        # drop observations where there are no (one-vehicle, driver type 1) or no (one-vehicle, driver type 2) crashes [otherwise, model won't converge]
+        keep = (counts[:,:num_driver_types]>0).all(axis=1)
+    else:
+        keep = numpy.ones(numpy.size(counts,axis=0),dtype=bool)
+    return keep, one_veh_crash_ratio
+
+# samples to be bootstrapped (see _bootstrap_sample), keyed by MI replicate (or False if not MI, or 'mi' for all MI replicates with 
+# shared bootstrap draws). These are set once per process, so that worker processes receive each sample once rather than with every task
+_bs_samples = {}
+_bs_blocks = []
+
+# a numpy array in a shared memory block, or a sparse matrix whose arrays are (see _share_bs_samples)
+_SharedArray = collections.namedtuple('_SharedArray',['name','shape','dtype'])
+_SharedCsr = collections.namedtuple('_SharedCsr',['data','indices','indptr','shape'])
+
+def _init_bootstrap_worker(bs_samples):
+    global _bs_samples, _bs_blocks
+    _bs_blocks = list()
+    _bs_samples = {bs_key: _attach_bs_sample(bs_sample,_bs_blocks) for (bs_key, bs_sample) in bs_samples.items()}
+
+# copies the arrays of the samples in bs_samples (numpy arrays and the arrays of csr matrices) into shared memory, so that worker 
+# processes attach to one copy of them rather than each unpickling its own. Returns the shared memory blocks, to be closed and unlinked 
+# once the workers are done, and bs_samples with each array replaced by its block (_SharedArray or _SharedCsr)
+def _share_bs_samples(bs_samples):
+    blocks = list()
+    def share(x):
+        if isinstance(x,numpy.ndarray) and (x.nbytes > 0) and not x.dtype.hasobject:
+            block = multiprocessing.shared_memory.SharedMemory(create=True,size=x.nbytes)
+            blocks.append(block)
+            numpy.ndarray(x.shape,dtype=x.dtype,buffer=block.buf)[...] = x
+            return _SharedArray(block.name,x.shape,x.dtype.str)
+        elif isinstance(x,scipy.sparse.csr_matrix):
+            return _SharedCsr(share(x.data),share(x.indices),share(x.indptr),x.shape)
+        else:
+            return x
+    try:
+        shared_samples = {bs_key: tuple(share(x) for x in bs_sample) for (bs_key, bs_sample) in bs_samples.items()}
+    except:
+        _release_blocks(blocks)
+        raise
+    return blocks, shared_samples
+
+# replaces the shared arrays of a sample from _share_bs_samples with arrays backed by their shared memory blocks, which are added to 
+# blocks so that they stay open while the arrays are used
+def _attach_bs_sample(bs_sample,blocks):
+    def attach(x):
+        if isinstance(x,_SharedArray):
+            block = multiprocessing.shared_memory.SharedMemory(name=x.name)
+            blocks.append(block)
+            return numpy.ndarray(x.shape,dtype=x.dtype,buffer=block.buf)
+        elif isinstance(x,_SharedCsr):
+            return scipy.sparse.csr_matrix((attach(x.data),attach(x.indices),attach(x.indptr)),shape=x.shape,copy=False)
         else:
-            estimation_sample = get_estimation_sample(boot_sample,equal_mixing,driver_types,mirep)
-            one_veh_crash_ratio = estimation_sample.one_veh_crash_ratio
+            return x
+    return tuple(attach(x) for x in bs_sample)
+
+# closes and frees the shared memory blocks from _share_bs_samples
+def _release_blocks(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+# draws a bootstrap replicate of the crashes using the replicate's own seed, as the number of times each crash is drawn
+def _draw_crash_weights(num_crashes,seed):
+    rng = numpy.random.default_rng(seed)
+    return numpy.bincount(rng.integers(0,num_crashes,num_crashes),minlength=num_crashes)
+
+# fits the LP model to the estimation sample of one bootstrap replicate (replicate 0 is the original sample), returning ([theta], 
+# [lambda], [N], [P]), the log-likelihood, the residual degrees of freedom and whether the optimizer converged to finite estimates
+def _fit_replicate(estimation_sample,one_veh_crash_ratio,num_driver_types,pairwise,init_rel_risk,method,bsr):
+    start_params = init_rel_risk*numpy.ones(2*(num_driver_types-1)) # initial relative risk parameter value for estimation (theta, then lambda)
+    if (bsr>0) & (method in fit_lp_methods): # fit the bootstrap replicates without constructing a model (see fit_lp)
+        params, llf, df_resid, converged = fit_lp(estimation_sample,num_driver_types,pairwise,start_params,method)
+    else:
         mod = Lp(estimation_sample,num_driver_types=num_driver_types,pairwise=pairwise) # create the model (modified GenericLikelihoodModel)    
-        results = mod.fit(start_params=start_params,skip_hessian=True) # fit the model, skipping hessian calculation because we're bootstrapping
+        # fit the model, skipping hessian calculation for the bootstrap replicates (the analytic hessian is cheap enough to keep for the original sample)
+        results = mod.fit(start_params=start_params,method=method,skip_hessian=(bsr>0))
 #        print(results.summary()) # summarize the model fit
-        boot_results[bsr][0] = results.params[:(num_driver_types-1)] # theta
-        boot_results[bsr][1] = results.params[(num_driver_types-1):] # lambda
-        for i in range(0,(num_driver_types-1)): # N
-            boot_results[bsr][2][i] = (1/boot_results[bsr][1][i])*one_veh_crash_ratio[i]   
-        # P, the proportion of that driver type on the road (LP didn't assign a letter to this value)
-        for i in range(0,(num_driver_types-1)):
-            boot_results[bsr][3][i] = boot_results[bsr][2][i]/(1+numpy.sum(boot_results[bsr][2],axis=0))
+        params, llf, df_resid, converged = results.params, results.llf, results.df_resid, results.mle_retvals['converged']
+    boot_result = _boot_result(params,one_veh_crash_ratio,num_driver_types)
+    return (boot_result, llf, df_resid, bool(converged & numpy.isfinite(boot_result).all() & numpy.isfinite(llf)))
+
+# ([theta], [lambda], [N], [P]) from the estimated parameters of a replicate
+def _boot_result(params,one_veh_crash_ratio,num_driver_types):
+    boot_result = numpy.zeros((4,(num_driver_types-1)))
+    boot_result[0] = params[:(num_driver_types-1)] # theta
+    boot_result[1] = params[(num_driver_types-1):] # lambda
+    boot_result[2] = (1/boot_result[1])*one_veh_crash_ratio # N
+    boot_result[3] = boot_result[2]/(1+numpy.sum(boot_result[2])) # P, the proportion of that driver type on the road (LP didn't assign a letter to this value)
+    return boot_result
+
+# fits the LP model to the estimation samples of a list of bootstrap replicates, returning the results of _fit_replicate for each. 
+# With method 'newton_batch', all of them are fit at once by fit_lp_batch, padded to num_rows rows
+def _fit_replicates(estimation_samples,one_veh_crash_ratios,num_driver_types,pairwise,init_rel_risk,method,bsrs,num_rows):
+    if method != 'newton_batch':
+        return [_fit_replicate(estimation_sample,one_veh_crash_ratio,num_driver_types,pairwise,init_rel_risk,method,bsr) 
+                for (estimation_sample, one_veh_crash_ratio, bsr) in zip(estimation_samples,one_veh_crash_ratios,bsrs)]
+    start_params = init_rel_risk*numpy.ones(2*(num_driver_types-1))
+    params, llf, df_resid, converged = fit_lp_batch(estimation_samples,num_driver_types,pairwise,start_params,num_rows=num_rows)
+    boot_results = [_boot_result(params[r],one_veh_crash_ratios[r],num_driver_types) for r in range(0,len(bsrs))]
+    return [(boot_results[r], llf[r], df_resid[r], bool(converged[r] & numpy.isfinite(boot_results[r]).all() & numpy.isfinite(llf[r]))) 
+            for r in range(0,len(bsrs))]
+
+# the number of replicates (MI replicates x bootstrap replicates) whose estimation samples are held at once, as dense arrays of cells x 
+# columns, and fit together; a task's bootstrap replicates are drawn and fit in chunks of this many, so that memory doesn't grow with bsreps
+_bs_chunk_size = 20
+
+# fits the LP model for a list of bootstrap replicates of the sample selected by bs_key from _bs_samples, returning the MI replicate 
+# (bs_key), the bootstrap replicate and the results of _fit_replicate for each. Each replicate draws its sample using its own seed, 
+# so results don't depend on how replicates are split across processes (or chunks)
+def _fit_bootstrap_replicates(bs_key,equal_mixing,num_driver_types,pairwise,init_rel_risk,acc_bs,method,bsrs,seeds):
+    if len(bsrs) > _bs_chunk_size:
+        return [rep_result for c in range(0,len(bsrs),_bs_chunk_size) for rep_result in 
+                _fit_bootstrap_replicates(bs_key,equal_mixing,num_driver_types,pairwise,init_rel_risk,acc_bs,method,bsrs[c:(c+_bs_chunk_size)],seeds[c:(c+_bs_chunk_size)])]
+    bs_sample = _bs_samples[bs_key]
+    estimation_samples = list()
+    one_veh_crash_ratios = list()
+    for (bsr, seed) in zip(bsrs,seeds):
+        if acc_bs==False:
+            real_sample, one_veh_crash_ratio = bs_sample
+            num_rows = numpy.size(real_sample,axis=0)
+            if bsr==0: # use the original sample
+                estimation_sample = real_sample
+            else: # draw random samples for bootstrapping
+                estimation_sample = real_sample[numpy.random.default_rng(seed).integers(0,num_rows,num_rows)]
+        else:
+            crash_cell, crash_col, num_cells, num_cols = bs_sample
+            if bsr==0: # use the original sample
+                crash_weights = None
+            else: # draw random samples for bootstrapping
+                crash_weights = _draw_crash_weights(len(crash_cell),seed)
+            crash_counts = count_crash_cells(crash_cell,crash_col,num_cells,num_cols,crash_weights)
+            keep, one_veh_crash_ratio = _restrict_crash_counts(crash_counts,equal_mixing,num_driver_types)
+            estimation_sample = crash_counts[keep]
+            num_rows = num_cells
+        estimation_samples.append(estimation_sample)
+        one_veh_crash_ratios.append(one_veh_crash_ratio)
+    rep_results = _fit_replicates(estimation_samples,one_veh_crash_ratios,num_driver_types,pairwise,init_rel_risk,method,bsrs,num_rows)
+    return [(bs_key, bsr, rep_result) for (bsr, rep_result) in zip(bsrs,rep_results)]
+
+# as _fit_bootstrap_replicates, but for all MI replicates at once with shared bootstrap draws: each bootstrap replicate's crashes 
+# are drawn once, and the crash counts of all MI replicates are aggregated against them in one pass. Bootstrap replicates are taken 
+# in chunks, so that the dense tensor from count_crash_cells_mi holds at most about _bs_chunk_size replicates
+def _fit_bootstrap_replicates_mi(bs_key,equal_mixing,num_driver_types,pairwise,init_rel_risk,acc_bs,method,bsrs,seeds):
+    indicator, mireps, num_cells, num_cols = _bs_samples[bs_key]
+    chunk_size = max(1,_bs_chunk_size//len(mireps))
+    if len(bsrs) > chunk_size:
+        return [rep_result for c in range(0,len(bsrs),chunk_size) for rep_result in 
+                _fit_bootstrap_replicates_mi(bs_key,equal_mixing,num_driver_types,pairwise,init_rel_risk,acc_bs,method,bsrs[c:(c+chunk_size)],seeds[c:(c+chunk_size)])]
+    num_crashes = indicator.shape[0]
+    crash_weights = numpy.array([numpy.ones(num_crashes) if bsr==0 else _draw_crash_weights(num_crashes,seed) for (bsr, seed) in zip(bsrs,seeds)])
+    crash_counts = count_crash_cells_mi(indicator,len(mireps),num_cells,num_cols,crash_weights)
+    rep_keys = list()
+    estimation_samples = list()
+    one_veh_crash_ratios = list()
+    for miidx in range(0,len(mireps)):
+        for bsidx in range(0,len(bsrs)):
+            keep, one_veh_crash_ratio = _restrict_crash_counts(crash_counts[miidx,bsidx],equal_mixing,num_driver_types)
+            rep_keys.append((mireps[miidx], bsrs[bsidx]))
+            estimation_samples.append(crash_counts[miidx,bsidx][keep])
+            one_veh_crash_ratios.append(one_veh_crash_ratio)
+    rep_results = _fit_replicates(estimation_samples,one_veh_crash_ratios,num_driver_types,pairwise,init_rel_risk,method,[bsr for (mir, bsr) in rep_keys],num_cells)
+    return [(mir, bsr, rep_result) for ((mir, bsr), rep_result) in zip(rep_keys,rep_results)]
+
+# runs each task, a tuple of arguments to fit_func (_fit_bootstrap_replicates or _fit_bootstrap_replicates_mi), either serially or 
+# spread across n_jobs worker processes, and returns the replicate results of all tasks keyed by (MI replicate, bootstrap replicate). 
+# bs_samples are copied once into shared memory, which each worker process attaches to when it starts, so that memory doesn't grow 
+# with n_jobs beyond each worker's own estimation samples. Note that scripts using n_jobs > 1 on Windows need an 
+# if __name__ == '__main__' guard
+def _run_bootstrap_tasks(bs_samples,fit_func,tasks,n_jobs=1):
+    if n_jobs == 1:
+        _init_bootstrap_worker(bs_samples)
+        try:
+            task_results = [fit_func(*task) for task in tasks]
+        finally:
+            _init_bootstrap_worker({})
+    else:
+        blocks, shared_samples = _share_bs_samples(bs_samples)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_bootstrap_worker,initargs=(shared_samples,)) as executor:
+                task_results = list(executor.map(fit_func,*zip(*tasks)))
+        finally:
+            _release_blocks(blocks)
+    return {(mir, bsr): rep_result for task_result in task_results for (mir, bsr, rep_result) in task_result}
+
+# splits bootstrap replicates into one task (see _run_bootstrap_tasks) per worker, giving each replicate its own seed spawned from rseed
+def _bootstrap_tasks(bs_key,bs_args,bsreps,rseed,n_jobs):
+    seeds = numpy.random.SeedSequence(rseed).spawn(bsreps)
+    return [(bs_key,) + bs_args + (list(bsrs), [seeds[bsr] for bsr in bsrs]) for bsrs in numpy.array_split(numpy.arange(bsreps),min(n_jobs,bsreps))]
+
+# converts the analytic sample into the form that is bootstrapped by _fit_bootstrap_replicates. If not bootstrapping at the accident 
+# level, convert to estimation sample now, otherwise encode crashes once (or roll up crash_cells) and count them for each bootstrap replicate
+def _bootstrap_sample(analytic_sample,equal_mixing,driver_types,mirep,acc_bs,crash_cells=None):
+    if acc_bs==False:
+        real_sample = get_estimation_sample(analytic_sample,equal_mixing,driver_types,mirep,crash_cells)
+        return (real_sample.to_numpy(), real_sample.one_veh_crash_ratio)
+    else:
+        crash_cell, crash_col, cell_index, columns = _get_crash_cells(analytic_sample,equal_mixing,driver_types,mirep,crash_cells)
+        return (crash_cell, crash_col, len(cell_index), len(columns))
+
+# fit the LP model using constructed estimation sample. Bootstrap replicates are fit in n_jobs worker processes, and are exactly 
+# replicated for a given rseed regardless of n_jobs. With method 'newton_batch', the bootstrap replicates of each worker are fit 
+# together by a batched Newton iteration (see fit_lp_batch) rather than one at a time by the statsmodels optimizer. When fitting 
+# several equal mixings of the same analytic sample, pass crash_cells from get_crash_cells at the finest of them, so that crashes are 
+# encoded once and rolled up for each (see roll_up_crash_cells)
+#def fit_model(estimation_sample,num_driver_types,bsreps=100):           
+def fit_model(analytic_sample,equal_mixing,driver_types,pairwise=True,init_rel_risk=10,bsreps=100,mirep=False,rseed=1,acc_bs=True,method='nm',n_jobs=1,crash_cells=None):           
+    _check_fit_method(method)
+    num_driver_types = len(driver_types)
+    bs_samples = {mirep: _bootstrap_sample(analytic_sample,equal_mixing,driver_types,mirep,acc_bs,crash_cells)}
+    bs_args = (equal_mixing,num_driver_types,pairwise,init_rel_risk,acc_bs,method)
+    rep_results = _run_bootstrap_tasks(bs_samples,_fit_bootstrap_replicates,_bootstrap_tasks(mirep,bs_args,bsreps,rseed,n_jobs),n_jobs)
+    return _summarize_bootstrap([rep_results[(mirep, bsr)] for bsr in range(0,bsreps)],num_driver_types)
+
+# the optimization methods supported by fit_model and fit_model_mi: 'nm' (the default), 'bfgs' and 'newton' (using the analytic 
+# derivatives, in the logs of the parameters; see fit_lp and Lp.fit), and 'newton_batch' (see fit_lp_batch). Bootstrap replicates that 
+# nevertheless fail to converge are dropped from the standard errors (see _summarize_bootstrap). 'newton_batch' is 
+# much faster for large samples, but with more than two driver types in full estimation it can settle on different maxima than 'nm'
+fit_methods = ['nm','bfgs','newton','newton_batch']
+
+def _check_fit_method(method):
+    if method not in fit_methods:
+        raise ValueError('Method ' + str(method) + ' is not supported; use one of ' + str(fit_methods) + '.')
+
+# collects the bootstrap replicate results from _fit_bootstrap_replicates, and calculates and reports the parameters and bootstrapped 
+# standard errors. Bootstrap replicates that didn't converge to finite estimates are dropped from the standard errors, and counted
+def _summarize_bootstrap(rep_results,num_driver_types):
+    bsreps = len(rep_results)
+    # dim 1: bootstrap replicate; dim 2: theta, lambda, N, eta; dim 3: driver types relative to type 1
+    boot_results = numpy.zeros((bsreps,4,(num_driver_types-1)))
+    converged = numpy.zeros(bsreps,dtype=bool)
+    for bsr in range(0,bsreps):
+        boot_results[bsr], rep_llf, rep_df_resid, converged[bsr] = rep_results[bsr]
         if bsr==0:
-            model_llf = results.llf
-            model_df_resid = results.df_resid
+            model_llf = rep_llf
+            model_df_resid = rep_df_resid
         print('([theta], [lambda], [N], [P]) estimated for bootstrap replicate '+str(bsr))
         print(boot_results[bsr])
-        print('Log-likelihood: ', results.llf)
-        print('Residual degrees of freedom: ', results.df_resid)
+        print('Log-likelihood: ', rep_llf)
+        print('Residual degrees of freedom: ', rep_df_resid)
+        if not converged[bsr]:
+            print('Failed to converge')
+    if not converged[0]:
+        warnings.warn('The model did not converge for the original sample.', ConvergenceWarning)
+    num_dropped = (~converged[1:]).sum()
+    if num_dropped > 0:
+        warnings.warn('Dropped ' + str(num_dropped) + ' of ' + str(bsreps-1) + ' bootstrap replicates that did not converge.', ConvergenceWarning)
         
     # dim 1: estimate, std err; dim 2: theta, lambda, N, eta; dim 3: driver types relative to type 1
     final_results = numpy.zeros((2,4,(num_driver_types-1)))
     final_results[0] = boot_results[0]
     if bsreps>1:    
-        final_results[1] = bs_se(boot_results,axis=0)
+        final_results[1] = bs_se(boot_results[converged],axis=0)
     else:
         final_results[1] = numpy.nan
     
@@ -135,21 +399,43 @@ def fit_model(analytic_sample,equal_mixing,driver_types,pairwise=True,init_rel_r
     print(final_results[1])
     print('Log-likelihood: ', model_llf)
     print('Residual degrees of freedom: ', model_df_resid)
+    print('Bootstrap replicates dropped because they did not converge: ', num_dropped)
     
     return final_results, model_llf, model_df_resid
 
 # wrapper around fit_model which implements multiple imputation estimation. Generates estimates for each MI replicate, and then
-# combines the results to produce final estimates and standard errors
-def fit_model_mi(analytic_sample,equal_mixing,driver_types,pairwise=True,init_rel_risk=10,bsreps=100,mireps=10,rseed=1,acc_bs=True):    
+# combines the results to produce final estimates and standard errors. Bootstrap replicates of all MI replicates are fit together in 
+# n_jobs worker processes, and give the same results as fitting each MI replicate separately with fit_model. With shared_draws (for 
+# bootstrapping at the accident level), each bootstrap replicate's crashes are drawn once for all MI replicates, rather than separately. 
+# crash_cells are as in fit_model, from get_crash_cells for the list of all MI replicates
+def fit_model_mi(analytic_sample,equal_mixing,driver_types,pairwise=True,init_rel_risk=10,bsreps=100,mireps=10,rseed=1,acc_bs=True,method='nm',n_jobs=1,shared_draws=True,crash_cells=None):    
+    _check_fit_method(method)
     num_driver_types = len(driver_types)       
     # dimensions are mireps, estimates & standard errors, parameters, driver types relative to type 1
     results_params = numpy.zeros((mireps,2,4,(num_driver_types-1)))
     mi_llf = 0
     mi_df_resid = 0
-    # loop over mi replicates and estimate model for each
+    # build the sample to be bootstrapped for each mi replicate, and then estimate models for all of them
+    bs_args = (equal_mixing,num_driver_types,pairwise,init_rel_risk,acc_bs,method)
+    print('Estimating models for multiple imputation replicates')
+    if (shared_draws == True) & (acc_bs == True):
+        crash_cell, crash_col_mi, cell_index, columns = _get_crash_cells(analytic_sample,equal_mixing,driver_types,list(range(1,mireps+1)),crash_cells)
+        bs_samples = {'mi': (crash_cell_indicator(crash_cell,crash_col_mi,len(cell_index),len(columns)),list(range(1,mireps+1)),len(cell_index),len(columns))}
+        rep_results = _run_bootstrap_tasks(bs_samples,_fit_bootstrap_replicates_mi,_bootstrap_tasks('mi',bs_args,bsreps,rseed,n_jobs),n_jobs)
+    else:
+        bs_samples = dict()
+        tasks = list()
+        for mir in range(0,mireps):
+            if crash_cells is None:
+                bs_samples[mir+1] = _bootstrap_sample(analytic_sample,equal_mixing,driver_types,(mir+1),acc_bs)
+            else: # select the MI replicate's crash columns
+                bs_samples[mir+1] = _bootstrap_sample(analytic_sample,equal_mixing,driver_types,(mir+1),acc_bs,
+                                                      (crash_cells[0],crash_cells[1][mir],crash_cells[2],crash_cells[3]))
+            tasks += _bootstrap_tasks((mir+1),bs_args,bsreps,rseed,n_jobs)
+        rep_results = _run_bootstrap_tasks(bs_samples,_fit_bootstrap_replicates,tasks,n_jobs)
     for mir in range(0,mireps):
-        print('Estimating model for multiple imputation replicate ' + str(mir))
-        mod_results, mod_llf, mod_df_resid = fit_model(analytic_sample,equal_mixing,driver_types,pairwise,init_rel_risk,bsreps,(mir+1),rseed,acc_bs)
+        print('Estimated model for multiple imputation replicate ' + str(mir))
+        mod_results, mod_llf, mod_df_resid = _summarize_bootstrap([rep_results[(mir+1, bsr)] for bsr in range(0,bsreps)],num_driver_types)
         results_params[mir] = mod_results
         mi_llf += mod_llf/mireps
         mi_df_resid += mod_df_resid/mireps
@@ -168,89 +454,126 @@ def fit_model_mi(analytic_sample,equal_mixing,driver_types,pairwise=True,init_re
 
     return mi_results, mi_llf, mi_df_resid
 
-# defines the log-likehood function. A is the set of accident data; N[i] is the proportion of crashes of type i, relative to type 1;
-# thet[i] is the two-car crash relative risk of type i, relative to type 1; lamb[i] is the one-car crash relative risk of type i, relative to type 1
-# A can't be passed in as a pandas, so need to work with matrix indices
-def _ll_lp(A, num_driver_types, pairwise, thet, lamb):    
-    # print(thet)
-    # print(lamb)
-    num_agg_rows = numpy.size(A,axis=0)
-    ll = numpy.zeros((num_agg_rows)) # log-likelihood
-          
-    if (pairwise == True): # For pairwise estimation, loop over pairs relative to the base type (first in driver type list)   
-        # print('Running pairwise estimation model')    
-        for dti in range(1,num_driver_types): # for each driver type index, build pairwise log-likelihood component                    
-            A_1 = A[:,[0,dti]] # one car crashes
-            A_2 = numpy.zeros((num_agg_rows,2,2)) # two car crashes
-            curr_col = num_driver_types
-            for dtout in range(0,num_driver_types):
-                for dtin in range(0,num_driver_types):
-                    if (dtin >= dtout) & (dtout in [0,dti]) & (dtin in [0,dti]):
-                        A_2[:,int(dtout/dti),int(dtin/dti)] = A[:,curr_col]
-                    if dtin >= dtout:
-                        curr_col += 1                                    
-            ll += _ll_lp_component(A_1, A_2, 2, [thet[(dti-1)]], [lamb[(dti-1)]])
-    else: # For full estimation (more than two driver types), use all types simultaneously
-        # to simplify indexing, first convert the estimation sample into separate matrices, one for single-car and one for two-car
-        # print('Running full estimation model')
-        A_1 = A[:,:num_driver_types] # one car crashes
-        A_2 = numpy.zeros((num_agg_rows,num_driver_types,num_driver_types)) # two car crashes
-        curr_col = num_driver_types
-        for dtout in range(0,num_driver_types):
-            for dtin in range(0,num_driver_types):
-                if dtin >= dtout:
-                    A_2[:,dtout,dtin] = A[:,curr_col]
-                    curr_col += 1        
-        ll += _ll_lp_component(A_1, A_2, num_driver_types, thet, lamb)
-        
-    return ll
-
-def _ll_lp_component(A_1, A_2, num_driver_types, thet, lamb):
-    num_agg_rows = numpy.size(A_1,axis=0)
-    ll_component = numpy.zeros((num_agg_rows)) # log-likelihood
+# builds the index maps used by the likelihood kernel, which only depend on the number of driver types and the estimation mode. 
+# The likelihood is the sum of one or more components: for pairwise estimation, there is one component for each driver type paired 
+# with the base type (first in driver type list); for full estimation (more than two driver types), there is one component that uses 
+# all types simultaneously. types (components x types per component) holds the driver type indices in each component, one_car_cols 
+# the matching columns of single-car crashes in A, and two_car_cols (components x two-car crash types) the columns of two-car crashes 
+# in the upper triangle (dtout <= dtin) of each component's types
+def _lp_index_maps(num_driver_types, pairwise):
+    two_car_col = _two_car_cols(num_driver_types)
+    if (pairwise == True):
+        types = numpy.array([[0,dti] for dti in range(1,num_driver_types)],dtype=int)
+    else:
+        types = numpy.arange(num_driver_types).reshape((1,num_driver_types))
+    one_car_cols = types
+    iu_comp = numpy.triu_indices(numpy.size(types,axis=1))
+    two_car_cols = two_car_col[types[:,iu_comp[0]],types[:,iu_comp[1]]]
     
-    # add arrays of 1's to represent driver type 1 relative to themselves
-    thet_1 = numpy.concatenate((numpy.ones(num_driver_types-1),thet)) 
-    lamb_1 = numpy.concatenate((numpy.ones(num_driver_types-1),lamb))
+    return types, one_car_cols, two_car_cols
+
+# columns of A holding two-car crashes of driver types (dtout,dtin), which are stored after the single-car crashes in upper triangle 
+# order. Crashes of types (dtout,dtin) and (dtin,dtout) share a column
+def _two_car_cols(num_driver_types):
+    two_car_col = numpy.zeros((num_driver_types,num_driver_types),dtype=int)
+    iu = numpy.triu_indices(num_driver_types)
+    two_car_col[iu] = numpy.arange(num_driver_types,num_driver_types+len(iu[0]))
+    two_car_col[iu[1],iu[0]] = two_car_col[iu]
+    return two_car_col
 
+# adds 1's to represent driver type 1 relative to themselves, then picks out the parameters of each component's driver types. thet and 
+# lamb are either vectors of parameters, or (replicates x parameters) to give each replicate its own parameters (see fit_lp_batch)
+def _lp_type_params(types, thet, lamb):
+    one = numpy.ones(numpy.shape(thet)[:-1]+(1,))
+    return numpy.concatenate((one,thet),axis=-1)[...,types], numpy.concatenate((one,lamb),axis=-1)[...,types]
+
+# the log-likelihood kernel: A_1 (rows x components x types per component) are single-car crashes and A_2 (rows x components x 
+# two-car crash types) are two-car crashes, as gathered from A using the index maps from _lp_index_maps. N[i] is the proportion of 
+# crashes of type i, relative to type 1; thet[i] is the two-car crash relative risk of type i, relative to type 1; lamb[i] is the 
+# one-car crash relative risk of type i, relative to type 1. Only the parameter-dependent part of the log-likelihood is calculated 
+# here; the multinomial constant is added separately (see _ll_lp_const)
+def _ll_lp_kernel(A_1, A_2, types, thet, lamb):
+    thet_1, lamb_1 = _lp_type_params(types, thet, lamb)
+    
     # first substitute in for N values: incorporate information from single car crashes using the fact that larger observed quantities 
     # of one type suggest more drivers on the road of that type
-    N = numpy.ones((num_agg_rows,num_driver_types))
-    for dt in range(0,num_driver_types): # count of a driver type relative to type 1
-        N[:,dt] = (1/lamb_1[dt])*(A_1[:,dt]/A_1[:,0])
-   
-    # build the probability values for accidents of each type: first build the probability denominator
-    p_denom = numpy.zeros((num_agg_rows))
-    for dtout in range(0,num_driver_types):
-        for dtin in range(0,num_driver_types):
-            p_denom += N[:,dtout]*N[:,dtin]*(thet_1[dtout]+thet_1[dtin])
-    
-    # next build the set of probabilities and add accidents
-    p = numpy.zeros((num_agg_rows,num_driver_types,num_driver_types))
-    for dtout in range(0,num_driver_types):
-        for dtin in range(0,num_driver_types):
-            if dtin >= dtout:
-                p[:,dtout,dtin] = N[:,dtout]*N[:,dtin]*(thet_1[dtout]+thet_1[dtin])/p_denom
-                if dtin != dtout:
-                    p[:,dtout,dtin] = 2*p[:,dtout,dtin] # after eliminating the duplicates, need to add in the probability of observing the two types reversed
-                    
+    N = (A_1/A_1[:,:,:1])/lamb_1 # count of a driver type relative to type 1
+    
+    # build the probability values for accidents of each type: first build the probability denominator, which is the sum over all 
+    # ordered pairs of driver types of N[dtout]*N[dtin]*(thet_1[dtout]+thet_1[dtin])
+    p_denom = 2*(N*thet_1).sum(axis=2)*N.sum(axis=2)
+    
+    # next build the set of probabilities for the upper triangle of two-car crash types
+    iu = numpy.triu_indices(numpy.size(types,axis=1))
+    p = N[:,:,iu[0]]*N[:,:,iu[1]]*(thet_1[:,iu[0]]+thet_1[:,iu[1]])/p_denom[:,:,numpy.newaxis]
+    p[:,:,iu[0]!=iu[1]] *= 2 # after eliminating the duplicates, need to add in the probability of observing the two types reversed
+    
     # construct the likelihood function using the above components
-    two_veh_total = 0
-    for dtout in range(0,num_driver_types):
-       for dtin in range(0,num_driver_types):
-           if dtin >= dtout:
-               ll_component += A_2[:,dtout,dtin]*numpy.log(p[:,dtout,dtin]) 
-               two_veh_total += A_2[:,dtout,dtin] # build the two-vehicle total while we're at it
-    
-    # add natural log of the factorial of total 2-car crashes (need to do this separately for each row )
-    for i in range(0,num_agg_rows):
-        ll_component[i] += lnfactorial(two_veh_total[i])
-        for dtout in range(0,num_driver_types):
-            for dtin in range(0,num_driver_types):
-                if dtin >= dtout:
-                    ll_component[i] -= lnfactorial(A_2[i,dtout,dtin])
-                    
-    return ll_component
+    return (A_2*numpy.log(p)).sum(axis=(1,2))
+
+# maps the parameters of each component's driver types (thet_1 then lamb_1, as in _ll_lp_kernel) to the model's parameters (thet then 
+# lamb), for collecting derivatives across components. The base type's parameters are fixed at 1, so they don't map to anything
+def _lp_param_map(types, num_driver_types):
+    num_comp_types = numpy.size(types,axis=1)
+    param_map = numpy.zeros((numpy.size(types,axis=0),2*num_comp_types,2*(num_driver_types-1)))
+    for c in range(0,numpy.size(types,axis=0)):
+        for l in range(0,num_comp_types):
+            if types[c,l] > 0:
+                param_map[c,l,types[c,l]-1] = 1 # theta
+                param_map[c,num_comp_types+l,(num_driver_types-1)+types[c,l]-1] = 1 # lambda
+    return param_map
+
+# the terms shared by the analytic derivatives of the log-likelihood kernel (see _ll_lp_kernel for notation). With u = sum(N*thet_1) 
+# and v = sum(N), the probability denominator is 2*u*v. T is the total of two-car crashes, E[l,x] is the number of times driver type 
+# l is involved in two-car crash type x, and thet_sum[x] is the sum of thet_1 over the two driver types of two-car crash type x
+def _lp_deriv_terms(A_1, A_2, types, thet, lamb):
+    num_comp_types = numpy.size(types,axis=1)
+    thet_1, lamb_1 = _lp_type_params(types, thet, lamb)
+    N = (A_1/A_1[:,:,:1])/lamb_1
+    u = (N*thet_1).sum(axis=2)[:,:,numpy.newaxis]
+    v = N.sum(axis=2)[:,:,numpy.newaxis]
+    T = A_2.sum(axis=2)[:,:,numpy.newaxis]
+    iu = numpy.triu_indices(num_comp_types)
+    E = (iu[0]==numpy.arange(num_comp_types)[:,numpy.newaxis]).astype(float) + (iu[1]==numpy.arange(num_comp_types)[:,numpy.newaxis])
+    thet_sum = thet_1[:,iu[0]]+thet_1[:,iu[1]]
+    return thet_1, lamb_1, N, u, v, T, E, thet_sum
+
+# analytic gradient of the log-likelihood kernel for each row, with respect to the parameters (thet then lamb)
+def _score_obs_lp_kernel(A_1, A_2, types, param_map, thet, lamb):
+    thet_1, lamb_1, N, u, v, T, E, thet_sum = _lp_deriv_terms(A_1, A_2, types, thet, lamb)
+    score_thet = numpy.matmul(A_2/thet_sum,E.T) - T*N/u
+    score_lamb = (T*N*(thet_1/u + 1/v) - numpy.matmul(A_2,E.T))/lamb_1
+    return numpy.einsum('rcx,cxy->ry',numpy.concatenate((score_thet,score_lamb),axis=2),param_map)
+
+# analytic Hessian of the log-likelihood kernel, summed over rows, with respect to the parameters (thet then lamb)
+def _hessian_lp_kernel(A_1, A_2, types, param_map, thet, lamb):
+    thet_1, lamb_1, N, u, v, T, E, thet_sum = _lp_deriv_terms(A_1, A_2, types, thet, lamb)
+    num_comp_types = numpy.size(types,axis=1)
+    eye = numpy.eye(num_comp_types)
+    NN = N[:,:,:,numpy.newaxis]*N[:,:,numpy.newaxis,:]
+    T = T[:,:,:,numpy.newaxis]
+    u = u[:,:,:,numpy.newaxis]
+    v = v[:,:,:,numpy.newaxis]
+    t_l = thet_1[:,:,numpy.newaxis]
+    t_m = thet_1[:,numpy.newaxis,:]
+    lamb_l = lamb_1[:,:,numpy.newaxis]
+    lamb_m = lamb_1[:,numpy.newaxis,:]
+    N_l = N[:,:,:,numpy.newaxis]
+    
+    hess_tt = T*NN/u**2 - numpy.einsum('rcx,lx,mx->rclm',A_2/thet_sum**2,E,E)
+    hess_tl = (T/lamb_m)*(eye*N_l/u - NN*t_m/u**2)
+    score_lamb = ((T*N_l*(t_l/u + 1/v))[:,:,:,0] - numpy.matmul(A_2,E.T))/lamb_1
+    hess_ll = -eye*(score_lamb/lamb_1)[:,:,:,numpy.newaxis] + (T/(lamb_l*lamb_m))*(-eye*N_l*(t_l/u + 1/v) + NN*(t_l*t_m/u**2 + 1/v**2))
+    
+    hess = numpy.concatenate((numpy.concatenate((hess_tt,hess_tl),axis=3),
+                              numpy.concatenate((numpy.swapaxes(hess_tl,2,3),hess_ll),axis=3)),axis=2).sum(axis=0)
+    return numpy.einsum('cxy,cxz,czw->yw',param_map,hess,param_map)
+
+# the natural log of the multinomial coefficient for two-car crashes, by row: the natural log of the factorial of total 2-car crashes, 
+# less the natural log of the factorial of each 2-car crash type's count. This doesn't depend on the parameters, so it only needs to be 
+# calculated once per model rather than on every likelihood evaluation
+def _ll_lp_const(A_2):
+    return (lnfactorial(A_2.sum(axis=2)) - lnfactorial(A_2).sum(axis=2)).sum(axis=1)
 
 # create a new LP model class that inherits from GenericLikelihoodModel
 class Lp(GenericLikelihoodModel):
@@ -264,27 +587,244 @@ class Lp(GenericLikelihoodModel):
         if exog is None:
             exog = numpy.zeros((numpy.size(endog,axis=0),2*(num_driver_types-1))) # LP doesn't have exogenous variables
         super(Lp, self).__init__(endog, exog, num_driver_types=num_driver_types, pairwise=pairwise, extra_params_names=extra_params_names, **kwds)
+        # gather single- and two-car crashes into the layout used by the likelihood kernel, and calculate the parameter-independent 
+        # part of the likelihood, once for the model rather than on every likelihood evaluation
+        A = numpy.asarray(self.endog,dtype=float)
+        self.types, one_car_cols, two_car_cols = _lp_index_maps(self.num_driver_types, self.pairwise)
+        self.A_1 = A[:,one_car_cols]
+        self.A_2 = A[:,two_car_cols]
+        self.ll_const = _ll_lp_const(self.A_2)
+        self.param_map = _lp_param_map(self.types, self.num_driver_types)
         
     def nloglikeobs(self, params):
         thet = params[:(self.num_driver_types-1)]
         lamb = params[(self.num_driver_types-1):]
-        return -_ll_lp(self.endog, self.num_driver_types, self.pairwise, thet, lamb)
+        return -(_ll_lp_kernel(self.A_1, self.A_2, self.types, thet, lamb) + self.ll_const)
+    
+    # analytic derivatives of the log-likelihood, so that the optimizer doesn't need to approximate them numerically
+    def score_obs(self, params):
+        thet = params[:(self.num_driver_types-1)]
+        lamb = params[(self.num_driver_types-1):]
+        return _score_obs_lp_kernel(self.A_1, self.A_2, self.types, self.param_map, thet, lamb)
     
-    def fit(self, start_params=None, maxiter=10000, maxfun=5000, **kwds):
+    def score(self, params):
+        return self.score_obs(params).sum(axis=0)
+    
+    def hessian(self, params):
+        thet = params[:(self.num_driver_types-1)]
+        lamb = params[(self.num_driver_types-1):]
+        return _hessian_lp_kernel(self.A_1, self.A_2, self.types, self.param_map, thet, lamb)
+    
+    # with the gradient methods ('bfgs' and 'newton'), the model is first fit in log parameters (see fit_lp), because from the default 
+    # start_params the optimizers diverge or stall on the raw parameters, and the statsmodels optimizer then only confirms the optimum 
+    # on the raw parameters, so that the results (and their covariance) refer to theta and lambda
+    def fit(self, start_params=None, method='nm', maxiter=10000, maxfun=5000, **kwds):
         self.exog_names.remove('const')
         for xn in range(1,(2*(self.num_driver_types-1))):
             self.exog_names.remove('x'+str(xn))
         
-        return super(Lp, self).fit(start_params=start_params, maxiter=maxiter, maxfun=maxfun, **kwds)
+        if (method in ['bfgs','newton']) and (start_params is not None):
+            start_params = fit_lp(self.endog, self.num_driver_types, self.pairwise, start_params, method, maxiter)[0]
+        return super(Lp, self).fit(start_params=start_params, method=method, maxiter=maxiter, maxfun=maxfun, **kwds)
         # return super(Lp, self).fit(maxiter=maxiter, maxfun=maxfun, **kwds)
 
-# calculates the natural log of the factorial of n (had to build this by hand because I couldn't find an existing python function)
+# the optimization methods supported by fit_lp
+fit_lp_methods = ['nm','bfgs','newton']
+
+# fits the LP model to A (accident counts, as in Lp) directly with scipy's optimizer, without constructing an Lp model and its results, 
+# and returns the parameters, the log-likelihood, the residual degrees of freedom and whether the optimizer converged. The optimizer is run as in Lp.fit (minimizing 
+# the negative log-likelihood per row), so the estimates are the same. The gradient methods optimize over the logs of the parameters, 
+# with the analytic derivatives transformed by the chain rule, which keeps the parameters positive and the likelihood much closer 
+# to quadratic: 'bfgs' with scipy's BFGS and 'newton' with scipy's trust-region Newton method ('trust-exact'), whose steps are 
+# bounded, unlike those of the statsmodels Newton optimizer. Lp remains the model to use for inference and summaries; this is for 
+# fitting many bootstrap replicates
+def fit_lp(A, num_driver_types, pairwise, start_params, method='nm', maxiter=10000, maxfun=5000):
+    A = numpy.asarray(A,dtype=float)
+    types, one_car_cols, two_car_cols = _lp_index_maps(num_driver_types, pairwise)
+    A_1 = A[:,one_car_cols]
+    A_2 = A[:,two_car_cols]
+    ll_const = _ll_lp_const(A_2)
+    param_map = _lp_param_map(types, num_driver_types)
+    nobs = numpy.size(A,axis=0)
+    num_thet = num_driver_types-1
+    
+    def loglike(params):
+        return (_ll_lp_kernel(A_1, A_2, types, params[:num_thet], params[num_thet:]) + ll_const).sum(0)
+    def f(params):
+        return -loglike(params)/nobs
+    def score(params):
+        return -_score_obs_lp_kernel(A_1, A_2, types, param_map, params[:num_thet], params[num_thet:]).sum(axis=0)/nobs
+    def hessian(params):
+        return -_hessian_lp_kernel(A_1, A_2, types, param_map, params[:num_thet], params[num_thet:])/nobs
+    # f and its derivatives in the logs of the parameters, log_params
+    def f_log(log_params):
+        with numpy.errstate(all='ignore'): # trial steps can overflow, which the optimizers handle
+            return f(numpy.exp(log_params))
+    def score_log(log_params):
+        params = numpy.exp(log_params)
+        return score(params)*params
+    def hessian_log(log_params):
+        params = numpy.exp(log_params)
+        return hessian(params)*numpy.outer(params,params) + numpy.diag(score(params)*params)
+    
+    if method == 'nm':
+        params, fopt, niter, fcalls, warnflag = scipy.optimize.fmin(f, start_params, xtol=0.0001, ftol=0.0001, maxiter=maxiter, maxfun=maxfun, 
+                                                                    full_output=True, disp=False)
+    elif method == 'bfgs':
+        log_params, fopt, gopt, Hinv, fcalls, gcalls, warnflag = scipy.optimize.fmin_bfgs(f_log, numpy.log(start_params), score_log, gtol=1e-05, 
+                                                                                          norm=numpy.inf, maxiter=maxiter, full_output=True, disp=False)
+        params = numpy.exp(log_params)
+    elif method == 'newton':
+        res = scipy.optimize.minimize(f_log, numpy.log(start_params), method='trust-exact', jac=score_log, hess=hessian_log, 
+                                      options={'gtol':1e-05, 'maxiter':maxiter})
+        params, warnflag = numpy.exp(res.x), (not res.success)
+    else:
+        raise ValueError('Method ' + str(method) + ' is not supported by fit_lp; use one of ' + str(fit_lp_methods) + '.')
+    if warnflag:
+        warnings.warn('Maximum Likelihood optimization failed to converge.', ConvergenceWarning)
+    
+    return params, loglike(params), float(nobs - 2*num_thet), not warnflag
+
+# fits the LP model to each of a list of accident count matrices As (e.g. bootstrap replicates, which may differ in their number of 
+# rows) at once, and returns the parameters (replicates x parameters), log-likelihoods, residual degrees of freedom and whether each 
+# replicate converged. The matrices are stacked into a (replicates x num_rows x columns) tensor, padded with rows that get no weight 
+# (num_rows is by default the largest number of rows; give a fixed num_rows so that each replicate's estimates don't depend on the 
+# replicates it is fit with), and a Newton iteration with analytic derivatives is run on the replicates that haven't yet converged. 
+# At most batch_size replicates are stacked at once, so that memory doesn't grow with the number of replicates, and the sums over rows 
+# are taken one replicate at a time, so that estimates don't depend on how replicates are batched (or split across worker processes). 
+# The Hessian's eigenvalues are made negative, so that each step increases the log-likelihood, and steps are halved until it does. 
+# Each step changes each parameter by at most max_rel_step (relative), which keeps the parameters positive and the iteration near 
+# start_params. Replicates whose log-likelihood can't be calculated at start_params get nan parameters.
+# With two driver types (or pairwise estimation), the estimates agree with those of 'nm' (fit_lp or Lp.fit) up to the looser 
+# tolerance of 'nm', other than replicates where the likelihood has mirror maxima of the same value (theta and 1/theta) and the 
+# two optimizers settle on different ones. With more driver types in full estimation, the likelihood has more maxima, and the 
+# iteration can settle on a different one than 'nm' or on a lower local maximum, so that bootstrapped standard errors differ
+def fit_lp_batch(As, num_driver_types, pairwise, start_params, tol=1e-08, ftol=1e-12, maxiter=100, max_halvings=50, max_rel_step=0.5, num_rows=None, batch_size=20):
+    num_reps = len(As)
+    nobs = numpy.array([numpy.size(A,axis=0) for A in As])
+    max_rows = nobs.max() if num_rows is None else num_rows
+    if num_reps > batch_size:
+        fits = [fit_lp_batch(As[b:(b+batch_size)], num_driver_types, pairwise, start_params, tol, ftol, maxiter, max_halvings, max_rel_step, max_rows, batch_size) 
+                for b in range(0,num_reps,batch_size)]
+        return tuple(numpy.concatenate(fit) for fit in zip(*fits))
+    types, one_car_cols, two_car_cols = _lp_index_maps(num_driver_types, pairwise)
+    param_map = _lp_param_map(types, num_driver_types)
+    num_thet = num_driver_types-1
+    num_comp_types = numpy.size(types,axis=1)
+    iu = numpy.triu_indices(num_comp_types)
+    E = (iu[0]==numpy.arange(num_comp_types)[:,numpy.newaxis]).astype(float) + (iu[1]==numpy.arange(num_comp_types)[:,numpy.newaxis])
+    
+    # the log-likelihood of a replicate, as calculated by fit_lp
+    def loglike(A, params):
+        A = numpy.asarray(A,dtype=float)
+        return (_ll_lp_kernel(A[:,one_car_cols], A[:,two_car_cols], types, params[:num_thet], params[num_thet:]) + _ll_lp_const(A[:,two_car_cols])).sum(0)
+    
+    # the terms that don't depend on the parameters (see _lp_deriv_terms for notation). With ratio = A_1/A_1[:,:,:1], so that 
+    # N = ratio/lamb_1, u = sum(ratio*thet_1/lamb_1) and v = sum(ratio/lamb_1), the log-likelihood kernel is, up to a constant, 
+    # sum(S_2*log(thet_sum)) - sum(AE*log(lamb_1)) - sum(T*log(u*v)). S_2 (two-car crashes by type) and AE (two-car crash involvements 
+    # by driver type) are summed over each replicate's rows, so only u and v are calculated by row. The padding rows have no crashes
+    ratio = numpy.ones((num_reps,max_rows)+types.shape)
+    T = numpy.zeros((num_reps,max_rows,numpy.size(types,axis=0)))
+    S_2 = numpy.zeros((num_reps,)+numpy.shape(two_car_cols))
+    for r in range(0,num_reps):
+        A_r = numpy.asarray(As[r],dtype=float)
+        ratio[r,:nobs[r]] = A_r[:,one_car_cols]/A_r[:,one_car_cols[:,:1]]
+        T[r,:nobs[r]] = A_r[:,two_car_cols].sum(axis=2)
+        S_2[r] = A_r[:,two_car_cols].sum(axis=0)
+    AE = numpy.matmul(S_2,E.T)
+    
+    def objective(ratio, T, S_2, AE, params):
+        thet_1, lamb_1 = _lp_type_params(types, params[:,:num_thet], params[:,num_thet:])
+        u = (ratio*(thet_1/lamb_1)[:,numpy.newaxis]).sum(axis=3)
+        v = (ratio/lamb_1[:,numpy.newaxis]).sum(axis=3)
+        return ((S_2*numpy.log(thet_1[...,iu[0]]+thet_1[...,iu[1]])).sum(axis=(1,2)) - (AE*numpy.log(lamb_1)).sum(axis=(1,2)) 
+                - (T*numpy.log(u*v)).sum(axis=(1,2)))
+    
+    # the gradient and Hessian of the objective. The rows enter through the sums G_u and G_v (of T*ratio/u and T*ratio/v) and H_u 
+    # and H_v (of T*ratio*ratio'/u**2 and T*ratio*ratio'/v**2), and the derivatives with respect to the parameters of each component's 
+    # driver types (thet_1 then lamb_1, as in _lp_param_map) follow from u and v being linear in thet_1/lamb_1 and 1/lamb_1
+    def derivatives(ratio, T, S_2, AE, params):
+        thet_1, lamb_1 = _lp_type_params(types, params[:,:num_thet], params[:,num_thet:])
+        u = (ratio*(thet_1/lamb_1)[:,numpy.newaxis]).sum(axis=3)
+        v = (ratio/lamb_1[:,numpy.newaxis]).sum(axis=3)
+        G_u = ((T/u)[...,numpy.newaxis]*ratio).sum(axis=1)
+        G_v = ((T/v)[...,numpy.newaxis]*ratio).sum(axis=1)
+        ratio_2 = ratio[...,:,numpy.newaxis]*ratio[...,numpy.newaxis,:]
+        H_u = ((T/u**2)[...,numpy.newaxis,numpy.newaxis]*ratio_2).sum(axis=1)
+        H_v = ((T/v**2)[...,numpy.newaxis,numpy.newaxis]*ratio_2).sum(axis=1)
+        thet_sum = thet_1[...,iu[0]]+thet_1[...,iu[1]]
+        inv_lamb = 1/lamb_1
+        a_lamb = thet_1*inv_lamb**2 # minus the derivative of thet_1/lamb_1 with respect to lamb_1
+        eye = numpy.eye(num_comp_types)
+        
+        grad_thet = numpy.matmul(S_2/thet_sum,E.T) - G_u*inv_lamb
+        grad_lamb = ((G_u*thet_1 + G_v)*inv_lamb - AE)*inv_lamb
+        hess_tt = H_u*inv_lamb[...,:,numpy.newaxis]*inv_lamb[...,numpy.newaxis,:] - numpy.einsum('rcx,lx,mx->rclm',S_2/thet_sum**2,E,E)
+        hess_tl = -H_u*inv_lamb[...,:,numpy.newaxis]*a_lamb[...,numpy.newaxis,:] + eye*(G_u*inv_lamb**2)[...,numpy.newaxis]
+        hess_ll = (H_u*a_lamb[...,:,numpy.newaxis]*a_lamb[...,numpy.newaxis,:] + H_v*(inv_lamb**2)[...,:,numpy.newaxis]*(inv_lamb**2)[...,numpy.newaxis,:] 
+                   + eye*((AE - 2*(G_u*thet_1 + G_v)*inv_lamb)*inv_lamb**2)[...,numpy.newaxis])
+        
+        grad = numpy.einsum('rcx,cxy->ry',numpy.concatenate((grad_thet,grad_lamb),axis=2),param_map)
+        hess = numpy.concatenate((numpy.concatenate((hess_tt,hess_tl),axis=3),
+                                  numpy.concatenate((numpy.swapaxes(hess_tl,2,3),hess_ll),axis=3)),axis=2)
+        return grad, numpy.einsum('cxy,rcxz,czw->ryw',param_map,hess,param_map)
+    
+    params = numpy.tile(numpy.asarray(start_params,dtype=float),(num_reps,1))
+    active = numpy.isfinite([loglike(As[r], params[r]) for r in range(0,num_reps)]) & (params > 0).all(axis=1)
+    params[~active] = numpy.nan
+    converged = numpy.zeros(num_reps,dtype=bool)
+    obj = numpy.full(num_reps,numpy.nan)
+    # the replicates being fit, and their terms; replicates that have finished are dropped from these, rather than copied from the 
+    # terms of all replicates on every step
+    work = numpy.arange(num_reps)
+    work_terms = (ratio, T, S_2, AE)
+    for it in range(0,maxiter):
+        if not active[work].all():
+            work_terms = tuple(term[active[work]] for term in work_terms)
+            work = work[active[work]]
+        if len(work) == 0:
+            break
+        if it == 0:
+            obj[work] = objective(*work_terms, params[work])
+        
+        # the Newton step, with the Hessian's eigenvalues made negative (and bounded away from zero) so that it is an ascent direction
+        grad, hess = derivatives(*work_terms, params[work])
+        evals, evecs = numpy.linalg.eigh(hess)
+        evals = numpy.maximum(numpy.abs(evals),numpy.finfo(float).eps*numpy.abs(evals).max(axis=1,keepdims=True))
+        step = numpy.einsum('rij,rj,rkj,rk->ri',evecs,1/evals,evecs,grad)
+        # converged when the step is within tol of the parameters, or its predicted increase in the log-likelihood is within ftol of 
+        # the log-likelihood, beyond which rounding in the sums over rows stops the iteration from making progress
+        small = ((numpy.abs(step) <= tol*(1+numpy.abs(params[work]))).all(axis=1) | ((grad*step).sum(axis=1) <= ftol*(1+numpy.abs(obj[work]))))
+        converged[work[small]] = True
+        active[work[small]] = False
+        
+        # limit each step's relative change in the parameters, then halve the steps of replicates whose log-likelihood doesn't 
+        # increase, until all of them do. Replicates that aren't pending stay where they are
+        step_size = numpy.minimum(1,max_rel_step/(numpy.abs(step)/numpy.abs(params[work])).max(axis=1))
+        pending = ~small
+        for h in range(0,max_halvings):
+            if not pending.any():
+                break
+            trial = params[work] + (step_size*pending)[:,numpy.newaxis]*step
+            with numpy.errstate(all='ignore'):
+                trial_obj = objective(*work_terms, trial)
+            accept = pending & (trial_obj >= obj[work])
+            params[work[accept]] = trial[accept]
+            obj[work[accept]] = trial_obj[accept]
+            pending = pending & ~accept
+            step_size[pending] /= 2
+        active[work[pending]] = False # the log-likelihood can't be increased along the step, so stop
+    
+    llf = numpy.array([loglike(As[r], params[r]) for r in range(0,num_reps)])
+    if not converged[numpy.isfinite(llf)].all():
+        warnings.warn('Maximum Likelihood optimization failed to converge for ' + str((~converged[numpy.isfinite(llf)]).sum()) + 
+                      ' of ' + str(num_reps) + ' replicates.', ConvergenceWarning)
+    
+    return params, llf, (nobs - 2*num_thet).astype(float), converged
+
+# calculates the natural log of the factorial of n, using the log-gamma function so that arrays of counts are handled in one call
 def lnfactorial(n):
-    n_calc = int(n)
-    lnf = 0
-    for i in range(1,n_calc+1):
-        lnf += numpy.log(i)
-    return lnf
+    return gammaln(numpy.floor(n)+1)
 
 # calculate boostrap standard error from bootstrap estimates
 def bs_se(theta_bs, axis=None):
@@ -5,8 +5,8 @@ Created on Tue May  7 14:29:49 2019
 @author: Nathan Tefft
 
 This script extracts data from the raw FARS data files to be used for replicating Levitt & Porter (2001). Selected variables are included, 
-and the data definitions are harmonized across years. Accident, vehicle, and person dataframes are constructed and stored in csv files 
-for later use in the replication.
+and the data definitions are harmonized across years. Accident, vehicle, and person dataframes are constructed and stored as year-partitioned 
+parquet files, with compact data types, for later use in the replication (see util.load_dataset).
 """
 
 # This script has been validated for FARS datasets from 1982 to 2017
@@ -20,7 +20,8 @@ latestYear = 2017
     # you may need to install some of these packages in the command line
         # for example, you may be able to install us with the command "pip install us"
 
-import os, numpy, pandas, shutil, us, zipfile
+import concurrent.futures, io, os, numpy, pandas, us, zipfile
+from replication import util
 
 """
    USER-DEFINED ATTRIBUTES 
@@ -50,59 +51,69 @@ import os, numpy, pandas, shutil, us, zipfile
 firstYear = 1982
 lastYear = 2017
 
+# number of worker processes used to extract years in parallel (1 extracts the years serially)
+extract_jobs = 4
 
-if firstYear>lastYear:
-    print('User selected lastYear earlier than firstYear. firstYear has been set to ' + str(earliestYear) + ' and lastYear has been set to ' + str(latestYear) +'.')
-    firstYear = earliestYear
-    lastYear = latestYear
-if firstYear < earliestYear:
-    print('User selected firstYear prior to ' + str(earliestYear) + '. firstYear has been set to ' + str(earliestYear) +'.')
-    firstYear = earliestYear
-if lastYear > latestYear:
-    print('User selected lastYear after ' + str(latestYear) + '. lastYear has been set to ' + str(latestYear) +'.')
-    lastYear = latestYear
+# version of the harmonization rules below; increment it whenever they change, so that every year is re-extracted on the next run
+harmonization_version = 1
+
+# the manifest records, for each extracted year, the source zip's hash and size, the harmonization version, and the output partitions. 
+# Years whose source zip and harmonization version match the manifest are not re-extracted
+manifest_file = os.path.join(util.DATA_FOLDER,'extract_manifest.json')
 
 # load US state abbreviations for later merge
 df_states = pandas.DataFrame.from_dict(us.states.mapping('fips', 'abbr'),orient='index',columns=['state_abbr'])
 df_states = df_states[df_states.index.notnull()]
 df_states.index = df_states.index.astype(int)
 
-# Initialize analytic dataframe for the accident, vehicle, and person datasets
-
-#fars_datasets = ['accident', 'vehicle', 'person', 'Miper']
-
 fars_datasets = ['accident', 'vehicle', 'person', 'Miper']
 dataset_ids = ['st_case','veh_no','per_no', 'per_no']
 
-df_list={}
-for dataset in fars_datasets:
-    df_list[dataset]=pandas.DataFrame()
-    
-# loop over years to be included in the replication analysis
-for yr in range(firstYear,lastYear+1): 
+# the retrieved FARS zip file for a year (see retrieve.local_file)
+def zip_file(yr):
+    return os.path.join('data','FARS' + str(yr) + '.zip')
+
+# the manifest entry for a year's extraction, given the current source zip
+def manifest_entry(yr):
+    return {'zip_sha256':util.file_sha256(zip_file(yr)), 'zip_size':os.path.getsize(zip_file(yr)), 'harmonization_version':harmonization_version, 
+            'partitions':{dfn:util.dataset_file(dfn,yr) for dfn in ['accident', 'vehicle', 'person']}}
+
+# whether a year's partitions are up to date, i.e. they exist and were extracted from the same source zip under the same harmonization rules
+def year_current(manifest, entry, yr):
+    return (manifest.get(str(yr)) == entry) and all(os.path.exists(f) for f in entry['partitions'].values())
+
+# find the member of a FARS zip file holding a dataset, matching the file name case-insensitively since it varies across years
+def zip_member(zf, dataset):
+    for name in zf.namelist():
+        if os.path.basename(name).lower() == dataset.lower() + '.csv':
+            return name
+    raise KeyError('No ' + dataset + '.csv in ' + str(zf.filename))
+
+# read a dataset directly from a FARS zip file, without extracting it to disk
+def read_zip_csv(zf, dataset):
+    # UTF-8 encoding errors are ignored because they don't impact the relevant variables
+    with io.TextIOWrapper(zf.open(zip_member(zf, dataset)), errors='ignore') as file:
+        return pandas.read_csv(file,low_memory=False)
+
+# extract and harmonize the accident, vehicle, and person dataframes for one year
+def extract_year(yr):
     print('Extracting data from ' + str(yr) + '.' )
     
-    # extract accident, vehicle, person, and multiple imputation files
-    zipfile.ZipFile('data\\FARS' + str(yr) + '.zip', 'r').extractall(path='data\\extracted')
-    # UTF-8 encoding errors are ignored because they don't impact the relevant variables
-        
+    # read accident, vehicle, person, and multiple imputation files
     df_list_yr={}
     index_list=['year']
-    for (dataset, id) in zip(fars_datasets,dataset_ids):
-        file = open('data\\extracted\\' + dataset + '.csv', errors='ignore')
-        df_list_yr[dataset]=pandas.read_csv(file,low_memory=False)
-        file.close()
-    
-        df_list_yr[dataset].columns = df_list_yr[dataset].columns.str.lower() # make all columns lowercase
-        df_list_yr[dataset]['year']=numpy.full(len(df_list_yr[dataset].index), yr) # standardize the year variable to 4 digits
+    with zipfile.ZipFile(zip_file(yr), 'r') as zf:
+        for (dataset, id) in zip(fars_datasets,dataset_ids):
+            df_list_yr[dataset]=read_zip_csv(zf, dataset)
         
-        if not dataset == 'Miper':
-            index_list.append(id)
-        df_list_yr[dataset][index_list] = df_list_yr[dataset][index_list].astype('int') # set the indices as integers
-        df_list_yr[dataset].set_index(index_list, inplace=True) # set the multiindex
-        df_list_yr[dataset].index.set_names(index_list, inplace=True)  
-
-    shutil.rmtree(path='data\\extracted') # clean up temporary extractions folder
+            df_list_yr[dataset].columns = df_list_yr[dataset].columns.str.lower() # make all columns lowercase
+            df_list_yr[dataset]['year']=numpy.full(len(df_list_yr[dataset].index), yr) # standardize the year variable to 4 digits
+            
+            if not dataset == 'Miper':
+                index_list.append(id)
+            df_list_yr[dataset][index_list] = df_list_yr[dataset][index_list].astype('int') # set the indices as integers
+            df_list_yr[dataset].set_index(index_list, inplace=True) # set the multiindex
+            df_list_yr[dataset].index.set_names(index_list, inplace=True)  
     
     # Manipulating accident data
     df_list_yr['accident'].loc[df_list_yr['accident'].hour==99, 'hour'] = numpy.nan
@@ -111,10 +122,9 @@ for yr in range(firstYear,lastYear+1):
     df_list_yr['accident']['quarter'] = numpy.ceil(df_list_yr['accident']['month']/3) # create quarter variable
     df_list_yr['accident'] = df_list_yr['accident'].merge(df_states,how='left',left_on='state',right_index=True) # merge in state abbreviations
 
-    # keep relevant accident variables and append to accident dataframe
+    # keep relevant accident variables
     df_list_yr['accident'] = df_list_yr['accident'][['state','state_abbr','quarter','day_week','hour','persons']]
     print('Count of crashes: ' + str(len(df_list_yr['accident'])))
-    df_list['accident'] = df_list['accident'].append(df_list_yr['accident'])
     
     # Manipulating vehicle data
     if yr <= 2008: 
@@ -128,10 +138,9 @@ for yr in range(firstYear,lastYear+1):
     for vt in ['acc','sus','dwi','spd','oth']:
         df_list_yr['vehicle'].loc[df_list_yr['vehicle']['prev_' + vt] > 97, 'prev_' + vt] = numpy.nan # previous violations
 
-    # keep relevant vehicle variables and append to vehicle dataframe
+    # keep relevant vehicle variables
     df_list_yr['vehicle'] = df_list_yr['vehicle'][['prev_acc','prev_sus','prev_dwi','prev_spd','prev_oth','dr_drink','occupants']]
     print('Count of vehicles: ' + str(len(df_list_yr['vehicle'])))
-    df_list['vehicle'] = df_list['vehicle'].append(df_list_yr['vehicle'])
     
     # Manipulating person variables
     
@@ -165,19 +174,53 @@ for yr in range(firstYear,lastYear+1):
     df_list_yr['Miper'] = df_list_yr['Miper'].rename(columns={'p1':'mibac1','p2':'mibac2','p3':'mibac3','p4':'mibac4','p5':'mibac5','p6':'mibac6','p7':'mibac7','p8':'mibac8','p9':'mibac9','p10':'mibac10'}) # rename bac columns    
     df_list_yr['person'] = df_list_yr['person'].merge(df_list_yr['Miper'],how='left',on=['year','st_case','veh_no','per_no']) # merge multiply imputed bac values into person dataframe
     
-    # keep relevant person variables and append to person dataframe
+    # keep relevant person variables
     df_list_yr['person'] = df_list_yr['person'][['seat_pos','drinking','alc_det','atst_typ','alcohol_test_result','race','age','age_lt15','sex','mibac1','mibac2','mibac3','mibac4','mibac5','mibac6','mibac7','mibac8','mibac9','mibac10']]
     print('Count of persons: ' + str(len(df_list_yr['person'])))
-    df_list['person'] = df_list['person'].append(df_list_yr['person'])
-    
-# summarize the constructed dataframes and save to csv files
-if not os.path.exists('replication\\data'):
-    os.makedirs('replication\\data')
-for dfn in ['accident', 'vehicle', 'person']:
-    print('Describing dataframe ' + dfn)
-    print(df_list[dfn].describe())
-    df_list[dfn].to_csv('replication\\data\\df_' + dfn + '.csv')
-
-# Delete dictionaries so garbage collector releases memory from dataframes
-df_list.clear()
-df_list_yr.clear()
\ No newline at end of file
+    return (df_list_yr['accident'], df_list_yr['vehicle'], df_list_yr['person'])
+
+# save an extracted year of the constructed dataframes to its own parquet files, with compact data types, and record it in the manifest
+def save_year(yr, df_yr, manifest, entry):
+    for (dfi, dfn) in enumerate(['accident', 'vehicle', 'person']):
+        yr_file = util.dataset_file(dfn,yr)
+        if not os.path.exists(os.path.dirname(yr_file)):
+            os.makedirs(os.path.dirname(yr_file))
+        df_yr[dfi].reset_index().astype(util.dataset_dtypes[dfn]).to_parquet(yr_file,index=False)
+    manifest[str(yr)] = entry
+    util.write_manifest(manifest,manifest_file)
+
+if __name__ == '__main__':
+    if firstYear>lastYear:
+        print('User selected lastYear earlier than firstYear. firstYear has been set to ' + str(earliestYear) + ' and lastYear has been set to ' + str(latestYear) +'.')
+        firstYear = earliestYear
+        lastYear = latestYear
+    if firstYear < earliestYear:
+        print('User selected firstYear prior to ' + str(earliestYear) + '. firstYear has been set to ' + str(earliestYear) +'.')
+        firstYear = earliestYear
+    if lastYear > latestYear:
+        print('User selected lastYear after ' + str(latestYear) + '. lastYear has been set to ' + str(latestYear) +'.')
+        lastYear = latestYear
+    
+    # only extract the years that are new or whose source zip or harmonization rules have changed since the last run
+    years = list(range(firstYear,lastYear+1))
+    manifest = util.read_manifest(manifest_file)
+    entries = {yr:manifest_entry(yr) for yr in years}
+    years_extract = [yr for yr in years if not year_current(manifest, entries[yr], yr)]
+    print('Extracting ' + str(len(years_extract)) + ' of ' + str(len(years)) + ' years; the others are up to date.')
+    
+    # extract the years in parallel, saving each year as soon as it is extracted, so that only the years in progress are held in memory. 
+    # Each year is saved to its own partitions, so they do not depend on the number of workers or the order in which the years finish
+    if extract_jobs > 1 and len(years_extract) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(extract_jobs,len(years_extract))) as executor:
+            future_years = {executor.submit(extract_year, yr):yr for yr in years_extract}
+            for future in concurrent.futures.as_completed(future_years):
+                yr = future_years.pop(future) # release the year's dataframes once saved
+                save_year(yr, future.result(), manifest, entries[yr])
+    else:
+        for yr in years_extract:
+            save_year(yr, extract_year(yr), manifest, entries[yr])
+    
+    # summarize the combined dataframes
+    for dfn in ['accident', 'vehicle', 'person']:
+        print('Describing dataframe ' + dfn)
+        print(util.load_dataset(dfn,(firstYear,lastYear)).describe())
@@ -23,13 +23,13 @@ import os, pandas
 import estimate
 from replication import util
 
-# read in previously extracted and stored dataframes
-df_accident = pandas.read_csv('replication\\data\\df_accident.csv')
-df_accident.set_index(['year','st_case'],inplace=True) # set the index
-df_vehicle = pandas.read_csv('replication\\data\\df_vehicle.csv')
-df_vehicle.set_index(['year','st_case','veh_no'],inplace=True) # set the index
-df_person = pandas.read_csv('replication\\data\\df_person.csv')
-df_person.set_index(['year','st_case','veh_no','per_no'],inplace=True) # set the index
+# read in previously extracted and stored dataframes, only for the years used in the replication. The dataframes are held in compact 
+# form, and each analytic sample expands only the years it uses
+data_years = [1983,1993]
+df_accident = util.load_dataset('accident',data_years,compact=True)
+df_vehicle = util.load_dataset('vehicle',data_years,compact=True)
+df_person = util.load_dataset('person',data_years,compact=True)
+data_fp = util.data_fingerprint(df_accident,df_vehicle,df_person) # for caching analytic samples built from these data
 
 # set estimation parameters
 # bsreps = 2 # bootstrap replicates for testing
@@ -46,13 +46,18 @@ if not os.path.exists(results_folder):
         os.makedirs(results_folder) # generate results directory, if it doesn't exist
 
 # TABLE 1
+# counts of all accidents, vehicles, and drivers, and the proportion of all drivers lacking a police evaluation, refer to all of the 
+# extracted years, so they are summarized from each year's extracted data rather than from the loaded years
+all_data_summary = util.summarize_all_data()
 # Data for Table 1: Outline of LP Replication Exercise 
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'police_report_only',
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=True)
+analytic_sample, sample_summary = util.summarize_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,
+                    'police_report_only',bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False)
+util.print_sample_summary(util.update_all_data_summary(sample_summary,all_data_summary))
 # Data for item 9 of Table 1: Outline of LP Replication Exercise  
 # (definition 5 (supplemental analysis) so need only look at the section "FOR BOTTOM HALF OF TABLE 1" )
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'impaired_vs_sober',
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=True)
+analytic_sample, sample_summary = util.summarize_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,
+                    'impaired_vs_sober',bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False)
+util.print_sample_summary(util.update_all_data_summary(sample_summary,all_data_summary))
 
 # TABLE 2
 # Data for Table 2: Distribution of police officer judgement of alcohol involvement and BAC test results (see section "Cross-tab for Table 2")
@@ -75,19 +80,21 @@ analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[198
                     bac_threshold=0.10,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=True)
 
 # TABLE 6, PANEL 1
+# build the samples for drinking definitions 1 through 4 together (these are also used for Appendix Table 1)
+analytic_samples = util.get_analytic_samples_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,
+                        [(drink_def,0) for drink_def in drink_defs],state_year_prop_threshold=sy_p_t,mireps=False,fingerprint=data_fp)
 res_fmt = list() # list of results, formatted
 for drink_def in drink_defs: 
     print("Estimating model for drinking definition: " + drink_def) 
-    analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,drink_def,
-                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+    analytic_sample = analytic_samples[(drink_def,0)]
     mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps)
     res_fmt.append([drink_def,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                  round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
                  round(mod_res[0][3][0],3),'('+str(format(round(mod_res[1][3][0],3),'.3f'))+')',
                  round(model_df_resid+2)])
 print("Estimating multiple imputation model:") 
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
-                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False)
+analytic_sample = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
+                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,fingerprint=data_fp)
 mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
 res_fmt.append(['multiple_imputation',round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                  round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -99,8 +106,8 @@ res_fmt_df.T.to_excel(results_folder + '\\table6_panel1.xlsx') # Note: should fo
 # TABLE 6, PANEL 2
 res_fmt = list() # list of results, formatted
 print("Estimating model for drinking definition: any_evidence") 
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'impaired_vs_sober',
-                    bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+analytic_sample = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'impaired_vs_sober',
+                    bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False,fingerprint=data_fp)
 as_ivs = analytic_sample # for use below
 mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps)
 res_fmt.append(['impaired_vs_sober',round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
@@ -108,13 +115,13 @@ res_fmt.append(['impaired_vs_sober',round(mod_res[0][0][0],2),'('+str(round(mod_
              round(mod_res[0][3][0],3),'('+str(format(round(mod_res[1][3][0],3),'.3f'))+')',
              round(model_df_resid+2)])
 print("Estimating multiple imputation model using impaired_vs_sober sample:") 
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
-                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False)
+analytic_sample = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
+                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,fingerprint=data_fp)
 analytic_sample = analytic_sample[analytic_sample.index.isin(as_ivs.index)]
 mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
 # need to estimate separate model, not dropping the legal drinkers, for unbiased estimate of prevalence
-analytic_sample_p = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
-                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,drop_below_threshold=False)
+analytic_sample_p = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
+                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,drop_below_threshold=False,fingerprint=data_fp)
 analytic_sample = analytic_sample[analytic_sample.index.isin(as_ivs.index)]
 mod_res_p,model_llf_p,model_df_resid_p = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
 res_fmt.append(['multiple_imputation',round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
@@ -122,12 +129,12 @@ res_fmt.append(['multiple_imputation',round(mod_res[0][0][0],2),'('+str(round(mo
                  round(mod_res_p[0][3][0],3),'('+str(format(round(mod_res_p[1][3][0],3),'.3f'))+')',
                  round(model_df_resid+2)])
 print("Estimating full multiple imputation model:") 
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
-                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False)
+analytic_sample = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
+                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,fingerprint=data_fp)
 mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
 # need to estimate separate model, not dropping the legal drinkers, for unbiased estimate of prevalence
-analytic_sample_p = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
-                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,drop_below_threshold=False)
+analytic_sample_p = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_only',
+                        bac_threshold=0.1,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,drop_below_threshold=False,fingerprint=data_fp)
 mod_res_p,model_llf_p,model_df_resid_p = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
 res_fmt.append(['multiple_imputation',round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                   round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -140,11 +147,11 @@ res_fmt_df.T.to_excel(results_folder + '\\table6_panel2.xlsx') # Note: should fo
 equal_mixings = [['all'],['hour'],['year','hour'],['year','weekend','hour'],['year','state','hour'],['year','state','weekend','hour']]
 for drink_def in drink_defs:     
     res_fmt = list() # list of results, formatted
-    analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,drink_def,
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+    analytic_sample = analytic_samples[(drink_def,0)]
+    crash_cells = estimate.get_crash_cells(analytic_sample,equal_mixings[-1],driver_types) # encoded once, at the finest equal mixing
     for eq_mix in equal_mixings: 
         print("Estimating model for drinking definition: " + drink_def) 
-        mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,eq_mix,driver_types,bsreps=bsreps)
+        mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,eq_mix,driver_types,bsreps=bsreps,crash_cells=crash_cells)
         res_fmt.append([eq_mix,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                      round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
                      round(mod_res[0][3][0],3),'('+str(format(round(mod_res[1][3][0],3),'.3f'))+')',
@@ -152,11 +159,12 @@ for drink_def in drink_defs:
     res_fmt_df = pandas.DataFrame(res_fmt,columns=['drink_def','theta','theta_se','lambda','lambda_se','proportion','proportion_se','total_dof'])
     res_fmt_df.T.to_excel(results_folder + '\\tableA1_panel_' + drink_def + '.xlsx') # Note: should format as text after opening Excel file    
 res_fmt = list() # list of results, formatted
-analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_primary',
-                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False)
+analytic_sample = util.get_analytic_sample_cached(df_accident,df_vehicle,df_person,[1983,1993],[20,4],driver_types,'bac_test_primary',
+                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False,fingerprint=data_fp)
+crash_cells = estimate.get_crash_cells(analytic_sample,equal_mixings[-1],driver_types,list(range(1,mireps+1)))
 for eq_mix in equal_mixings: 
     print("Estimating multiple imputation model:")     
-    mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,eq_mix,driver_types,bsreps=bsreps,mireps=mireps)
+    mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,eq_mix,driver_types,bsreps=bsreps,mireps=mireps,crash_cells=crash_cells)
     res_fmt.append([eq_mix,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                      round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
                      round(mod_res[0][3][0],3),'('+str(format(round(mod_res[1][3][0],3),'.3f'))+')',
@@ -165,12 +173,17 @@ res_fmt_df = pandas.DataFrame(res_fmt,columns=['drink_def','theta','theta_se','l
 res_fmt_df.T.to_excel(results_folder + '\\tableA1_panel_multiple_imputation.xlsx') # Note: should format as text after opening Excel file
 
 # APPENDIX FIGURE 1
+# build the samples for each year and for each hour, for drinking definitions 1 through 4 together (these are also used for Appendix 
+# Figures 3 and 4)
+year_ranges = [((yr,yr),(20,4)) for yr in range(1983,1994)]
+hour_ranges = [((1983,1993),(earliest_hour_raw % 24,earliest_hour_raw % 24)) for earliest_hour_raw in range(20,29)]
+year_samples = util.get_analytic_sample_sweep_cached(df_accident,df_vehicle,df_person,year_ranges,driver_types,
+                        [(drink_def,0) for drink_def in drink_defs],state_year_prop_threshold=sy_p_t,mireps=False,fingerprint=data_fp)
 for drink_def in drink_defs: 
     res_fmt = list() # list of results, formatted
     for yr in range(1983,1994): 
         print("Estimating model for drinking definition " + drink_def + " in year " + str(yr)) 
-        analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[yr,yr],[20,4],driver_types,drink_def,
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+        analytic_sample = year_samples[((yr,yr),(20,4))][(drink_def,0)]
         mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps)
         res_fmt.append([yr,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                      round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -180,6 +193,8 @@ for drink_def in drink_defs:
     res_fmt_df.T.to_excel(results_folder + '\\figureA1_' + drink_def + '.xlsx') # Note: should format as text after opening Excel file    
 
 # APPENDIX FIGURE 2
+hour_samples = util.get_analytic_sample_sweep_cached(df_accident,df_vehicle,df_person,hour_ranges,driver_types,
+                        [(drink_def,0) for drink_def in drink_defs],state_year_prop_threshold=sy_p_t,mireps=False,fingerprint=data_fp)
 for drink_def in drink_defs: 
     res_fmt = list() # list of results, formatted
     for earliest_hour_raw in range(20,29): 
@@ -188,8 +203,7 @@ for drink_def in drink_defs:
         else:
             earliest_hour = earliest_hour_raw
         print("Estimating model for drinking definition " + drink_def + " in hour " + str(earliest_hour)) 
-        analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[earliest_hour,earliest_hour],driver_types,drink_def,
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+        analytic_sample = hour_samples[((1983,1993),(earliest_hour,earliest_hour))][(drink_def,0)]
         mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps)
         res_fmt.append([earliest_hour,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                      round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -203,8 +217,7 @@ drink_def = 'police_report_primary'
 res_fmt = list() # list of results, formatted
 for yr in range(1983,1994): 
     print("Estimating model for drinking definition " + drink_def + " in year " + str(yr)) 
-    analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[yr,yr],[20,4],driver_types,drink_def,
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+    analytic_sample = year_samples[((yr,yr),(20,4))][(drink_def,0)]
     mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps)
     res_fmt.append([yr,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                  round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -213,10 +226,11 @@ for yr in range(1983,1994):
 res_fmt_df = pandas.DataFrame(res_fmt,columns=['drink_def','theta','theta_se','lambda','lambda_se','proportion','proportion_se','total_dof'])
 res_fmt_df.T.to_excel(results_folder + '\\figureA3_' + drink_def + '.xlsx') # Note: should format as text after opening Excel file   
 res_fmt = list() # list of results, formatted
+year_samples = util.get_analytic_sample_sweep_cached(df_accident,df_vehicle,df_person,year_ranges,driver_types,
+                        [('bac_test_primary',0)],state_year_prop_threshold=sy_p_t,mireps=mireps,fingerprint=data_fp)
 for yr in range(1983,1994): 
     print("Estimating multiple imputation model in year " + str(yr)) 
-    analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[yr,yr],[20,4],driver_types,'bac_test_primary',
-                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False)
+    analytic_sample = year_samples[((yr,yr),(20,4))][('bac_test_primary',0)]
     mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
     res_fmt.append([yr,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                      round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -234,8 +248,7 @@ for earliest_hour_raw in range(20,29):
     else:
         earliest_hour = earliest_hour_raw    
     print("Estimating model for drinking definition " + drink_def + " in hour " + str(earliest_hour)) 
-    analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[earliest_hour,earliest_hour],driver_types,drink_def,
-                    bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=False,summarize_sample=False)
+    analytic_sample = hour_samples[((1983,1993),(earliest_hour,earliest_hour))][(drink_def,0)]
     mod_res,model_llf,model_df_resid = estimate.fit_model(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps)
     res_fmt.append([earliest_hour,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                  round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -244,14 +257,15 @@ for earliest_hour_raw in range(20,29):
 res_fmt_df = pandas.DataFrame(res_fmt,columns=['drink_def','theta','theta_se','lambda','lambda_se','proportion','proportion_se','total_dof'])
 res_fmt_df.T.to_excel(results_folder + '\\figureA4_' + drink_def + '.xlsx') # Note: should format as text after opening Excel file   
 res_fmt = list() # list of results, formatted
+hour_samples = util.get_analytic_sample_sweep_cached(df_accident,df_vehicle,df_person,hour_ranges,driver_types,
+                        [('bac_test_primary',0)],state_year_prop_threshold=sy_p_t,mireps=mireps,fingerprint=data_fp)
 for earliest_hour_raw in range(20,29): 
     if earliest_hour_raw > 23:
         earliest_hour = earliest_hour_raw - 24
     else:
         earliest_hour = earliest_hour_raw    
     print("Estimating multiple imputation model in hour " + str(earliest_hour)) 
-    analytic_sample = util.get_analytic_sample(df_accident,df_vehicle,df_person,[1983,1993],[earliest_hour,earliest_hour],driver_types,'bac_test_primary',
-                        bac_threshold=0,state_year_prop_threshold=sy_p_t,mireps=mireps,summarize_sample=False)
+    analytic_sample = hour_samples[((1983,1993),(earliest_hour,earliest_hour))][('bac_test_primary',0)]
     mod_res,model_llf,model_df_resid = estimate.fit_model_mi(analytic_sample,['year','state','weekend','hour'],driver_types,bsreps=bsreps,mireps=mireps)
     res_fmt.append([earliest_hour,round(mod_res[0][0][0],2),'('+str(round(mod_res[1][0][0],2))+')',
                      round(mod_res[0][1][0],2),'('+str(round(mod_res[1][1][0],2))+')',
@@ -7,7 +7,181 @@ Created on Fri May 10 11:41:35 2019
 This is a collection of utility functions that are to be used for the Levitt and Porter (2001) replication.
 """
 # import necessary packages
-import numpy,pandas,time
+import collections,hashlib,json,numpy,os,pandas,time,weakref
+
+# EXTRACTED DATASETS
+# extract.py stores the accident, vehicle, and person datasets as year-partitioned parquet files, as df_[dataset]/[year].parquet in 
+# data_folder (by default DATA_FOLDER), with the following indices and compact column data types. Missing values are kept as NaN, so 
+# variables that can be missing are floats
+DATA_FOLDER = os.path.join('replication','data')
+dataset_index = {'accident':['year','st_case'],
+                 'vehicle':['year','st_case','veh_no'],
+                 'person':['year','st_case','veh_no','per_no']}
+dataset_dtypes = {'accident':{'year':'int16','st_case':'int32','state':'int8','state_abbr':'category','quarter':'float32',
+                              'day_week':'float32','hour':'float32','persons':'int16'},
+                  'vehicle':{'year':'int16','st_case':'int32','veh_no':'int16','prev_acc':'float32','prev_sus':'float32',
+                             'prev_dwi':'float32','prev_spd':'float32','prev_oth':'float32','dr_drink':'float32','occupants':'float32'},
+                  'person':{'year':'int16','st_case':'int32','veh_no':'int16','per_no':'int16','seat_pos':'float32','drinking':'float32',
+                            'alc_det':'float32','atst_typ':'float32','alcohol_test_result':'float32','race':'float32','age':'float32',
+                            'age_lt15':'bool','sex':'float32','mibac1':'float32','mibac2':'float32','mibac3':'float32','mibac4':'float32',
+                            'mibac5':'float32','mibac6':'float32','mibac7':'float32','mibac8':'float32','mibac9':'float32','mibac10':'float32'}}
+
+# the file storing a year of an extracted dataset
+def dataset_file(dataset,year,data_folder=DATA_FOLDER):
+    return os.path.join(data_folder,'df_' + dataset,str(year) + '.parquet')
+
+# the years of an extracted dataset
+def dataset_years(dataset,data_folder=DATA_FOLDER):
+    return sorted([int(os.path.splitext(f)[0]) for f in os.listdir(os.path.join(data_folder,'df_' + dataset)) if f.endswith('.parquet')])
+
+# loads an extracted dataset ('accident', 'vehicle', or 'person'), reading only the years in year_range (all extracted years if None) 
+# and the given columns (all columns if None). The index is set as in the extracted data, or the dataset is returned in compact form 
+# (see COMPACT DATASETS) if compact is True
+def load_dataset(dataset,year_range=None,columns=None,data_folder=DATA_FOLDER,compact=False):
+    if year_range is None:
+        years = dataset_years(dataset,data_folder)
+    else:
+        years = range(year_range[0],year_range[1]+1)
+    if columns is not None:
+        columns = dataset_index[dataset] + [c for c in columns if c not in dataset_index[dataset]]
+    df = pandas.concat([pandas.read_parquet(dataset_file(dataset,yr,data_folder),columns=columns) for yr in years],ignore_index=True)
+    if compact == True:
+        return compact_dataset(df,dataset)
+    return df.set_index(dataset_index[dataset])
+
+# COMPACT DATASETS
+# To keep the full datasets in memory at low cost, they can be held in a compact form: the (year, st_case, veh_no, per_no) index is 
+# packed into a single int64 key (zero for absent levels), small codes are nullable 8- or 16-bit integers, and BAC values are integers 
+# scaled by BAC_SCALE. get_analytic_sample accepts compact datasets and expands only the years in the sample to the standard form
+BAC_SCALE = 10
+KEY_BITS = {'year':16,'st_case':24,'veh_no':12,'per_no':12}
+bac_columns = ['alcohol_test_result'] + ['mibac' + str(mirep) for mirep in range(1,11)]
+compact_dtypes = {'accident':{'state':'int8','state_abbr':'category','quarter':'Int8','day_week':'Int8','hour':'Int8','persons':'int16'},
+                  'vehicle':{'prev_acc':'Int8','prev_sus':'Int8','prev_dwi':'Int8','prev_spd':'Int8','prev_oth':'Int8','dr_drink':'Int8',
+                             'occupants':'Int8'},
+                  'person':{'seat_pos':'Int8','drinking':'Int8','alc_det':'Int8','atst_typ':'Int8','race':'Int8','age':'Int16','age_lt15':'bool',
+                            'sex':'Int8',**{bc:'Int16' for bc in bac_columns}}}
+
+# packs index levels into a single int64 key, which sorts in the same order as the levels
+def pack_key(year,st_case,veh_no=0,per_no=0):
+    key = numpy.asarray(year,dtype='int64')
+    for (level,values) in [('st_case',st_case),('veh_no',veh_no),('per_no',per_no)]:
+        key = (key << KEY_BITS[level]) | numpy.asarray(values,dtype='int64')
+    return key
+
+# unpacks an int64 key into its index levels, returned as a dictionary of arrays
+def unpack_key(key):
+    key = numpy.asarray(key,dtype='int64')
+    levels = {}
+    for level in ['per_no','veh_no','st_case','year']:
+        levels[level] = key & ((1 << KEY_BITS[level]) - 1)
+        key = key >> KEY_BITS[level]
+    return levels
+
+# whether a dataset is in compact form
+def is_compact(df):
+    return df.index.name == 'key'
+
+# converts a dataset (with its index as a dataframe index, or as columns) to compact form
+def compact_dataset(df,dataset):
+    if isinstance(df.index,pandas.MultiIndex):
+        df = df.reset_index()
+    levels = {level:df[level].to_numpy() for level in dataset_index[dataset]}
+    df_compact = df.drop(columns=dataset_index[dataset]).set_index(pandas.Index(pack_key(**levels),name='key'))
+    for (c,dtype) in compact_dtypes[dataset].items():
+        if c in df_compact.columns:
+            if c in bac_columns:
+                scaled = df_compact[c]*BAC_SCALE
+                if not numpy.allclose(scaled.round(),scaled,rtol=0,atol=1e-3,equal_nan=True):
+                    raise ValueError('Values of ' + c + ' cannot be stored as integers scaled by ' + str(BAC_SCALE) + '.')
+                df_compact[c] = scaled.round()
+            df_compact[c] = df_compact[c].astype(dtype)
+    return df_compact
+
+# whether each row of a compact dataset is in the years in year_range (all years if None)
+def compact_year_rows(df_compact,year_range=None):
+    if year_range is None:
+        return numpy.ones(len(df_compact),dtype=bool)
+    return (df_compact.index >= pack_key(year_range[0],0)) & (df_compact.index < pack_key(year_range[1]+1,0))
+
+# converts a compact dataset back to the standard form returned by load_dataset, optionally only for the years in year_range
+def expand_dataset(df_compact,dataset,year_range=None):
+    if year_range is not None:
+        df_compact = df_compact[compact_year_rows(df_compact,year_range)]
+    levels = unpack_key(df_compact.index.to_numpy())
+    df = pandas.DataFrame({level:levels[level] for level in dataset_index[dataset]})
+    for c in df_compact.columns:
+        if dataset_dtypes[dataset][c] == 'float32':
+            df[c] = df_compact[c].astype('float32').to_numpy()
+            if c in bac_columns:
+                df[c] = (df[c].astype('float64')/BAC_SCALE).astype('float32')
+        else:
+            df[c] = df_compact[c].to_numpy()
+    return df.astype({c:dataset_dtypes[dataset][c] for c in df.columns}).set_index(dataset_index[dataset])
+
+# CRASH KEYS
+# get_analytic_sample selects vehicles and persons by crash, and crashes by membership in other sets of crashes. Rather than matching 
+# (year, st_case) MultiIndex levels, rows are identified by packed int64 keys (see pack_key) and matched by sorted lookups
+
+# the packed keys of the rows of a dataframe index, from the given levels
+def row_keys(index,levels=['year','st_case']):
+    return pack_key(**{level:index.get_level_values(level) for level in levels})
+
+# whether each key is among sel_keys, found by binary search in the sorted sel_keys
+def keys_isin(keys,sel_keys):
+    sel_keys = numpy.unique(sel_keys)
+    if len(sel_keys) == 0:
+        return numpy.zeros(len(keys),dtype=bool)
+    pos = numpy.searchsorted(sel_keys,keys).clip(max=len(sel_keys)-1)
+    return sel_keys[pos] == keys
+
+# index from crashes to the rows of a dataframe (e.g. vehicles or persons): the sorted unique crash keys, the order that sorts the 
+# rows by crash, and the offsets of each crash's rows in that order
+def crash_row_index(df):
+    keys = row_keys(df.index)
+    order = numpy.argsort(keys,kind='stable')
+    (crashes,starts) = numpy.unique(keys[order],return_index=True)
+    return {'crashes':crashes,'offsets':numpy.append(starts,len(keys)),'order':order}
+
+# the rows of a dataframe belonging to the crashes in crash_index (an index with year and st_case levels), in their original order, 
+# found through the dataframe's crash_row_index
+def crash_rows(df,row_index,crash_index):
+    sel_keys = numpy.unique(row_keys(crash_index))
+    pos = numpy.searchsorted(row_index['crashes'],sel_keys).clip(max=max(len(row_index['crashes'])-1,0))
+    pos = pos[row_index['crashes'][pos] == sel_keys] if len(row_index['crashes']) > 0 else pos[:0]
+    starts = row_index['offsets'][pos]
+    lengths = row_index['offsets'][pos+1] - starts
+    sorted_rows = numpy.repeat(starts - numpy.cumsum(lengths) + lengths,lengths) + numpy.arange(lengths.sum())
+    keep = numpy.zeros(len(df),dtype=bool)
+    keep[row_index['order'][sorted_rows]] = True
+    return df[keep]
+
+# MANIFESTS
+# retrieve.py and extract.py record each year they have processed in a JSON manifest (keyed by year), so that a rerun only 
+# re-fetches or re-extracts the years whose inputs have changed
+
+# the sha256 hash of a file, read in chunks
+def file_sha256(path,chunk_size=2**20):
+    file_hash = hashlib.sha256()
+    with open(path,'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+# reads a manifest, returning an empty manifest if none has been written yet
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as file:
+        return json.load(file)
+
+# writes a manifest atomically, so an interrupted run never leaves a partial manifest
+def write_manifest(manifest,manifest_file):
+    if os.path.dirname(manifest_file) and not os.path.exists(os.path.dirname(manifest_file)):
+        os.makedirs(os.path.dirname(manifest_file))
+    with open(manifest_file + '.tmp','w') as file:
+        json.dump(manifest,file,indent=1,sort_keys=True)
+    os.replace(manifest_file + '.tmp',manifest_file)
 
 # returns a dataframe of drivers, from the person file. Defaults to drop crashes with multiple drivers in at least one of the driver's seats.
 def get_driver(df_person, keep_duplicated = False, keep_per_no = False):
@@ -18,15 +192,103 @@ def get_driver(df_person, keep_duplicated = False, keep_per_no = False):
         df_driver = df_driver.reset_index().set_index(['year','st_case','veh_no']).drop(['per_no'],axis=1)
     return df_driver
     
+# DRIVERS
+# get_analytic_sample selects drivers many times, so the drivers of each person dataframe are derived once, with their crash index 
+# (see CRASH KEYS), and kept until the person dataframe is deleted. For compact datasets, only the drivers' rows in year_range (all 
+# years if None) are expanded, with the person columns in SAMPLE_COLUMNS. Person dataframes should therefore not be modified in place 
+# once loaded
+DRIVER_CACHE_SIZE = 4
+# the vehicle and person columns used in building analytic samples, which are the only ones expanded from compact datasets (the 
+# accident columns are all kept in the samples)
+SAMPLE_COLUMNS = {'vehicle':['prev_acc','prev_sus','prev_dwi','prev_spd','prev_oth','dr_drink'],
+                  'person':['seat_pos','drinking','alcohol_test_result','age','sex'] + ['mibac' + str(mirep) for mirep in range(1,11)]}
+_driver_cache = collections.OrderedDict()
+
+# returns the drivers of a person dataframe (as get_driver) and their crash_row_index, from the cache if they were derived before
+def get_driver_indexed(df_person,year_range=None):
+    if not is_compact(df_person):
+        year_range = None
+    key = (id(df_person),None if year_range is None else tuple(year_range))
+    if key in _driver_cache:
+        _driver_cache.move_to_end(key)
+    else:
+        if is_compact(df_person):
+            rows = compact_year_rows(df_person,year_range) & df_person['seat_pos'].eq(11).to_numpy(dtype=bool,na_value=False)
+            df_driver = get_driver(expand_dataset(df_person.loc[rows,[c for c in SAMPLE_COLUMNS['person'] if c in df_person.columns]],'person'))
+        else:
+            df_driver = get_driver(df_person)
+        _driver_cache[key] = (df_driver,crash_row_index(df_driver))
+        weakref.finalize(df_person,_driver_cache.pop,key,None) # ids can be reused once the dataframe is deleted
+        if len(_driver_cache) > DRIVER_CACHE_SIZE:
+            _driver_cache.popitem(last=False)
+    return _driver_cache[key]
+
+# the number of all drivers of a person dataframe and of those lacking a police evaluation, from its drivers (df_driver, as derived 
+# by get_driver) or, for compact datasets, from the packed keys without expanding the dataframe
+def _all_driver_summary(df_person,df_driver):
+    if is_compact(df_person):
+        rows = df_person['seat_pos'].eq(11).to_numpy(dtype=bool,na_value=False)
+        veh_keys = df_person.index.to_numpy()[rows] >> KEY_BITS['per_no']
+        (veh_keys,inverse,counts) = numpy.unique(veh_keys,return_inverse=True,return_counts=True)
+        drinking = df_person['drinking'].to_numpy(dtype=float,na_value=numpy.nan)[rows][counts[inverse]==1] # drop duplicated drivers
+    else:
+        drinking = df_driver['drinking'].to_numpy(dtype=float)
+    return {'drivers':len(drinking),'drivers_no_police_eval':int((numpy.isin(drinking,[8,9]) | numpy.isnan(drinking)).sum())}
+
 # identifies a vehicle's driver as drinking, depending on drinking definition of interest
 # for multiple imputation, returns a dataframe with a drink_status for each MI replicate
 def veh_dr_drinking_status(df_vehicle, df_driver, drinking_definition, bac_threshold, mireps, drop_below_threshold):
-    df_veh_driver = df_vehicle.merge(df_driver,how='left',left_index=True,right_index=True) # merge in drivers from person file    
+    return veh_dr_drinking_statuses(df_vehicle, df_driver, [(drinking_definition, bac_threshold)], mireps, drop_below_threshold, 
+                                    missing=False)[(drinking_definition, bac_threshold)]
+
+# as veh_dr_drinking_status, for a list of (drinking_definition, bac_threshold) pairs, in one pass over the merged vehicle-driver table. 
+# Returns a dictionary keyed by those pairs. If missing is True, each value is a tuple of the drink status and of whether the drink 
+# status is missing (for any MI replicate) when drivers below the threshold are not dropped, as used to identify missing data
+def veh_dr_drinking_statuses(df_vehicle, df_driver, definitions, mireps, drop_below_threshold, missing=True):
+    # look up the relevant driver variables from the person file by the vehicles' packed keys (see CRASH KEYS), as a left merge would, 
+    # without building the merged index
+    bac_vars = ['alcohol_test_result'] if mireps == False else ['mibac' + str(mirep) for mirep in range(1,mireps+1)] 
+    veh_keys = row_keys(df_vehicle.index,['year','st_case','veh_no'])
+    dr_keys = row_keys(df_driver.index,['year','st_case','veh_no'])
+    dr_order = numpy.argsort(dr_keys,kind='stable')
+    veh_dr = numpy.searchsorted(dr_keys[dr_order],veh_keys).clip(max=max(len(dr_keys)-1,0))
+    veh_matched = (dr_keys[dr_order][veh_dr] == veh_keys) if len(dr_keys) > 0 else numpy.zeros(len(veh_keys),dtype=bool)
+    dr_rows = dr_order[veh_dr[veh_matched]]
+    driver_values = numpy.full((len(veh_keys),1+len(bac_vars)),numpy.nan)
+    driver_values[veh_matched] = df_driver[['drinking'] + bac_vars].to_numpy(dtype=float)[dr_rows]
+    drinking = driver_values[:,0]
+    dr_drink = df_vehicle['dr_drink'].to_numpy(dtype=float)
+    driver_bac = driver_values[:,1:]
+    
+    drink_statuses = {}
+    for (drinking_definition, bac_threshold) in definitions:
+        # the drink status has the data type of the variable it is based on, or is a float for definitions based only on BAC
+        if drinking_definition in ['police_report_only','police_report_primary','bac_test_primary']:
+            dtype = numpy.result_type(df_driver['drinking'].dtype,numpy.float32)
+        elif drinking_definition == 'any_evidence':
+            dtype = numpy.result_type(df_vehicle['dr_drink'].dtype,numpy.float32)
+        else:
+            dtype = numpy.float64
+        drink_status = drinking_status_array(drinking,dr_drink,driver_bac,drinking_definition,bac_threshold,drop_below_threshold).astype(dtype)
+        if mireps == False:
+            drink_status = pandas.Series(drink_status[:,0],index=df_vehicle.index,name='drink_status')
+        else:
+            drink_status = pandas.DataFrame(drink_status,index=df_vehicle.index,columns=['drink_status' + str(mirep+1) for mirep in range(0,mireps)])
+        if missing == True:
+            drink_status_missing = numpy.isnan(drinking_status_array(drinking,dr_drink,driver_bac,drinking_definition,bac_threshold,False)).any(axis=1)
+            drink_status = (drink_status, pandas.Series(drink_status_missing,index=df_vehicle.index))
+        drink_statuses[(drinking_definition, bac_threshold)] = drink_status
+    
+    return drink_statuses
+
+# the drink status of each driver, for each of the driver's BAC values (e.g. one for each MI replicate), as an array with a row for 
+# each driver and a column for each BAC value. drinking and dr_drink have a value for each driver, and missing values are NaN 
+def drinking_status_array(drinking, dr_drink, driver_bac, drinking_definition, bac_threshold, drop_below_threshold):
     bac_threshold_scaled = bac_threshold*100 # need to scale the threshold to match how the data are stored
-    if mireps == False:
-        driver_bac = df_veh_driver['alcohol_test_result']
-    else:
-        driver_bac = df_veh_driver.loc[:,'mibac1':'mibac' + str(mireps)] # replace the alcohol test result with the multiply imputed value
+    shape = driver_bac.shape
+    drinking = numpy.broadcast_to(drinking[:,None],shape)
+    dr_drink = numpy.broadcast_to(dr_drink[:,None],shape)
+    drinking_reported = numpy.where(numpy.isin(drinking,[8,9]),numpy.nan,drinking) # 8 if not reported, 9 if unknown
     
     # DRINKING DEFINITIONS
     # police_report_only: police officer report [0 if nondrinking, 1 if drinking, 8 if not reported, 9 if unknown] (definition 1 in L&P, 2001; what LP say they use)
@@ -34,99 +296,112 @@ def veh_dr_drinking_status(df_vehicle, df_driver, drinking_definition, bac_thres
     # police_report_primary: officer report primary, missing values adjusted by BAC test (definition 3 in paper)
     # bac_test_primary: BAC test primary (definition 4 in paper)
     # impaired_vs_sober: Legal impairment based on tested BAC, compared against not drinking (intermediate values dropped...this is the supplemental analysis in LP)
-
+    # (comparisons with missing BAC values are always false, so missing BAC values never change the status)
+    
     if drinking_definition == 'police_report_only': # definition 1 in Levitt & Porter (2001)
-        if mireps == False:
-            df_driver_drink_status = df_veh_driver['drinking']
-        else:
-            df_driver_drink_status = pandas.concat([df_veh_driver['drinking']]*mireps,axis=1)
-        df_driver_drink_status = df_driver_drink_status.replace({8:numpy.nan, 9:numpy.nan})
+        drink_status = drinking_reported.copy()
     elif drinking_definition == 'any_evidence': # definition 2 in Levitt & Porter (2001)
-        if mireps == False:
-            df_driver_drink_status = df_veh_driver['dr_drink']
-        else:
-            df_driver_drink_status = pandas.concat([df_veh_driver['dr_drink']]*mireps,axis=1)
+        drink_status = dr_drink.copy()
     elif drinking_definition == 'police_report_primary': # definition 3 in Levitt & Porter (2001)
-        if mireps == False:
-            df_driver_drink_status = df_veh_driver['drinking']
-        else:
-            df_driver_drink_status = pandas.concat([df_veh_driver['drinking']]*mireps,axis=1)
-        df_driver_drink_status = df_driver_drink_status.replace({8:numpy.nan, 9:numpy.nan})
+        drink_status = drinking_reported.copy()
         if drop_below_threshold == False:
-            df_driver_drink_status = df_driver_drink_status.mask((df_driver_drink_status.isnull()).to_numpy() & (driver_bac<=bac_threshold_scaled).to_numpy(), 0)
+            drink_status[numpy.isnan(drink_status) & (driver_bac<=bac_threshold_scaled)] = 0
         else:
-            df_driver_drink_status = df_driver_drink_status.mask((df_driver_drink_status.isnull()).to_numpy() & (driver_bac==0).to_numpy(), 0)
-        df_driver_drink_status = df_driver_drink_status.mask((df_driver_drink_status.isnull()).to_numpy() & (driver_bac>bac_threshold_scaled).to_numpy(), 1)
+            drink_status[numpy.isnan(drink_status) & (driver_bac==0)] = 0
+        drink_status[numpy.isnan(drink_status) & (driver_bac>bac_threshold_scaled)] = 1
     elif drinking_definition == 'bac_test_primary': # definition 4 in Levitt & Porter (2001)
-        if mireps == False:
-            df_driver_drink_status = df_veh_driver['drinking']
-        else:
-            df_driver_drink_status = pandas.concat([df_veh_driver['drinking']]*mireps,axis=1)
+        drink_status = drinking.copy()
         if drop_below_threshold == False:
-            df_driver_drink_status = df_driver_drink_status.mask((driver_bac<=bac_threshold_scaled).to_numpy(), 0)
+            drink_status[driver_bac<=bac_threshold_scaled] = 0
         else:
-            df_driver_drink_status = df_driver_drink_status.mask((driver_bac==0).to_numpy(), 0)
-            df_driver_drink_status = df_driver_drink_status.mask((driver_bac>0).to_numpy() & (driver_bac<=bac_threshold_scaled).to_numpy(), numpy.nan)
-        df_driver_drink_status = df_driver_drink_status.mask((driver_bac>bac_threshold_scaled).to_numpy(), 1)
-        df_driver_drink_status = df_driver_drink_status.replace({8:numpy.nan, 9:numpy.nan})        
+            drink_status[driver_bac==0] = 0
+            drink_status[(driver_bac>0) & (driver_bac<=bac_threshold_scaled)] = numpy.nan
+        drink_status[driver_bac>bac_threshold_scaled] = 1
+        drink_status[numpy.isin(drink_status,[8,9])] = numpy.nan
     elif drinking_definition == 'impaired_vs_sober': # definition 5 in Levitt & Porter (2001)
-        if mireps == False:
-            dr_drink = df_veh_driver['dr_drink']
-            df_driver_drink_status = pandas.Series(index=df_veh_driver.index,data=numpy.nan)
-        else:
-            dr_drink = pandas.concat([df_veh_driver['dr_drink']]*mireps,axis=1)    
-            df_driver_drink_status = pandas.DataFrame(index=df_veh_driver.index)
-            for mirep in range(0,mireps):
-                df_driver_drink_status['drink_status' + str(mirep+1)] = numpy.nan    
-        df_driver_drink_status = df_driver_drink_status.mask((driver_bac==0).to_numpy() | (dr_drink==0).to_numpy(), 0)    
+        drink_status = numpy.full(shape,numpy.nan)
+        drink_status[(driver_bac==0) | (dr_drink==0)] = 0
         if drop_below_threshold == False:
-            df_driver_drink_status = df_driver_drink_status.mask((driver_bac<=bac_threshold_scaled).to_numpy() | (dr_drink==0).to_numpy(), 0)        
-        df_driver_drink_status = df_driver_drink_status.mask((driver_bac>bac_threshold_scaled).to_numpy(), 1)
+            drink_status[(driver_bac<=bac_threshold_scaled) | (dr_drink==0)] = 0
+        drink_status[driver_bac>bac_threshold_scaled] = 1
     elif drinking_definition == 'bac_test_only': # new definition that should be used when running MI with BAC only
-        if mireps == False:
-            df_driver_drink_status = pandas.Series(index=df_veh_driver.index,data=numpy.nan)
-        else:
-            df_driver_drink_status = pandas.DataFrame(index=df_veh_driver.index)
-            for mirep in range(0,mireps):
-                df_driver_drink_status['drink_status' + str(mirep+1)] = numpy.nan
-        df_driver_drink_status = df_driver_drink_status.mask((driver_bac==0).to_numpy(), 0)
+        drink_status = numpy.full(shape,numpy.nan)
+        drink_status[driver_bac==0] = 0
         if drop_below_threshold == False:
-            df_driver_drink_status = df_driver_drink_status.mask((driver_bac<=bac_threshold_scaled).to_numpy(), 0)
-        df_driver_drink_status = df_driver_drink_status.mask((driver_bac>bac_threshold_scaled).to_numpy(), 1)
-    
-    if mireps == False:
-        df_driver_drink_status = df_driver_drink_status.rename('drink_status')
-    else:
-        for mirep in range(0,mireps):
-            df_driver_drink_status.columns.values[mirep] = 'drink_status' + str(mirep+1)
+            drink_status[driver_bac<=bac_threshold_scaled] = 0
+        drink_status[driver_bac>bac_threshold_scaled] = 1
     
-    return df_driver_drink_status
+    return drink_status
+
+# the driver type of each driver and drink status column (e.g. MI replicate), coded as 1 & 2 in the two-type case, or 1, 2, 3, & 4 in 
+# the four-type case, and NaN if the driver is none of the types
+def driver_type_array(drink_status, driver_types):
+    driver_type = numpy.full(drink_status.shape,numpy.nan)
+    for (dt_num, dt) in enumerate(driver_types,start=1): # loop over driver type definitions
+        dt_bool = numpy.ones(drink_status.shape,dtype=bool)
+        for dtc in dt: # loop over each criterion for each definition
+            if dtc=='sober':
+                dt_bool = dt_bool & (drink_status==0)
+            elif dtc=='drinking':
+                dt_bool = dt_bool & (drink_status==1)
+        driver_type[dt_bool] = dt_num
+    return driver_type
+
+# the bit of each type of missing data in the bitmasks of accident_missing_data, in the order of its miss_* columns
+MISSING_BITS = {'miss_hour':1,'miss_day_week':2,'miss_state':4,'miss_minor_blemishes':8,'miss_major_blemishes':16,
+                'miss_any_blemishes':32,'miss_drinking_status':64,'miss_age':128,'miss_sex':256}
 
 # identifies accidents with missing data (that are relevant for exclusion from L&P estimation)
-def accident_missing_data(df_accident,df_vehicle,df_driver,drinking_definition,bac_threshold,mireps):
-    # collect missing info about the driver
-    df_dr_miss = pandas.DataFrame(index=df_driver.index)
-    df_dr_miss['miss_age'] = (df_driver['age'].isnull()) | (df_driver['age'] < 13) # set child drivers as missing values
-    df_dr_miss['miss_sex'] = df_driver['sex'].isnull()
-    
+# whether each vehicle's drink status is missing can be given in veh_drink_status_missing (see veh_dr_drinking_statuses), if already known
+# The missing data of each vehicle and its driver are encoded as a bitmask (see MISSING_BITS), which is combined with the accident's 
+# by a bitwise OR over each crash's vehicles, sorted by crash
+def accident_missing_data(df_accident,df_vehicle,df_driver,drinking_definition,bac_threshold,mireps,veh_drink_status_missing=None):
     # collect missing info about the vehicle
-    df_veh_miss = pandas.DataFrame(index=df_vehicle.index)
-    df_veh_miss['miss_minor_blemishes'] = (df_vehicle['prev_acc'].isnull() | df_vehicle['prev_spd'].isnull() | df_vehicle['prev_oth'].isnull()) 
-    df_veh_miss['miss_major_blemishes'] = (df_vehicle['prev_sus'].isnull() | df_vehicle['prev_dwi'].isnull()) 
-    df_veh_miss['miss_any_blemishes'] = (df_veh_miss['miss_minor_blemishes'] | df_veh_miss['miss_major_blemishes']) 
-    df_veh_miss['miss_drinking_status'] = pandas.DataFrame(veh_dr_drinking_status(df_vehicle, df_driver, drinking_definition, bac_threshold, mireps, drop_below_threshold=False)).isnull().any(axis='columns')
+    miss_minor_blemishes = (df_vehicle['prev_acc'].isnull() | df_vehicle['prev_spd'].isnull() | df_vehicle['prev_oth'].isnull()).to_numpy()
+    miss_major_blemishes = (df_vehicle['prev_sus'].isnull() | df_vehicle['prev_dwi'].isnull()).to_numpy()
+    if veh_drink_status_missing is None:
+        veh_drink_status_missing = veh_dr_drinking_statuses(df_vehicle, df_driver, [(drinking_definition, bac_threshold)], mireps, 
+                                                            drop_below_threshold=False)[(drinking_definition, bac_threshold)][1]
+    if not veh_drink_status_missing.index.equals(df_vehicle.index):
+        veh_drink_status_missing = veh_drink_status_missing.reindex(df_vehicle.index).fillna(False)
+    veh_bits = (MISSING_BITS['miss_minor_blemishes']*miss_minor_blemishes | MISSING_BITS['miss_major_blemishes']*miss_major_blemishes | 
+                MISSING_BITS['miss_any_blemishes']*(miss_minor_blemishes | miss_major_blemishes) | 
+                MISSING_BITS['miss_drinking_status']*veh_drink_status_missing.to_numpy(dtype=bool))
+    
+    # collect missing info about the driver, and add it to the driver's vehicle
+    dr_bits = (MISSING_BITS['miss_age']*((df_driver['age'].isnull()) | (df_driver['age'] < 13)).to_numpy() | # set child drivers as missing values
+               MISSING_BITS['miss_sex']*df_driver['sex'].isnull().to_numpy())
+    veh_keys = row_keys(df_vehicle.index,['year','st_case','veh_no'])
+    veh_order = numpy.argsort(veh_keys,kind='stable')
+    dr_keys = row_keys(df_driver.index,['year','st_case','veh_no'])
+    dr_veh = numpy.searchsorted(veh_keys[veh_order],dr_keys).clip(max=max(len(veh_keys)-1,0))
+    dr_matched = (veh_keys[veh_order][dr_veh] == dr_keys) if len(veh_keys) > 0 else numpy.zeros(len(dr_keys),dtype=bool)
+    numpy.bitwise_or.at(veh_bits,veh_order[dr_veh[dr_matched]],dr_bits[dr_matched])
     
     # collect missing info about the accident
-    df_acc_miss = pandas.DataFrame(index=df_accident.index)
-    df_acc_miss['miss_hour'] = df_accident['hour'].isnull()
-    df_acc_miss['miss_day_week'] = df_accident['day_week'].isnull()
-    df_acc_miss['miss_state'] = df_accident['state'].isnull()
+    acc_bits = (MISSING_BITS['miss_hour']*df_accident['hour'].isnull().to_numpy() | 
+                MISSING_BITS['miss_day_week']*df_accident['day_week'].isnull().to_numpy() | 
+                MISSING_BITS['miss_state']*df_accident['state'].isnull().to_numpy())
+    acc_keys = row_keys(df_accident.index)
+    acc_order = numpy.argsort(acc_keys,kind='stable')
+    acc_bits = acc_bits[acc_order]
     
-    df_return_miss = df_acc_miss.merge(df_veh_miss.merge(df_dr_miss,how='left',on=['year','st_case','veh_no']),how='left',on=['year','st_case']).groupby(['year','st_case']).any()
+    # combine the vehicles' bitmasks over each crash, and add them to the accident's
+    veh_crash_keys = row_keys(df_vehicle.index)
+    veh_crash_order = numpy.argsort(veh_crash_keys,kind='stable')
+    (veh_crashes,veh_crash_starts) = numpy.unique(veh_crash_keys[veh_crash_order],return_index=True)
+    if len(veh_crashes) > 0 and len(acc_keys) > 0:
+        crash_veh_bits = numpy.bitwise_or.reduceat(veh_bits[veh_crash_order],veh_crash_starts)
+        acc_pos = numpy.searchsorted(acc_keys[acc_order],veh_crashes).clip(max=len(acc_keys)-1)
+        acc_matched = acc_keys[acc_order][acc_pos] == veh_crashes
+        acc_bits[acc_pos[acc_matched]] |= crash_veh_bits[acc_matched]
+    
+    df_return_miss = pandas.DataFrame({miss_column:(acc_bits & bit) > 0 for (miss_column,bit) in MISSING_BITS.items()},
+                                      index=df_accident.index[acc_order])
     # flag anything missing excluding drinking status
-    df_return_miss['miss_any_excl_drink_stat'] = df_return_miss.drop(columns=['miss_drinking_status']).any(axis='columns')
+    df_return_miss['miss_any_excl_drink_stat'] = (acc_bits & ~MISSING_BITS['miss_drinking_status']) > 0
     # flag anything missing
-    df_return_miss['miss_any'] = df_return_miss.any(axis='columns')
+    df_return_miss['miss_any'] = acc_bits > 0
     
     return df_return_miss
 
@@ -135,121 +410,211 @@ def accident_missing_data(df_accident,df_vehicle,df_driver,drinking_definition,b
 def get_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
                         drinking_definition,bac_threshold,state_year_prop_threshold,
                         mireps=False,summarize_sample=True,drop_below_threshold=True):
+    # start timer
+    start = time.time()
+    print("Building the analytic sample...")
+    
+    summary = dict() if summarize_sample == True else None
+    analytic_sample = _build_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                                             drinking_definition,bac_threshold,state_year_prop_threshold,mireps,drop_below_threshold,summary)
+    if summarize_sample == True:
+        print_sample_summary(summary)
+    
+    end = time.time()
+    print("Time to build analytic sample: " + str(end-start))
+    return analytic_sample
+
+# as get_analytic_sample, but returns the summary statistics of the sample (see SAMPLE SUMMARY STATISTICS) rather than printing them, 
+# as (analytic_sample, summary)
+def summarize_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                              drinking_definition,bac_threshold,state_year_prop_threshold,
+                              mireps=False,drop_below_threshold=True):
+    summary = dict()
+    analytic_sample = _build_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                                             drinking_definition,bac_threshold,state_year_prop_threshold,mireps,drop_below_threshold,summary)
+    return (analytic_sample,summary)
+
+# builds the analytic sample (see get_analytic_sample), collecting the summary statistics of each stage in summary, unless it is None
+def _build_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                           drinking_definition,bac_threshold,state_year_prop_threshold,mireps,drop_below_threshold,summary):
+    # expand compact datasets only for the sample years
+    sample_data = _prepare_sample_data(df_accident,df_vehicle,df_person,year_range,summary)
+    analytic_sample = _base_analytic_sample(sample_data,year_range,hour_range,mireps,summary)
+    drink_status = veh_dr_drinking_statuses(sample_data['vehicle'],sample_data['driver'],[(drinking_definition,bac_threshold)],mireps,
+                                            drop_below_threshold)[(drinking_definition,bac_threshold)]
+    return _restrict_analytic_sample(analytic_sample,sample_data,drink_status,driver_types,drinking_definition,bac_threshold,
+                                     state_year_prop_threshold,mireps,summary,drop_below_threshold)
+
+# builds the analytic samples for several drinking definitions, given as a list of (drinking_definition, bac_threshold) pairs, and 
+# returns them in a dictionary keyed by those pairs. The sample restrictions that don't depend on the drinking definition are applied 
+# once, and the drink status for all of the definitions is identified in one pass. The samples are not summarized
+def get_analytic_samples(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                         definitions,state_year_prop_threshold,mireps=False,drop_below_threshold=True):
+    return get_analytic_sample_sweep(df_accident,df_vehicle,df_person,[(year_range,hour_range)],driver_types,definitions,
+                                     state_year_prop_threshold,mireps,drop_below_threshold)[(tuple(year_range),tuple(hour_range))]
+
+# builds the analytic samples for several year and hour ranges, given as a list of (year_range, hour_range) pairs, and for several 
+# drinking definitions (as in get_analytic_samples). Returns a dictionary keyed by the (year_range, hour_range) pairs, as tuples, of 
+# dictionaries keyed by the drinking definitions. The data are prepared and the drink status identified once for the widest range of 
+# years, and whether each crash has missing data is identified once for all of the ranges. The state-year missing data restriction 
+# is still evaluated within each range, so the samples are the same as those built separately by get_analytic_sample
+def get_analytic_sample_sweep(df_accident,df_vehicle,df_person,ranges,driver_types, 
+                              definitions,state_year_prop_threshold,mireps=False,drop_below_threshold=True):
+    # start timer
+    start = time.time()
+    print("Building the analytic samples for " + str(len(ranges)) + " year and hour ranges and " + str(len(definitions)) + " drinking definitions...")
     
+    ranges = [(tuple(year_range),tuple(hour_range)) for (year_range,hour_range) in ranges]
+    expand_years = (min(year_range[0] for (year_range,hour_range) in ranges),max(year_range[1] for (year_range,hour_range) in ranges))
+    sample_data = _prepare_sample_data(df_accident,df_vehicle,df_person,expand_years,None)
+    base_samples = {(year_range,hour_range):_base_analytic_sample(sample_data,year_range,hour_range,mireps,None) for (year_range,hour_range) in ranges}
+    drink_statuses = veh_dr_drinking_statuses(sample_data['vehicle'],sample_data['driver'],definitions,mireps,drop_below_threshold)
+    
+    # identify missing data in all of the crashes in any of the ranges, from which each range's crashes are then selected
+    crash_keys = numpy.unique(numpy.concatenate([row_keys(base_sample.index) for base_sample in base_samples.values()]))
+    all_crashes = sample_data['accident'][keys_isin(row_keys(sample_data['accident'].index),crash_keys)]
+    acc_miss_flags = {definition:_sample_missing_data(all_crashes,sample_data,drink_statuses[definition],definition[0],definition[1],mireps) 
+                      for definition in definitions}
+    
+    analytic_samples = {}
+    for (sample_range,base_sample) in base_samples.items():
+        analytic_samples[sample_range] = {}
+        for (drinking_definition,bac_threshold) in definitions:
+            analytic_samples[sample_range][(drinking_definition,bac_threshold)] = _restrict_analytic_sample(base_sample.copy(),sample_data,
+                                                                    drink_statuses[(drinking_definition,bac_threshold)],driver_types,
+                                                                    drinking_definition,bac_threshold,state_year_prop_threshold,mireps,
+                                                                    None,drop_below_threshold,acc_miss_flags[(drinking_definition,bac_threshold)])
+    
+    end = time.time()
+    print("Time to build analytic samples: " + str(end-start))
+    return analytic_samples
+
+# builds the analytic samples for several state-year missing data thresholds (state_year_prop_thresholds), and returns them in a 
+# dictionary keyed by the thresholds. The proportion of crashes with missing data in each state-year doesn't depend on the threshold, 
+# and a higher threshold only adds state-years, so the samples are nested: the sample for the highest threshold is built once, and 
+# each of the others keeps its rows in the state-years within that threshold. The samples are not summarized
+def get_analytic_sample_thresholds(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                                   drinking_definition,bac_threshold,state_year_prop_thresholds,mireps=False,drop_below_threshold=True):
+    # start timer
+    start = time.time()
+    print("Building the analytic samples for " + str(len(state_year_prop_thresholds)) + " state-year missing data thresholds...")
+    
+    sample_data = _prepare_sample_data(df_accident,df_vehicle,df_person,year_range,None)
+    analytic_sample = _base_analytic_sample(sample_data,year_range,hour_range,mireps,None)
+    drink_status = veh_dr_drinking_statuses(sample_data['vehicle'],sample_data['driver'],[(drinking_definition,bac_threshold)],mireps,
+                                            drop_below_threshold)[(drinking_definition,bac_threshold)]
+    (analytic_sample,df_acc_miss_flag,df_st_yr_prop_miss) = _missing_analytic_sample(analytic_sample,sample_data,drink_status,
+                                                                drinking_definition,bac_threshold,mireps,None)
+    analytic_sample = _state_year_restriction(analytic_sample,df_st_yr_prop_miss,max(state_year_prop_thresholds))
+    analytic_sample = _complete_analytic_sample(analytic_sample,sample_data,drink_status,df_acc_miss_flag,driver_types,mireps,None)
+    
+    # proportion of crashes with missing data in the state-year of each row
+    row_prop_miss = df_st_yr_prop_miss['miss_any'].reindex(pandas.MultiIndex.from_arrays([analytic_sample.index.get_level_values('year'),
+                                                                                          analytic_sample['state']])).to_numpy()
+    analytic_samples = {threshold:analytic_sample[row_prop_miss<=threshold] for threshold in state_year_prop_thresholds}
+    
+    end = time.time()
+    print("Time to build analytic samples: " + str(end-start))
+    return analytic_samples
+
+# prepares the data from which analytic samples are built: expands compact datasets (only for expand_years, if given, and only the 
+# vehicle and person columns in SAMPLE_COLUMNS), derives the drivers, indexes the vehicles and drivers by crash, and identifies the 
+# crashes that include any vehicles that don't have a driver. The prepared data can be shared by samples for any years within 
+# expand_years. Summary statistics are collected in summary (see SAMPLE SUMMARY STATISTICS), unless it is None
+def _prepare_sample_data(df_accident,df_vehicle,df_person,expand_years,summary):
+    (df_driver,driver_index) = get_driver_indexed(df_person,expand_years) # drivers are derived once per person dataframe
+    
+    # summarize the initial data, with all of the drivers (rather than those of expand_years)
+    all_drivers = None
+    if summary is not None:
+        all_drivers = _all_driver_summary(df_person,df_driver)
+        summary['all'] = {'accidents':len(df_accident.index),'vehicles':len(df_vehicle.index),'drivers':all_drivers['drivers']}
+    
+    if is_compact(df_accident):
+        df_accident = expand_dataset(df_accident,'accident',expand_years)
+    if is_compact(df_vehicle):
+        df_vehicle = expand_dataset(df_vehicle.loc[compact_year_rows(df_vehicle,expand_years),
+                                                   [c for c in SAMPLE_COLUMNS['vehicle'] if c in df_vehicle.columns]],'vehicle')
+    # index the vehicles by crash, for selecting those in the sample's crashes (see CRASH KEYS)
+    veh_index = crash_row_index(df_vehicle)
+    veh_no_driver = df_vehicle.index[~keys_isin(row_keys(df_vehicle.index,['year','st_case','veh_no']),row_keys(df_driver.index,['year','st_case','veh_no']))]
+    
+    return {'accident':df_accident,'vehicle':df_vehicle,'veh_index':veh_index,'driver':df_driver,'driver_index':driver_index,
+            'no_driver_crashes':row_keys(veh_no_driver),'all_drivers':all_drivers}
+
+# the first stage of building an analytic sample from the prepared data (see _prepare_sample_data): the restrictions that don't 
+# depend on the drinking definition (years, complete drivers, hours, and number of vehicles). Each is a restriction on crashes, so 
+# the prepared data for a wider range of years give the same sample
+def _base_analytic_sample(sample_data,year_range,hour_range,mireps,summary):
     first_year = year_range[0]
     last_year = year_range[1]
     earliest_hour = hour_range[0]
     latest_hour = hour_range[1]
+    df_accident = sample_data['accident']
+    df_vehicle = sample_data['vehicle']
+    veh_index = sample_data['veh_index']
     
-    # start timer and summarize the initial data
-    start = time.time()
-    print("Building the analytic sample...")
-    if summarize_sample == True:
-        print('Count of all accidents: ')
-        print(len(df_accident.index))
-        print('Count of all vehicles: ')
-        print(len(df_vehicle.index))
-        print('Count of all drivers: ')
-        print(len(get_driver(df_person)))
-        
     # implement year range sample restriction
     analytic_sample = df_accident[df_accident.index.droplevel('st_case').isin(range(first_year,last_year+1))] # restrict sample to selected years
-    if summarize_sample == True:
-        print('Count of accidents after year sample restriction: ')
-        print(len(analytic_sample.index))
-        print('Count of vehicles after year sample restriction: ')
-        print(len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].index))
+    if summary is not None:
+        summary['years'] = _crash_summary(analytic_sample,sample_data)
         
     # drop accidents that include any vehicles that don't have a driver (all acidents must be complete with all vehicles having a driver)
-    analytic_sample = analytic_sample[~analytic_sample.index.isin(df_vehicle[~df_vehicle.index.isin(get_driver(df_person).index)].index.droplevel(['veh_no']))]
-    if summarize_sample == True:    
-        print('Count of accidents after excluding accidents with no recorded drivers: ')
-        print(len(analytic_sample.index))
-        print('Count of vehicles after excluding accidents with no recorded drivers: ')
-        print(len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].index))
-        print('Count of accidents with missing hours: ')
-        print(len(analytic_sample.loc[analytic_sample['hour'].isnull()]))
-        print('Count of vehicles with missing hours: ')
-        print(len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.loc[analytic_sample['hour'].isnull()].index)].index))   
-        acc_veh_count = df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].groupby(['year','st_case']).size() # series that counts vehicles in each accident
-        acc_veh_count = acc_veh_count.rename('acc_veh_count')
-        print('Count of accidents by vehicles per accident, before hours restriction:')
-        print(acc_veh_count.value_counts())
-        print('Proportion of accidents with 3 or more drivers, before hours restriction:')
-        print(len(analytic_sample[analytic_sample.index.isin(acc_veh_count.loc[acc_veh_count>=3].index)])/len(analytic_sample.index))
-        print('Proportion of drivers in accidents with 3 or more drivers, before hours restriction:')
-        print(len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample[analytic_sample.index.isin(acc_veh_count.loc[acc_veh_count>=3].index)].index)])/len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)]))
+    analytic_sample = analytic_sample[~keys_isin(row_keys(analytic_sample.index),sample_data['no_driver_crashes'])]
+    if summary is not None:
+        summary['complete_drivers'] = _crash_summary(analytic_sample,sample_data)
         
     # implement hours range restriction
     if earliest_hour > latest_hour: # wrap selected hours across midnight, and keep that sample
         analytic_sample = analytic_sample.loc[(analytic_sample['hour']>=earliest_hour) | (analytic_sample['hour']<=latest_hour)]
     else: # get simple range of hours, and keep that sample
         analytic_sample = analytic_sample.loc[(analytic_sample['hour']>=earliest_hour) & (analytic_sample['hour']<=latest_hour)]
-    if summarize_sample == True:    
-        print('Count of accidents after hour sample restriction: ')
-        print(len(analytic_sample.index))
-        print('Count of vehicles after hour sample restriction: ')
-        print(len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].index))      
-        print('Count of accidents by vehicles per accident, after hours restriction:')
-        acc_veh_count = df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].groupby(['year','st_case']).size() # series that counts vehicles in each accident
-        acc_veh_count = acc_veh_count.rename('acc_veh_count')
-        print(acc_veh_count.value_counts())
-        print('Proportion of accidents with 3 or more drivers, after hours restriction:')
-        print(len(analytic_sample.merge(acc_veh_count.loc[acc_veh_count>=3],how='inner',on=['year','st_case']).index)/len(analytic_sample.index))
-        print('Proportion of drivers in accidents with 3 or more drivers, before hours restriction:')
-        print(len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.merge(acc_veh_count.loc[acc_veh_count>=3],how='inner',on=['year','st_case']).index)])/len(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)]))
+    if summary is not None:
+        summary['hours'] = _crash_summary(analytic_sample,sample_data)
         
     # implement restriction only keeping accidents that have 1 or 2 involved vehicles
-    analytic_sample['acc_veh_count'] = df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].groupby(['year','st_case']).size() # series that counts vehicles in each accident
+    analytic_sample['acc_veh_count'] = crash_rows(df_vehicle,veh_index,analytic_sample.index).groupby(['year','st_case']).size() # series that counts vehicles in each accident
     analytic_sample = analytic_sample.loc[analytic_sample['acc_veh_count']<=2]
-    if summarize_sample == True:    
-        print('Count of accidents after vehicle count sample restriction: ')
-        print(len(analytic_sample.index))
-        print('Count of drivers after vehicle count sample restriction: ')
-        tmp_driver = get_driver(df_person[df_person.index.droplevel(['veh_no','per_no']).isin(analytic_sample.index)])
-        print(len(tmp_driver.index))
-        print('Count and proportion of drivers with drinking==8 or drinking==9 after vehicle count sample restriction: ')
-        print(len(tmp_driver.loc[tmp_driver['drinking'].isin([8,9])]))
-        print(len(tmp_driver.loc[tmp_driver['drinking'].isin([8,9])])/len(tmp_driver))
-        print('Count of accidents by vehicles per accident, after vehicle count restriction:')
-        acc_veh_count = df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)].groupby(['year','st_case']).size() # series that counts vehicles in each accident
-        acc_veh_count = acc_veh_count.rename('acc_veh_count')
-        print(acc_veh_count.value_counts())
-        tmp_driver1 = tmp_driver.merge(acc_veh_count.loc[acc_veh_count==1],how='inner',on=['year','st_case'])
-        print('Proportion of one-vehicle crashes with driver lacking a police evaluation: ')
-        print(len(tmp_driver1.loc[tmp_driver1['drinking'].isin([8,9]) | tmp_driver1['drinking'].isnull()])/len(tmp_driver1))
-        print('Proportion of one-vehicle crashes with driver lacking a BAC test result: ')
-        print(len(tmp_driver1.loc[tmp_driver1['alcohol_test_result'].isnull()])/len(tmp_driver1))
-        print('Proportion of one-vehicle crashes with driver lacking a police evaluation and BAC test result: ')
-        print(len(tmp_driver1.loc[(tmp_driver1['drinking'].isin([8,9]) | tmp_driver1['drinking'].isnull()) & tmp_driver1['alcohol_test_result'].isnull()])/len(tmp_driver1))
-        tmp_driver2 = tmp_driver.merge(acc_veh_count.loc[acc_veh_count==2],how='inner',on=['year','st_case'])
-        print('Proportions of two-vehicle crashes with driver(s) lacking a police evaluation: ')
-        print((tmp_driver2['drinking'].isin([8,9]) | tmp_driver2['drinking'].isnull()).groupby(['year','st_case']).mean().value_counts()/len(tmp_driver2.groupby(['year','st_case']).mean()))
-        print('Proportions of two-vehicle crashes with driver(s) lacking a BAC test result: ')
-        print((tmp_driver2['alcohol_test_result'].isnull()).groupby(['year','st_case']).mean().value_counts()/len(tmp_driver2.groupby(['year','st_case']).mean()))       
-        print('Proportions of two-vehicle crashes with driver(s) lacking a police evaluation and a BAC test result: ')
-        print(((tmp_driver2['drinking'].isin([8,9]) | tmp_driver2['drinking'].isnull()) & tmp_driver2['alcohol_test_result'].isnull()).groupby(['year','st_case']).mean().value_counts()/len(tmp_driver2.groupby(['year','st_case']).mean()))
-        print('Proportion of all drivers involved in all fatal crashes lacking a police evaluation: ')
-        tmp_all_driver = get_driver(df_person)
-        print(len(tmp_all_driver.loc[tmp_all_driver['drinking'].isin([8,9]) | tmp_all_driver['drinking'].isnull()])/len(tmp_all_driver))        
-        if mireps == False: # can only obtain single driver BAC if not MI (and BAC is never missing for MI)
-            print('Count and proportion of drivers missing BAC test after vehicle count sample restriction: ')
-            tmp_driver['driver_bac'] = tmp_driver['alcohol_test_result']
-            print(len(tmp_driver.loc[tmp_driver['driver_bac'].isnull()]))
-            print(len(tmp_driver.loc[tmp_driver['driver_bac'].isnull()])/len(tmp_driver))
-            print('Cross-tabulation of police evaluation and BAC test result: ')
-            tmp_driver['bac_gt0_na'] = tmp_driver['driver_bac']
-            tmp_driver.loc[tmp_driver['bac_gt0_na']>0,'bac_gt0_na'] = 1
-            tmp_driver.loc[tmp_driver['bac_gt0_na'].isnull(),'bac_gt0_na'] = 2
-            print(pandas.crosstab(tmp_driver['bac_gt0_na'],tmp_driver['drinking'],margins=True))
-            print(pandas.crosstab(tmp_driver['bac_gt0_na'],tmp_driver['drinking'],margins=True).apply(lambda r: r/len(tmp_driver)))
-       
+    if summary is not None:
+        summary['vehicle_count'] = _vehicle_count_summary(analytic_sample,sample_data,mireps)
+    
+    return analytic_sample
+
+# the second stage of building an analytic sample from the first (see _base_analytic_sample): the restrictions that depend on the 
+# drinking definition, and the drink status and driver types of the remaining drivers. drink_status is the vehicles' drink status and 
+# whether it is missing, as returned by veh_dr_drinking_statuses
+def _restrict_analytic_sample(analytic_sample,sample_data,drink_status,driver_types,drinking_definition,bac_threshold,
+                              state_year_prop_threshold,mireps,summary,drop_below_threshold,acc_miss_flag=None):
+    (analytic_sample,df_acc_miss_flag,df_st_yr_prop_miss) = _missing_analytic_sample(analytic_sample,sample_data,drink_status,
+                                                                drinking_definition,bac_threshold,mireps,summary,acc_miss_flag)
+    
+    analytic_sample = _state_year_restriction(analytic_sample,df_st_yr_prop_miss,state_year_prop_threshold)
+    if summary is not None:
+        summary['state_year'] = {'accidents':len(analytic_sample.index)}
+    
+    return _complete_analytic_sample(analytic_sample,sample_data,drink_status,df_acc_miss_flag,driver_types,mireps,summary)
+
+# only keep accidents in state-years that have a proportion of missing data that is above the given threshold
+def _state_year_restriction(analytic_sample,df_st_yr_prop_miss,state_year_prop_threshold):
+    analytic_sample = analytic_sample.reset_index().set_index(['year','state']) # reset index in order to select by state and year
+    analytic_sample = analytic_sample[analytic_sample.index.isin(df_st_yr_prop_miss.loc[df_st_yr_prop_miss['miss_any']<=state_year_prop_threshold].index)]
+    return analytic_sample.reset_index().set_index(['year','st_case'])
+
+# the restrictions of _restrict_analytic_sample that come before the state-year missing data restriction, which doesn't depend on 
+# the threshold. Returns the restricted sample, whether each of its crashes has missing data, and the proportion of crashes with 
+# missing data in each state-year
+def _missing_analytic_sample(analytic_sample,sample_data,drink_status,drinking_definition,bac_threshold,mireps,summary,
+                             acc_miss_flag=None):
+    df_vehicle = sample_data['vehicle']
+    df_driver = sample_data['driver']
+    driver_index = sample_data['driver_index']
+    
     if (drinking_definition == 'impaired_vs_sober') & (mireps == False): # not applicable to MI
         # calculate how many are dropped according to the following supplemental analysis under definition 5:
         # page 1214, paragraph 2: "we exclude all crashes occurring in states that do not test at least 95 percent of those judged to have been drinking 
         # by the police in our sample in that year (regardless of whether the motorist in question was tested). This requirement excludes more than 80 percent 
         # of the fatal crashes in the sample."
-        tmp_driver_veh = get_driver(df_person[df_person.index.droplevel(['veh_no','per_no']).isin(analytic_sample.index)]).merge(df_vehicle,how='inner',on=['year','st_case','veh_no'])
+        tmp_driver_veh = crash_rows(df_driver,driver_index,analytic_sample.index).merge(df_vehicle,how='inner',on=['year','st_case','veh_no'])
         tmp_driver_veh['at_flag'] = numpy.nan
         tmp_driver_veh['driver_bac'] = tmp_driver_veh['alcohol_test_result']
         tmp_driver_veh['at_flag'].loc[(tmp_driver_veh['dr_drink'] == 1) & (tmp_driver_veh['driver_bac'].isnull())] = 0
@@ -259,104 +624,358 @@ def get_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,d
         df_st_yr_prop_at = df_acc_at_flag[['at_flag']].groupby(['year','state']).mean()
         df_st_yr_prop_at['at_flag_prop'] = df_st_yr_prop_at['at_flag']
         analytic_sample = analytic_sample.reset_index().set_index(['year','state']) # reset index in order to select by state and year
-        if summarize_sample == True:  
-            print('Proportion of crashes occurring in states that do not test at least 95 percent of those judged to have been drinking: ')
-            print(len(analytic_sample[analytic_sample.index.isin(df_st_yr_prop_at.loc[df_st_yr_prop_at['at_flag_prop']<0.95].index)])/len(analytic_sample)) 
+        if summary is not None:
+            summary['tested_states'] = {'prop_accidents_untested':len(analytic_sample[analytic_sample.index.isin(df_st_yr_prop_at.loc[df_st_yr_prop_at['at_flag_prop']<0.95].index)])/len(analytic_sample)}
         analytic_sample = analytic_sample[analytic_sample.index.isin(df_st_yr_prop_at.loc[df_st_yr_prop_at['at_flag_prop']>=0.95].index)]
         analytic_sample = analytic_sample.reset_index().set_index(['year','st_case'])
         
-    # get dataframe of booleans indicating whether each variable has missing data (or all of them are missing)
-    df_acc_miss_flag = accident_missing_data(analytic_sample, df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)],
-                                             get_driver(df_person[df_person.index.droplevel(['veh_no','per_no']).isin(analytic_sample.index)]),
-                                             drinking_definition, bac_threshold, mireps)
-    if summarize_sample == True:    
-        print('Proportion of accidents missing information about various and any characteristics:')
-        print(df_acc_miss_flag.mean())
-    
-    # only keep accidents in state-years that have a proportion of missing data that is above the given threshold
+    # get dataframe of booleans indicating whether each variable has missing data (or all of them are missing), or select it from 
+    # acc_miss_flag if already identified for a set of crashes that includes the sample
+    if acc_miss_flag is None:
+        df_acc_miss_flag = _sample_missing_data(analytic_sample,sample_data,drink_status,drinking_definition,bac_threshold,mireps)
+    else:
+        df_acc_miss_flag = acc_miss_flag[keys_isin(row_keys(acc_miss_flag.index),row_keys(analytic_sample.index))]
+    if summary is not None:
+        summary['missing_data'] = {'prop_accidents_missing':df_acc_miss_flag.mean()}
+    
+    # proportion of accidents with missing data in each state-year
     df_acc_miss_flag_plus = analytic_sample[['state']].merge(df_acc_miss_flag,how='inner',on=['year','st_case'])
     df_st_yr_prop_miss = df_acc_miss_flag_plus[['state','miss_any']].groupby(['year','state']).mean()
-    analytic_sample = analytic_sample.reset_index().set_index(['year','state']) # reset index in order to select by state and year
-    analytic_sample = analytic_sample[analytic_sample.index.isin(df_st_yr_prop_miss.loc[df_st_yr_prop_miss['miss_any']<=state_year_prop_threshold].index)]
-    analytic_sample = analytic_sample.reset_index().set_index(['year','st_case'])
-    if summarize_sample == True:    
-        print('Count of accidents after state-year missing proportion sample restriction: ')
-        print(len(analytic_sample.index))
+    
+    return (analytic_sample,df_acc_miss_flag,df_st_yr_prop_miss)
 
+# the restrictions of _restrict_analytic_sample that come after the state-year missing data restriction: drops the crashes with 
+# missing data, and adds the weekend indicator and the drink status and driver types of the drivers
+def _complete_analytic_sample(analytic_sample,sample_data,drink_status,df_acc_miss_flag,driver_types,mireps,summary):
+    veh_index = sample_data['veh_index']
+    df_drink_status = drink_status[0]
+    
     # only keep remaining accidents that don't have missing data
-    analytic_sample = analytic_sample[analytic_sample.index.isin(df_acc_miss_flag.loc[df_acc_miss_flag['miss_any']==False].index)]
-    if summarize_sample == True:    
-        print('Count of accidents after missing data sample restriction: ')
-        print(len(analytic_sample.index))
-
-    # generate statistics for Table 4 of replication
-    if summarize_sample == True:    
-        print('Count of one- and two-car accidents: ')
-        print(analytic_sample['acc_veh_count'].value_counts())
-        tmp_driver = get_driver(df_person[df_person.index.droplevel(['veh_no','per_no']).isin(analytic_sample.index)])
-        tmp_vehicle = df_vehicle[df_vehicle.index.isin(tmp_driver.index)]
-        tmp_driver_veh = get_driver(df_person[df_person.index.droplevel(['veh_no','per_no']).isin(analytic_sample.index)]).merge(df_vehicle,how='inner',on=['year','st_case','veh_no'])        
-        if mireps == False:
-            tmp_driver_veh['drink_status'] = veh_dr_drinking_status(tmp_vehicle, tmp_driver, drinking_definition, bac_threshold, mireps, drop_below_threshold)
-        else:
-            # Note that "drink_status" here is the mean across multiply imputed values for MI
-            tmp_driver_veh['drink_status'] = veh_dr_drinking_status(tmp_vehicle, tmp_driver, drinking_definition, bac_threshold, mireps, drop_below_threshold).mean(axis='columns')
-        tmp_driver_veh['male'] = tmp_driver_veh['sex']==1
-        tmp_driver_veh['age_lt25'] = tmp_driver_veh['age'] < 25        
-        tmp_driver_veh['minor_blemishes'] = tmp_driver_veh['prev_acc'] + tmp_driver_veh['prev_spd'] + tmp_driver_veh['prev_oth']
-        tmp_driver_veh['major_blemishes'] = tmp_driver_veh['prev_sus'] + tmp_driver_veh['prev_dwi']
-        tmp_driver_veh['bad_record'] = (tmp_driver_veh['minor_blemishes']>=2) | (tmp_driver_veh['major_blemishes']>=1)
-        tmp_driver_veh['male_and_drinking'] = (tmp_driver_veh['male']==1) & (tmp_driver_veh['drink_status']==1)
-        tmp_driver_veh['age_lt25_and_drinking'] = (tmp_driver_veh['age_lt25']==1) & (tmp_driver_veh['drink_status']==1)
-        tmp_driver_veh['bad_record_and_drinking'] = (tmp_driver_veh['bad_record']==1) & (tmp_driver_veh['drink_status']==1)
-        print('Proportions of all drivers in fatal crashes: ')
-        print(tmp_driver_veh[['drink_status','male','age_lt25','bad_record','male_and_drinking',
-                              'age_lt25_and_drinking','bad_record_and_drinking']].mean())
-        print('Percentage of fatal one-car crashes with zero or one drinking driver: ')
-        print(tmp_driver_veh[tmp_driver_veh.index.droplevel('veh_no').isin(analytic_sample.loc[analytic_sample['acc_veh_count']==1].index)]['drink_status'].groupby(['year','st_case']).mean().value_counts()/len(analytic_sample.loc[analytic_sample['acc_veh_count']==1]))
-        print('Percentage of fatal two-car crashes with zero, one, or two drinking drivers: ')
-        print(tmp_driver_veh[tmp_driver_veh.index.droplevel('veh_no').isin(analytic_sample.loc[analytic_sample['acc_veh_count']==2].index)]['drink_status'].groupby(['year','st_case']).mean().value_counts()/len(analytic_sample.loc[analytic_sample['acc_veh_count']==2]))
+    analytic_sample = analytic_sample[keys_isin(row_keys(analytic_sample.index),row_keys(df_acc_miss_flag.loc[df_acc_miss_flag['miss_any']==False].index))]
+    if summary is not None:
+        # generate statistics for Table 4 of replication
+        summary['complete'] = {'accidents':len(analytic_sample.index)}
+        summary['complete'].update(_driver_summary(analytic_sample,sample_data,df_drink_status,mireps))
     
     # generate weekend variable
     analytic_sample['weekend'] = ((analytic_sample['day_week'] == 6) & (analytic_sample['hour'] >= 20)) | (analytic_sample['day_week'] == 7) | ((analytic_sample['day_week'] == 1) & (analytic_sample['hour'] <= 4))
-    if summarize_sample == True:    
-        print('Count of weekdays vs weekend days: ')
-        print(analytic_sample['weekend'].value_counts())
+    if summary is not None:
+        summary['complete']['weekend'] = analytic_sample['weekend'].value_counts()
         
     # now merge in driver-level drink_status, to be available for building the estimation sample
-    df_acc_drink_count = veh_dr_drinking_status(df_vehicle[df_vehicle.index.droplevel('veh_no').isin(analytic_sample.index)], 
-                                             get_driver(df_person[df_person.index.droplevel(['veh_no','per_no']).isin(analytic_sample.index)]), 
-                                             drinking_definition, bac_threshold, mireps, drop_below_threshold)
+    df_acc_drink_count = crash_rows(df_drink_status,veh_index,analytic_sample.index)
     analytic_sample = analytic_sample.merge(df_acc_drink_count.reset_index().set_index(['year','st_case']),how='left',on=['year','st_case'])
     analytic_sample = analytic_sample.reset_index().set_index(['year','st_case','veh_no'])    
     
     # code driver types as types 1 & 2 in the two-type case, or 1, 2, 3, & 4 in the four-type case
     if mireps==False:
-        dt_num = 1
-        for dt in driver_types: # loop over driver type definitions
-            dt_bool = True
-            for dtc in dt: # loop over each criterion for each definition
-                if dtc=='sober':
-                    dt_bool = dt_bool & (analytic_sample['drink_status']==0)
-                elif dtc=='drinking':
-                    dt_bool = dt_bool & (analytic_sample['drink_status']==1)
-            analytic_sample.loc[dt_bool,'driver_type'] = dt_num
-            dt_num+=1
+        analytic_sample['driver_type'] = driver_type_array(analytic_sample[['drink_status']].to_numpy(dtype=float),driver_types)[:,0]
     else:
-        for mirep in range(0,mireps):           
-            analytic_sample['driver_type'+str(mirep+1)] = numpy.nan
-    
-            dt_num = 1
-            for dt in driver_types: # loop over driver type definitions
-                dt_bool = True
-                for dtc in dt: # loop over each criterion for each definition
-                    if dtc=='sober':
-                        dt_bool = dt_bool & (analytic_sample['drink_status'+str(mirep+1)]==0)
-                    elif dtc=='drinking':
-                        dt_bool = dt_bool & (analytic_sample['drink_status'+str(mirep+1)]==1)
-                analytic_sample.loc[dt_bool,'driver_type'+str(mirep+1)] = dt_num
-                dt_num+=1
-        
-    end = time.time()
-    print("Time to build analytic sample: " + str(end-start))
-    return analytic_sample
\ No newline at end of file
+        driver_type = driver_type_array(analytic_sample[['drink_status' + str(mirep+1) for mirep in range(0,mireps)]].to_numpy(dtype=float),driver_types)
+        for mirep in range(0,mireps):
+            analytic_sample['driver_type'+str(mirep+1)] = driver_type[:,mirep]
+    
+    return analytic_sample
+
+# identifies the missing data (see accident_missing_data) in the crashes of an analytic sample
+def _sample_missing_data(analytic_sample,sample_data,drink_status,drinking_definition,bac_threshold,mireps):
+    df_vehicle = sample_data['vehicle']
+    veh_index = sample_data['veh_index']
+    return accident_missing_data(analytic_sample, crash_rows(df_vehicle,veh_index,analytic_sample.index),
+                                 crash_rows(sample_data['driver'],sample_data['driver_index'],analytic_sample.index),
+                                 drinking_definition, bac_threshold, mireps,
+                                 veh_drink_status_missing=crash_rows(drink_status[1],veh_index,analytic_sample.index))
+
+# SAMPLE SUMMARY STATISTICS
+# The statistics reported for the analytic sample (including those for Tables 1, 2, 4, and 5 of the replication) are collected while 
+# building the sample only if requested, as a dictionary keyed by restriction stage of dictionaries of named statistics: 'all' (all 
+# of the data), 'years', 'complete_drivers', 'hours', 'vehicle_count', 'tested_states' (impaired_vs_sober only), 'missing_data', 
+# 'state_year', and 'complete'. The statistics of each stage are calculated from one set of aggregations of its crashes and drivers. 
+# print_sample_summary reports them as labelled in _summary_labels
+
+# the statistics that describe all of the extracted data rather than a sample (the counts of all accidents, vehicles, and drivers, 
+# and the proportion of all drivers lacking a police evaluation), calculated one year at a time from the extracted datasets (all 
+# extracted years if year_range is None), so that the full person dataset is never loaded. Returns them as a summary, which 
+# replaces those of a sample's summary (built from only the loaded years) in update_all_data_summary
+def summarize_all_data(year_range=None,data_folder=DATA_FOLDER):
+    years = dataset_years('accident',data_folder) if year_range is None else range(year_range[0],year_range[1]+1)
+    accidents = vehicles = drivers = drivers_no_police_eval = 0
+    for yr in years:
+        accidents += len(load_dataset('accident',(yr,yr),[],data_folder).index)
+        vehicles += len(load_dataset('vehicle',(yr,yr),[],data_folder).index)
+        df_driver = get_driver(load_dataset('person',(yr,yr),['seat_pos','drinking'],data_folder))
+        drivers += len(df_driver)
+        drivers_no_police_eval += int((df_driver['drinking'].isin([8,9]) | df_driver['drinking'].isnull()).sum())
+    return {'all':{'accidents':accidents,'vehicles':vehicles,'drivers':drivers},
+            'vehicle_count':{'prop_all_drivers_no_police_eval':drivers_no_police_eval/drivers}}
+
+# replaces the statistics of a sample's summary that describe all of the data with those of all_data_summary (see summarize_all_data)
+def update_all_data_summary(summary,all_data_summary):
+    for (stage,stats) in all_data_summary.items():
+        if stage in summary:
+            summary[stage].update(stats)
+    return summary
+
+# the statistics of a stage from its crashes and their vehicles, with the vehicles counted once per crash
+def _crash_summary(analytic_sample,sample_data):
+    veh_rows = crash_rows(sample_data['vehicle'],sample_data['veh_index'],analytic_sample.index)
+    acc_veh_count = veh_rows.groupby(['year','st_case']).size().rename('acc_veh_count') # series that counts vehicles in each accident
+    missing_hour = analytic_sample['hour'].isnull().to_numpy()
+    return {'accidents':len(analytic_sample.index),
+            'vehicles':len(veh_rows.index),
+            'accidents_missing_hour':int(missing_hour.sum()),
+            'vehicles_missing_hour':int(keys_isin(row_keys(veh_rows.index),row_keys(analytic_sample.index[missing_hour])).sum()),
+            'vehicles_per_accident':acc_veh_count.value_counts(),
+            'prop_accidents_3plus':int((acc_veh_count>=3).sum())/len(analytic_sample.index),
+            'prop_drivers_3plus':int(acc_veh_count[acc_veh_count>=3].sum())/len(veh_rows.index)}
+
+# the statistics of the stage after the vehicle count restriction, which add those of the drivers' police evaluations and BAC tests
+def _vehicle_count_summary(analytic_sample,sample_data,mireps):
+    stats = _crash_summary(analytic_sample,sample_data)
+    df_driver = sample_data['driver']
+    tmp_driver = crash_rows(df_driver,sample_data['driver_index'],analytic_sample.index)
+    no_police_eval = tmp_driver['drinking'].isin([8,9]) | tmp_driver['drinking'].isnull()
+    no_bac_test = tmp_driver['alcohol_test_result'].isnull()
+    stats['drivers'] = len(tmp_driver.index)
+    stats['drivers_drinking_unknown'] = int(tmp_driver['drinking'].isin([8,9]).sum())
+    stats['prop_drivers_drinking_unknown'] = stats['drivers_drinking_unknown']/len(tmp_driver.index)
+    
+    # drivers in one- and two-vehicle crashes
+    driver_keys = row_keys(tmp_driver.index)
+    one_car = keys_isin(driver_keys,row_keys(analytic_sample.index[analytic_sample['acc_veh_count']==1]))
+    two_car = keys_isin(driver_keys,row_keys(analytic_sample.index[analytic_sample['acc_veh_count']==2]))
+    stats['prop_one_car_no_police_eval'] = int(no_police_eval[one_car].sum())/int(one_car.sum())
+    stats['prop_one_car_no_bac_test'] = int(no_bac_test[one_car].sum())/int(one_car.sum())
+    stats['prop_one_car_no_police_eval_and_bac_test'] = int((no_police_eval & no_bac_test)[one_car].sum())/int(one_car.sum())
+    num_two_car = tmp_driver[two_car].groupby(['year','st_case']).ngroups
+    stats['props_two_car_no_police_eval'] = no_police_eval[two_car].groupby(['year','st_case']).mean().value_counts()/num_two_car
+    stats['props_two_car_no_bac_test'] = no_bac_test[two_car].groupby(['year','st_case']).mean().value_counts()/num_two_car
+    stats['props_two_car_no_police_eval_and_bac_test'] = (no_police_eval & no_bac_test)[two_car].groupby(['year','st_case']).mean().value_counts()/num_two_car
+    stats['prop_all_drivers_no_police_eval'] = sample_data['all_drivers']['drivers_no_police_eval']/sample_data['all_drivers']['drivers']
+    
+    if mireps == False: # can only obtain single driver BAC if not MI (and BAC is never missing for MI)
+        stats['drivers_missing_bac'] = int(no_bac_test.sum())
+        stats['prop_drivers_missing_bac'] = stats['drivers_missing_bac']/len(tmp_driver.index)
+        bac_gt0_na = tmp_driver['alcohol_test_result'].rename('bac_gt0_na')
+        bac_gt0_na.loc[bac_gt0_na>0] = 1
+        bac_gt0_na.loc[bac_gt0_na.isnull()] = 2
+        stats['bac_by_police_eval'] = pandas.crosstab(bac_gt0_na,tmp_driver['drinking'],margins=True)
+        stats['prop_bac_by_police_eval'] = stats['bac_by_police_eval']/len(tmp_driver.index)
+    return stats
+
+# the statistics of the drivers in the completed sample (Table 4 of the replication), given the vehicles' drink status
+def _driver_summary(analytic_sample,sample_data,df_drink_status,mireps):
+    tmp_driver_veh = crash_rows(sample_data['driver'],sample_data['driver_index'],analytic_sample.index).merge(sample_data['vehicle'],how='inner',on=['year','st_case','veh_no'])        
+    if mireps == False:
+        tmp_driver_veh['drink_status'] = crash_rows(df_drink_status,sample_data['veh_index'],analytic_sample.index)
+    else:
+        # Note that "drink_status" here is the mean across multiply imputed values for MI
+        tmp_driver_veh['drink_status'] = crash_rows(df_drink_status,sample_data['veh_index'],analytic_sample.index).mean(axis='columns')
+    tmp_driver_veh['male'] = tmp_driver_veh['sex']==1
+    tmp_driver_veh['age_lt25'] = tmp_driver_veh['age'] < 25        
+    tmp_driver_veh['minor_blemishes'] = tmp_driver_veh['prev_acc'] + tmp_driver_veh['prev_spd'] + tmp_driver_veh['prev_oth']
+    tmp_driver_veh['major_blemishes'] = tmp_driver_veh['prev_sus'] + tmp_driver_veh['prev_dwi']
+    tmp_driver_veh['bad_record'] = (tmp_driver_veh['minor_blemishes']>=2) | (tmp_driver_veh['major_blemishes']>=1)
+    tmp_driver_veh['male_and_drinking'] = (tmp_driver_veh['male']==1) & (tmp_driver_veh['drink_status']==1)
+    tmp_driver_veh['age_lt25_and_drinking'] = (tmp_driver_veh['age_lt25']==1) & (tmp_driver_veh['drink_status']==1)
+    tmp_driver_veh['bad_record_and_drinking'] = (tmp_driver_veh['bad_record']==1) & (tmp_driver_veh['drink_status']==1)
+    
+    # share of drinking drivers in each one- and two-car crash
+    driver_keys = row_keys(tmp_driver_veh.index)
+    one_car = analytic_sample.index[analytic_sample['acc_veh_count']==1]
+    two_car = analytic_sample.index[analytic_sample['acc_veh_count']==2]
+    return {'accidents_by_vehicle_count':analytic_sample['acc_veh_count'].value_counts(),
+            'driver_proportions':tmp_driver_veh[['drink_status','male','age_lt25','bad_record','male_and_drinking',
+                                                 'age_lt25_and_drinking','bad_record_and_drinking']].mean(),
+            'one_car_drinking_drivers':tmp_driver_veh[keys_isin(driver_keys,row_keys(one_car))]['drink_status'].groupby(['year','st_case']).mean().value_counts()/len(one_car),
+            'two_car_drinking_drivers':tmp_driver_veh[keys_isin(driver_keys,row_keys(two_car))]['drink_status'].groupby(['year','st_case']).mean().value_counts()/len(two_car)}
+
+# the label of each summary statistic, as (stage, statistic, label), in the order in which they are reported. Statistics without a 
+# label are reported directly after the previous one
+_summary_labels = [('all','accidents','Count of all accidents: '),
+                   ('all','vehicles','Count of all vehicles: '),
+                   ('all','drivers','Count of all drivers: '),
+                   ('years','accidents','Count of accidents after year sample restriction: '),
+                   ('years','vehicles','Count of vehicles after year sample restriction: '),
+                   ('complete_drivers','accidents','Count of accidents after excluding accidents with no recorded drivers: '),
+                   ('complete_drivers','vehicles','Count of vehicles after excluding accidents with no recorded drivers: '),
+                   ('complete_drivers','accidents_missing_hour','Count of accidents with missing hours: '),
+                   ('complete_drivers','vehicles_missing_hour','Count of vehicles with missing hours: '),
+                   ('complete_drivers','vehicles_per_accident','Count of accidents by vehicles per accident, before hours restriction:'),
+                   ('complete_drivers','prop_accidents_3plus','Proportion of accidents with 3 or more drivers, before hours restriction:'),
+                   ('complete_drivers','prop_drivers_3plus','Proportion of drivers in accidents with 3 or more drivers, before hours restriction:'),
+                   ('hours','accidents','Count of accidents after hour sample restriction: '),
+                   ('hours','vehicles','Count of vehicles after hour sample restriction: '),
+                   ('hours','vehicles_per_accident','Count of accidents by vehicles per accident, after hours restriction:'),
+                   ('hours','prop_accidents_3plus','Proportion of accidents with 3 or more drivers, after hours restriction:'),
+                   ('hours','prop_drivers_3plus','Proportion of drivers in accidents with 3 or more drivers, before hours restriction:'),
+                   ('vehicle_count','accidents','Count of accidents after vehicle count sample restriction: '),
+                   ('vehicle_count','drivers','Count of drivers after vehicle count sample restriction: '),
+                   ('vehicle_count','drivers_drinking_unknown','Count and proportion of drivers with drinking==8 or drinking==9 after vehicle count sample restriction: '),
+                   ('vehicle_count','prop_drivers_drinking_unknown',None),
+                   ('vehicle_count','vehicles_per_accident','Count of accidents by vehicles per accident, after vehicle count restriction:'),
+                   ('vehicle_count','prop_one_car_no_police_eval','Proportion of one-vehicle crashes with driver lacking a police evaluation: '),
+                   ('vehicle_count','prop_one_car_no_bac_test','Proportion of one-vehicle crashes with driver lacking a BAC test result: '),
+                   ('vehicle_count','prop_one_car_no_police_eval_and_bac_test','Proportion of one-vehicle crashes with driver lacking a police evaluation and BAC test result: '),
+                   ('vehicle_count','props_two_car_no_police_eval','Proportions of two-vehicle crashes with driver(s) lacking a police evaluation: '),
+                   ('vehicle_count','props_two_car_no_bac_test','Proportions of two-vehicle crashes with driver(s) lacking a BAC test result: '),
+                   ('vehicle_count','props_two_car_no_police_eval_and_bac_test','Proportions of two-vehicle crashes with driver(s) lacking a police evaluation and a BAC test result: '),
+                   ('vehicle_count','prop_all_drivers_no_police_eval','Proportion of all drivers involved in all fatal crashes lacking a police evaluation: '),
+                   ('vehicle_count','drivers_missing_bac','Count and proportion of drivers missing BAC test after vehicle count sample restriction: '),
+                   ('vehicle_count','prop_drivers_missing_bac',None),
+                   ('vehicle_count','bac_by_police_eval','Cross-tabulation of police evaluation and BAC test result: '),
+                   ('vehicle_count','prop_bac_by_police_eval',None),
+                   ('tested_states','prop_accidents_untested','Proportion of crashes occurring in states that do not test at least 95 percent of those judged to have been drinking: '),
+                   ('missing_data','prop_accidents_missing','Proportion of accidents missing information about various and any characteristics:'),
+                   ('state_year','accidents','Count of accidents after state-year missing proportion sample restriction: '),
+                   ('complete','accidents','Count of accidents after missing data sample restriction: '),
+                   ('complete','accidents_by_vehicle_count','Count of one- and two-car accidents: '),
+                   ('complete','driver_proportions','Proportions of all drivers in fatal crashes: '),
+                   ('complete','one_car_drinking_drivers','Percentage of fatal one-car crashes with zero or one drinking driver: '),
+                   ('complete','two_car_drinking_drivers','Percentage of fatal two-car crashes with zero, one, or two drinking drivers: '),
+                   ('complete','weekend','Count of weekdays vs weekend days: ')]
+
+# reports the summary statistics of an analytic sample (see summarize_analytic_sample)
+def print_sample_summary(summary):
+    for (stage,stat,label) in _summary_labels:
+        if (stage in summary) and (stat in summary[stage]):
+            if label is not None:
+                print(label)
+            print(summary[stage][stat])
+
+# CACHING OF ANALYTIC SAMPLES
+# get_analytic_sample_cached memoizes get_analytic_sample, keyed by a fingerprint of the input dataframes and all of the sample 
+# parameters. Recently used samples are kept in memory, and all samples are written to a columnar (parquet) store in cache_dir, 
+# so that repeated runs of the replication load them rather than rebuilding them. Increment ANALYTIC_SAMPLE_CACHE_VERSION whenever 
+# the sample construction changes, so that previously cached samples are no longer used. The cache files are named by the version 
+# and the data fingerprint, and writing a sample removes the files of any other version or fingerprint, so cache_dir only holds 
+# samples of the current data
+ANALYTIC_SAMPLE_CACHE_VERSION = 2
+ANALYTIC_SAMPLE_CACHE_DIR = os.path.join('replication','cache')
+ANALYTIC_SAMPLE_LRU_SIZE = 8
+_analytic_sample_lru = collections.OrderedDict()
+
+# returns a fingerprint of the contents of the accident, vehicle, and person dataframes. This changes whenever the extracted data 
+# change, which invalidates any cached samples. Calculate once after loading the data, and pass to get_analytic_sample_cached
+def data_fingerprint(df_accident,df_vehicle,df_person):
+    fingerprint = hashlib.sha256()
+    for df in [df_accident,df_vehicle,df_person]:
+        fingerprint.update(str(list(df.index.names)+list(df.columns)+list(df.dtypes.astype(str))).encode())
+        fingerprint.update(pandas.util.hash_pandas_object(df,index=True).to_numpy().tobytes())
+    return fingerprint.hexdigest()
+
+# the key for a cached analytic sample, from the data fingerprint and the sample parameters
+def _analytic_sample_key(fingerprint,year_range,hour_range,driver_types,drinking_definition,bac_threshold,state_year_prop_threshold,
+                         mireps,drop_below_threshold):
+    params = [ANALYTIC_SAMPLE_CACHE_VERSION,fingerprint,list(year_range),list(hour_range),driver_types,drinking_definition,
+              float(bac_threshold),float(state_year_prop_threshold),mireps,drop_below_threshold]
+    return hashlib.sha256(repr(params).encode()).hexdigest()
+
+# as get_analytic_sample, but returns a cached sample if one was previously built from the same data and parameters. The data 
+# fingerprint is calculated here if not provided. If cache_dir is None, samples are only cached in memory. Samples are always rebuilt 
+# (and then cached) when summarize_sample is True, because the summary statistics are generated while building the sample
+def get_analytic_sample_cached(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                               drinking_definition,bac_threshold,state_year_prop_threshold,
+                               mireps=False,summarize_sample=True,drop_below_threshold=True,
+                               fingerprint=None,cache_dir=ANALYTIC_SAMPLE_CACHE_DIR):
+    if fingerprint is None:
+        fingerprint = data_fingerprint(df_accident,df_vehicle,df_person)
+    key = _analytic_sample_key(fingerprint,year_range,hour_range,driver_types,drinking_definition,bac_threshold,
+                               state_year_prop_threshold,mireps,drop_below_threshold)
+    
+    analytic_sample = None
+    if summarize_sample == False:
+        analytic_sample = _load_cached_analytic_sample(key,fingerprint,cache_dir)
+    if analytic_sample is None:
+        analytic_sample = get_analytic_sample(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                                              drinking_definition,bac_threshold,state_year_prop_threshold,
+                                              mireps,summarize_sample,drop_below_threshold)
+        _store_cached_analytic_sample(key,analytic_sample,fingerprint,cache_dir)
+    _remember_analytic_sample(key,analytic_sample)
+    
+    return analytic_sample.copy()
+
+# as get_analytic_samples, but returns cached samples for the drinking definitions with previously built samples, and builds the 
+# samples for the others together (see get_analytic_sample_cached)
+def get_analytic_samples_cached(df_accident,df_vehicle,df_person,year_range,hour_range,driver_types, 
+                                definitions,state_year_prop_threshold,mireps=False,drop_below_threshold=True,
+                                fingerprint=None,cache_dir=ANALYTIC_SAMPLE_CACHE_DIR):
+    return get_analytic_sample_sweep_cached(df_accident,df_vehicle,df_person,[(year_range,hour_range)],driver_types,definitions,
+                                            state_year_prop_threshold,mireps,drop_below_threshold,
+                                            fingerprint,cache_dir)[(tuple(year_range),tuple(hour_range))]
+
+# as get_analytic_sample_sweep, but returns cached samples for the ranges and drinking definitions with previously built samples, 
+# and builds the samples for the others together (see get_analytic_sample_cached)
+def get_analytic_sample_sweep_cached(df_accident,df_vehicle,df_person,ranges,driver_types, 
+                                     definitions,state_year_prop_threshold,mireps=False,drop_below_threshold=True,
+                                     fingerprint=None,cache_dir=ANALYTIC_SAMPLE_CACHE_DIR):
+    if fingerprint is None:
+        fingerprint = data_fingerprint(df_accident,df_vehicle,df_person)
+    ranges = [(tuple(year_range),tuple(hour_range)) for (year_range,hour_range) in ranges]
+    keys = {(sample_range,definition):_analytic_sample_key(fingerprint,sample_range[0],sample_range[1],driver_types,definition[0],
+                                                           definition[1],state_year_prop_threshold,mireps,drop_below_threshold) 
+            for sample_range in ranges for definition in definitions}
+    
+    analytic_samples = {sample_key:_load_cached_analytic_sample(key,fingerprint,cache_dir) for (sample_key,key) in keys.items()}
+    build = [sample_key for sample_key in keys if analytic_samples[sample_key] is None]
+    if len(build) > 0: # builds every missing definition for every range with any missing definitions
+        ranges_build = [sample_range for sample_range in ranges if any(sample_key[0] == sample_range for sample_key in build)]
+        definitions_build = [definition for definition in definitions if any(sample_key[1] == definition for sample_key in build)]
+        built_samples = get_analytic_sample_sweep(df_accident,df_vehicle,df_person,ranges_build,driver_types,definitions_build,
+                                                  state_year_prop_threshold,mireps,drop_below_threshold)
+        for sample_key in build:
+            analytic_samples[sample_key] = built_samples[sample_key[0]][sample_key[1]]
+            _store_cached_analytic_sample(keys[sample_key],analytic_samples[sample_key],fingerprint,cache_dir)
+    for (sample_key,key) in keys.items():
+        _remember_analytic_sample(key,analytic_samples[sample_key])
+    
+    return {sample_range:{definition:analytic_samples[(sample_range,definition)].copy() for definition in definitions} for sample_range in ranges}
+
+# the prefix of the names of the cache files of the current version and data fingerprint
+def _cache_file_prefix(fingerprint):
+    return 'analytic_sample_v' + str(ANALYTIC_SAMPLE_CACHE_VERSION) + '_' + fingerprint[:16] + '_'
+
+# returns a cached analytic sample, from memory or from cache_dir, or None if it is not cached
+def _load_cached_analytic_sample(key,fingerprint,cache_dir):
+    if key in _analytic_sample_lru:
+        _analytic_sample_lru.move_to_end(key)
+        print("Loaded the analytic sample from the in-memory cache.")
+        return _analytic_sample_lru[key]
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir,_cache_file_prefix(fingerprint) + key + '.parquet')
+        if os.path.exists(cache_file):
+            print("Loaded the analytic sample from " + cache_file + ".")
+            return pandas.read_parquet(cache_file)
+    return None
+
+# writes an analytic sample to cache_dir, if not None, and removes the stale cache files of other versions or data fingerprints
+def _store_cached_analytic_sample(key,analytic_sample,fingerprint,cache_dir):
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir,_cache_file_prefix(fingerprint) + key + '.parquet')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        analytic_sample.to_parquet(cache_file + '.tmp')
+        os.replace(cache_file + '.tmp',cache_file) # only complete files are ever read from the cache
+        for stale_file in os.listdir(cache_dir):
+            if stale_file.startswith('analytic_sample_') and not stale_file.startswith(_cache_file_prefix(fingerprint)):
+                try:
+                    os.remove(os.path.join(cache_dir,stale_file))
+                except FileNotFoundError: # already removed by another process
+                    pass
+
+# keeps an analytic sample in the in-memory cache, dropping the least recently used samples
+def _remember_analytic_sample(key,analytic_sample):
+    _analytic_sample_lru[key] = analytic_sample
+    _analytic_sample_lru.move_to_end(key)
+    while len(_analytic_sample_lru) > ANALYTIC_SAMPLE_LRU_SIZE:
+        _analytic_sample_lru.popitem(last=False)
+
+# removes all cached analytic samples, from memory and from cache_dir. Use this to force samples to be rebuilt, e.g. after changing 
+# the extracted data without changing the data fingerprint passed to get_analytic_sample_cached (stale samples of other versions or 
+# fingerprints are removed whenever a sample is written)
+def clear_analytic_sample_cache(cache_dir=ANALYTIC_SAMPLE_CACHE_DIR):
+    _analytic_sample_lru.clear()
+    if (cache_dir is not None) and os.path.exists(cache_dir):
+        for cache_file in os.listdir(cache_dir):
+            if cache_file.startswith('analytic_sample_'):
+                os.remove(os.path.join(cache_dir,cache_file))
@@ -5,11 +5,13 @@ Created on Tue May  7 09:52:37 2019
 @author: Nathan Tefft
 
 This script connects to the NHTSA's FTP server and retrieves the annual zip files containing the FARS data. The files are stored in a 
-data folder for later extraction.
+data folder for later extraction. Years are downloaded concurrently over a small pool of FTP connections. Interrupted downloads are
+resumed, and each file is verified before it replaces the previous download.
 """
 
 # import necessary packages
-import ftplib, os
+import concurrent.futures, ftplib, os, zipfile
+from replication import util
 
 """
    USER-DEFINED ATTRIBUTES 
@@ -28,22 +30,128 @@ import ftplib, os
 firstYear = 1975
 latestYear = 2017
 
-""" Retrieval Script """
+# FTP server, number of concurrent connections, and number of attempts at each file before giving up
+ftp_host = 'ftp.nhtsa.dot.gov'
+ftp_port = 21
+retrieve_jobs = 4
+max_attempts = 5
 
-# connect to NHTSA's FTP server
-ftp = ftplib.FTP('ftp.nhtsa.dot.gov')
-ftp.login()
+# the manifest records, for each retrieved year, the remote file's size and modification time and the local file's hash. 
+# Years whose remote size and modification time match the manifest are not re-fetched. If the server does not report modification 
+# times, years whose remote size matches the manifest and whose local file still has the recorded hash are not re-fetched
+manifest_file = os.path.join('data','retrieve_manifest.json')
 
-# retrieve each annual zipped files and store them in the data folder 
-for yr in range(firstYear,latestYear+1):
-    print("Retrieving data for " + str(yr) + ".")
-    filenameLocal = 'data\\FARS' + str(yr) + '.zip'
-    if not os.path.exists(os.path.dirname(filenameLocal)):
-        os.makedirs(os.path.dirname(filenameLocal))
-    
-    ftp.cwd('\\fars\\' + str(yr) + '\\National')
-    fileLocal = open(filenameLocal, 'wb')
-    ftp.retrbinary('RETR FARS' + str(yr) + 'NationalCSV.zip', fileLocal.write)
-    fileLocal.close()
-    
-print("Retrieval of FARS data from " + str(firstYear) + " to " + str(latestYear) + " successfully completed.")
\ No newline at end of file
+# the remote directory and name of a year's zip file
+def remote_file(yr):
+    return ('/fars/' + str(yr) + '/National', 'FARS' + str(yr) + 'NationalCSV.zip')
+
+# the local name of a year's zip file. Downloads are written to a temporary .part file, which is renamed once complete and verified
+def local_file(yr, data_folder='data'):
+    return os.path.join(data_folder, 'FARS' + str(yr) + '.zip')
+
+# opens an anonymous FTP connection in binary mode, so that SIZE reports the size of the zip files
+def connect(host, port):
+    ftp = ftplib.FTP()
+    ftp.connect(host, port)
+    ftp.login()
+    ftp.voidcmd('TYPE I')
+    return ftp
+
+# the remote modification time of a file, or None if the server does not support MDTM
+def remote_modified(ftp, filename):
+    try:
+        return ftp.voidcmd('MDTM ' + filename)[4:].strip()
+    except ftplib.error_perm:
+        return None
+
+# checks that a download has the remote file's size, and that every member of the zip file matches its stored CRC checksum
+def verify(filename, remote_size):
+    if os.path.getsize(filename) != remote_size:
+        return False
+    try:
+        with zipfile.ZipFile(filename, 'r') as zf:
+            return zf.testzip() is None
+    except zipfile.BadZipFile:
+        return False
+
+# downloads a file into filename, resuming from the end of an existing partial download with REST
+def download(ftp, remote_name, filename, remote_size):
+    offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if offset > remote_size: # the partial download cannot belong to the current remote file
+        offset = 0
+    with open(filename, 'r+b' if offset > 0 else 'wb') as file:
+        file.seek(offset)
+        file.truncate()
+        if offset < remote_size:
+            ftp.retrbinary('RETR ' + remote_name, file.write, rest=(offset if offset > 0 else None))
+
+# whether the local file of a year is the remote file recorded in its manifest entry: by the remote size and modification time, or if 
+# the server does not report modification times, by the remote size and the hash of the local file
+def up_to_date(entry, remote, filename):
+    if entry.get('remote_size') != remote['remote_size']:
+        return False
+    if remote['remote_modified'] is not None:
+        return entry.get('remote_modified') == remote['remote_modified']
+    return ('sha256' in entry) and (entry['sha256'] == util.file_sha256(filename))
+
+# retrieves one year's zip file unless the manifest entry shows it is up to date, returning the year's new manifest entry
+# (or None if it was up to date). After a failure, the connection is reopened and the download resumed
+def retrieve_year(yr, entry, host, port, data_folder, attempts):
+    filenameLocal = local_file(yr, data_folder)
+    (remote_dir, remote_name) = remote_file(yr)
+    ftp = None
+    try:
+        for attempt in range(1, attempts+1):
+            try:
+                if ftp is None:
+                    ftp = connect(host, port)
+                ftp.cwd(remote_dir)
+                remote = {'remote_size':ftp.size(remote_name), 'remote_modified':remote_modified(ftp, remote_name)}
+                if os.path.exists(filenameLocal) and os.path.getsize(filenameLocal) == remote['remote_size']:
+                    if up_to_date(entry, remote, filenameLocal):
+                        print("Data for " + str(yr) + " are up to date.")
+                        return None
+                    if not entry and verify(filenameLocal, remote['remote_size']): # complete file retrieved before the manifest was kept
+                        print("Data for " + str(yr) + " are complete.")
+                        remote['sha256'] = util.file_sha256(filenameLocal)
+                        return remote
+                
+                print("Retrieving data for " + str(yr) + ".")
+                download(ftp, remote_name, filenameLocal + '.part', remote['remote_size'])
+                if not verify(filenameLocal + '.part', remote['remote_size']):
+                    os.remove(filenameLocal + '.part') # corrupt rather than incomplete, so start the next attempt from scratch
+                    raise ValueError('verification of ' + remote_name + ' failed')
+                os.replace(filenameLocal + '.part', filenameLocal)
+                remote['sha256'] = util.file_sha256(filenameLocal)
+                return remote
+            except (ValueError,) + ftplib.all_errors as e:
+                print("Attempt " + str(attempt) + " at retrieving data for " + str(yr) + " failed: " + str(e))
+                if ftp is not None:
+                    ftp.close()
+                    ftp = None
+        raise RuntimeError('Retrieval of data for ' + str(yr) + ' failed after ' + str(attempts) + ' attempts.')
+    finally:
+        if ftp is not None:
+            ftp.close()
+
+# retrieves the zip files for the given years into data_folder over up to jobs concurrent FTP connections, recording each one in the manifest
+def retrieve(years, host=ftp_host, port=ftp_port, data_folder='data', manifest_file=manifest_file, jobs=retrieve_jobs, attempts=max_attempts):
+    if not os.path.exists(data_folder):
+        os.makedirs(data_folder)
+    manifest = util.read_manifest(manifest_file)
+    if len(years) == 0:
+        return manifest
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs,len(years))) as executor:
+        futures = {executor.submit(retrieve_year, yr, manifest.get(str(yr), {}), host, port, data_folder, attempts):yr for yr in years}
+        for future in concurrent.futures.as_completed(futures):
+            entry = future.result()
+            if entry is not None:
+                manifest[str(futures[future])] = entry
+                util.write_manifest(manifest,manifest_file)
+    return manifest
+
+""" Retrieval Script """
+
+if __name__ == '__main__':
+    retrieve(list(range(firstYear,latestYear+1)))
+    print("Retrieval of FARS data from " + str(firstYear) + " to " + str(latestYear) + " successfully completed.")
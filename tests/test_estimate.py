@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of estimate.py on synthetic data: the LP model optimizers on synthetic accident counts, where the gradient methods, which optimize 
+over the logs of the parameters, reach the same optimum as Nelder-Mead from the default starting values, and the integer-coded 
+estimation samples on synthetic analytic samples, which match those built by unstacking each crash's vehicles and summing by cell.
+"""
+import os, sys
+import numpy, pandas
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import estimate
+
+# draws accident counts (cells x columns, as in an estimation sample) for driver types with the given relative risks thet and lamb
+def lp_counts(rng, num_driver_types, num_cells, thet, lamb, crashes_per_cell):
+    t = numpy.concatenate(([1], thet))
+    l = numpy.concatenate(([1], lamb))
+    iu = numpy.triu_indices(num_driver_types)
+    A = list()
+    for cell in range(0,num_cells):
+        N = numpy.concatenate(([1], rng.uniform(0.05, 0.5, num_driver_types-1)))
+        one_car = rng.poisson(crashes_per_cell*N*l/l.sum())
+        p = N[iu[0]]*N[iu[1]]*(t[iu[0]]+t[iu[1]])*numpy.where(iu[0]!=iu[1], 2, 1)
+        two_car = rng.multinomial(rng.poisson(crashes_per_cell), p/p.sum())
+        A.append(numpy.concatenate((one_car, two_car)))
+    A = numpy.array(A, dtype=float)
+    return A[(A[:,:num_driver_types]>0).all(axis=1)]
+
+@pytest.mark.parametrize('num_driver_types,pairwise', [(2,True), (3,True), (3,False)])
+@pytest.mark.parametrize('method', ['bfgs','newton'])
+def test_fit_lp_matches_nm(num_driver_types, pairwise, method):
+    rng = numpy.random.default_rng(num_driver_types)
+    start_params = 10*numpy.ones(2*(num_driver_types-1)) # the default init_rel_risk
+    for rep in range(0,5):
+        A = lp_counts(rng, num_driver_types, 80, rng.uniform(0.5, 4, num_driver_types-1), rng.uniform(0.5, 3, num_driver_types-1), 80)
+        params_nm, llf_nm, df_resid_nm, converged_nm = estimate.fit_lp(A, num_driver_types, pairwise, start_params, 'nm')
+        params, llf, df_resid, converged = estimate.fit_lp(A, num_driver_types, pairwise, start_params, method)
+        assert converged
+        assert llf >= llf_nm - 1e-6
+        if num_driver_types == 2: # otherwise, the likelihood can have several maxima of the same value
+            numpy.testing.assert_allclose(params, params_nm, rtol=1e-3)
+
+@pytest.mark.parametrize('method', ['bfgs','newton'])
+def test_lp_fit_matches_nm(method):
+    rng = numpy.random.default_rng(0)
+    A = lp_counts(rng, 2, 80, [3.0], [2.0], 80)
+    results_nm = estimate.Lp(A, num_driver_types=2).fit(start_params=10*numpy.ones(2), method='nm', disp=False)
+    results = estimate.Lp(A, num_driver_types=2).fit(start_params=10*numpy.ones(2), method=method, disp=False)
+    assert results.mle_retvals['converged']
+    numpy.testing.assert_allclose(results.params, results_nm.params, rtol=1e-3)
+    assert numpy.isfinite(results.bse).all()
+
+# a synthetic analytic sample (indexed by year, st_case, and veh_no, as util.get_analytic_sample returns it) of one- and two-car 
+# crashes, with driver types for two MI replicates (driver_type1 and driver_type2) as well as driver_type. Some drivers are of none of 
+# the types
+def synthetic_analytic_sample(rng, num_crashes, num_driver_types):
+    acc_veh_count = rng.choice([1,2], num_crashes)
+    crash_rows = numpy.repeat(numpy.arange(num_crashes), acc_veh_count)
+    veh_no = numpy.concatenate([numpy.arange(1,n+1) for n in acc_veh_count])
+    analytic_sample = pandas.DataFrame({'year':rng.integers(1983,1987,num_crashes)[crash_rows], 'st_case':crash_rows+10000, 'veh_no':veh_no,
+                                        'state':rng.integers(1,4,num_crashes)[crash_rows], 'hour':rng.integers(0,3,num_crashes)[crash_rows],
+                                        'acc_veh_count':acc_veh_count[crash_rows]})
+    for dt_column in ['driver_type','driver_type1','driver_type2']:
+        driver_type = rng.integers(1,num_driver_types+1,len(crash_rows)).astype(float)
+        driver_type[rng.random(len(crash_rows))<0.05] = numpy.nan
+        analytic_sample[dt_column] = driver_type
+    return analytic_sample.set_index(['year','st_case','veh_no'])
+
+# the estimation sample as built before crashes were integer-coded: the crashes' vehicles are unstacked into columns, and crashes are 
+# flagged by driver types and summed by equal-mixing cell
+def reference_estimation_sample(analytic_sample, equal_mixing, num_driver_types, mirep_suf=''):
+    sample = analytic_sample.copy()
+    sample['veh_no2'] = sample.groupby(['year','st_case']).cumcount()+1
+    idx_add_veh_no2 = ['year','st_case','veh_no2'] if 'all' in equal_mixing else equal_mixing + ['year','st_case','veh_no2']
+    sample = sample.reset_index().set_index(list(dict.fromkeys(idx_add_veh_no2)))[['acc_veh_count','driver_type'+mirep_suf]].unstack()
+    acc_veh_count = sample['acc_veh_count'][1]
+    dt_veh1 = sample['driver_type'+mirep_suf][1]
+    dt_veh2 = sample['driver_type'+mirep_suf][2]
+    counts = pandas.DataFrame(index=sample.index)
+    for dt in range(1,num_driver_types+1):
+        counts['a_' + str(dt)] = ((acc_veh_count==1) & (dt_veh1==dt)).astype(int)
+    for dt1 in range(1,num_driver_types+1):
+        for dt2 in range(dt1,num_driver_types+1):
+            counts['a_' + str(dt1) + '_' + str(dt2)] = ((acc_veh_count==2) & (((dt_veh1==dt1) & (dt_veh2==dt2)) | 
+                                                                               ((dt_veh1==dt2) & (dt_veh2==dt1)))).astype(int)
+    if 'all' in equal_mixing:
+        return counts.sum().to_frame().transpose()
+    counts = counts.groupby(equal_mixing).sum()
+    return counts[(counts[['a_' + str(dt) for dt in range(1,num_driver_types+1)]]>0).all(axis=1)]
+
+@pytest.mark.parametrize('equal_mixing', [['all'], ['year'], ['year','hour'], ['year','state','hour']])
+@pytest.mark.parametrize('num_driver_types,mirep', [(2,False), (2,2), (3,False)])
+def test_estimation_sample_matches_reference(equal_mixing, num_driver_types, mirep):
+    rng = numpy.random.default_rng(num_driver_types)
+    analytic_sample = synthetic_analytic_sample(rng, 3000, num_driver_types)
+    driver_types = [['type' + str(dt)] for dt in range(1,num_driver_types+1)] # only their number matters in estimation
+    reference = reference_estimation_sample(analytic_sample, equal_mixing, num_driver_types, '' if mirep==False else str(mirep))
+    estimation_sample = estimate.get_estimation_sample(analytic_sample, equal_mixing, driver_types, mirep)
+    pandas.testing.assert_frame_equal(estimation_sample, reference, check_dtype=False, check_index_type=False)
+    
+    # rolled up from the crash cells of a finer equal mixing
+    crash_cells = estimate.get_crash_cells(analytic_sample, ['year','state','hour'], driver_types, mirep)
+    rolled_up = estimate.get_estimation_sample(analytic_sample, equal_mixing, driver_types, mirep, crash_cells)
+    pandas.testing.assert_frame_equal(rolled_up, reference, check_dtype=False, check_index_type=False)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of retrieve.py against a local FTP server (pyftpdlib) that serves FARS-like zip files, covering a fresh download, the resumption
+of a partial download, and skipping years that are up to date, with and without support for MDTM on the server.
+"""
+import os, sys, threading, zipfile
+import pytest
+
+pyftpdlib = pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import retrieve
+
+# writes a year's zip file into the served directory tree, as retrieve.remote_file locates it, and returns its contents
+def write_remote_zip(root, yr, size=2**18):
+    (remote_dir, remote_name) = retrieve.remote_file(yr)
+    folder = os.path.join(root, *remote_dir.strip('/').split('/'))
+    os.makedirs(folder, exist_ok=True)
+    with zipfile.ZipFile(os.path.join(folder, remote_name), 'w') as zf:
+        zf.writestr('accident.csv', os.urandom(size)) # incompressible, so that the zip file is about size bytes
+    with open(os.path.join(folder, remote_name), 'rb') as file:
+        return file.read()
+
+# starts an anonymous FTP server for the files under root, whose handler records the RETR and REST commands it receives. If mdtm is
+# False, the server doesn't support MDTM. Returns the server, its port and the recorded commands
+def start_server(root, mdtm=True):
+    commands = []
+    class RecordingHandler(FTPHandler):
+        def ftp_RETR(self, file):
+            commands.append(('RETR', os.path.basename(file)))
+            return FTPHandler.ftp_RETR(self, file)
+        def ftp_REST(self, line):
+            commands.append(('REST', int(line)))
+            return FTPHandler.ftp_REST(self, line)
+    if not mdtm:
+        RecordingHandler.proto_cmds = {cmd: info for (cmd, info) in FTPHandler.proto_cmds.items() if cmd != 'MDTM'}
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    RecordingHandler.authorizer = authorizer
+    server = ThreadedFTPServer(('127.0.0.1', 0), RecordingHandler)
+    threading.Thread(target=server.serve_forever, kwargs={'timeout':0.1, 'handle_exit':False}, daemon=True).start()
+    return server, server.address[1], commands
+
+@pytest.fixture(params=[True, False], ids=['mdtm', 'no_mdtm'])
+def ftp_server(tmp_path, request):
+    root = str(tmp_path / 'ftp')
+    os.makedirs(root)
+    server, port, commands = start_server(root, mdtm=request.param)
+    yield root, port, commands
+    server.close_all()
+
+def run_retrieve(tmp_path, port, years):
+    data_folder = str(tmp_path / 'data')
+    manifest = retrieve.retrieve(years, host='127.0.0.1', port=port, data_folder=data_folder,
+                                 manifest_file=os.path.join(data_folder, 'retrieve_manifest.json'), jobs=2, attempts=2)
+    return data_folder, manifest
+
+def test_fresh_download(tmp_path, ftp_server):
+    root, port, commands = ftp_server
+    contents = {yr: write_remote_zip(root, yr) for yr in [1990, 1991]}
+    data_folder, manifest = run_retrieve(tmp_path, port, [1990, 1991])
+    for yr in [1990, 1991]:
+        with open(retrieve.local_file(yr, data_folder), 'rb') as file:
+            assert file.read() == contents[yr]
+        assert manifest[str(yr)]['remote_size'] == len(contents[yr])
+        assert not os.path.exists(retrieve.local_file(yr, data_folder) + '.part')
+    assert sorted(commands) == [('RETR', 'FARS1990NationalCSV.zip'), ('RETR', 'FARS1991NationalCSV.zip')]
+
+def test_resume(tmp_path, ftp_server):
+    root, port, commands = ftp_server
+    contents = write_remote_zip(root, 1990)
+    data_folder = str(tmp_path / 'data')
+    os.makedirs(data_folder)
+    with open(retrieve.local_file(1990, data_folder) + '.part', 'wb') as file: # an interrupted download
+        file.write(contents[:len(contents)//2])
+    data_folder, manifest = run_retrieve(tmp_path, port, [1990])
+    with open(retrieve.local_file(1990, data_folder), 'rb') as file:
+        assert file.read() == contents
+    assert ('REST', len(contents)//2) in commands
+
+def test_up_to_date_skip(tmp_path, ftp_server):
+    root, port, commands = ftp_server
+    write_remote_zip(root, 1990)
+    data_folder, manifest = run_retrieve(tmp_path, port, [1990])
+    assert commands == [('RETR', 'FARS1990NationalCSV.zip')]
+    data_folder, manifest_again = run_retrieve(tmp_path, port, [1990])
+    assert manifest_again == manifest
+    assert commands == [('RETR', 'FARS1990NationalCSV.zip')] # not downloaded again
+
+    # a changed local file is downloaded again if the server doesn't report modification times, since its hash no longer matches
+    with open(retrieve.local_file(1990, data_folder), 'r+b') as file:
+        file.write(b'\0')
+    run_retrieve(tmp_path, port, [1990])
+    assert len(commands) == (1 if manifest['1990']['remote_modified'] is not None else 2)
+
+def test_no_years(tmp_path):
+    data_folder = str(tmp_path / 'data')
+    assert retrieve.retrieve([], data_folder=data_folder, manifest_file=os.path.join(data_folder, 'retrieve_manifest.json')) == {}
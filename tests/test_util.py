@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of replication/util.py on synthetic frames: selecting crashes and their rows through packed integer keys matches selecting them
+with isin on the (year, st_case) MultiIndex levels, the missing data bitmasks of accident_missing_data match per-column null checks 
+combined over each crash, and writing to the analytic sample cache removes the samples of other versions or data fingerprints.
+"""
+import os, sys
+import numpy, pandas
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from replication import util
+
+# a synthetic vehicle-level frame (indexed by year, st_case, and veh_no) of num_crashes crashes with one to three vehicles, in shuffled
+# row order, as rows are ordered after merges and restrictions
+def synthetic_vehicles(rng, num_crashes):
+    num_vehicles = rng.integers(1,4,num_crashes)
+    crash_rows = numpy.repeat(numpy.arange(num_crashes), num_vehicles)
+    df_vehicle = pandas.DataFrame({'year':rng.integers(1983,1994,num_crashes)[crash_rows], 'st_case':rng.integers(1,60000,num_crashes)[crash_rows],
+                                   'veh_no':numpy.concatenate([numpy.arange(1,n+1) for n in num_vehicles]),
+                                   'dr_drink':rng.integers(0,2,len(crash_rows)).astype(float)})
+    df_vehicle = df_vehicle.drop_duplicates(['year','st_case','veh_no']).set_index(['year','st_case','veh_no'])
+    return df_vehicle.iloc[rng.permutation(len(df_vehicle.index))]
+
+# a selection of crashes (indexed by year and st_case), some of which are in df_vehicle and some of which are not, with duplicates
+def synthetic_crash_index(rng, df_vehicle, num_crashes):
+    crashes = df_vehicle.index.droplevel('veh_no').unique()
+    selected = crashes[rng.choice(len(crashes), num_crashes)]
+    absent = pandas.MultiIndex.from_arrays([rng.integers(1983,1994,num_crashes//4), rng.integers(60000,70000,num_crashes//4)],
+                                           names=['year','st_case'])
+    return selected.append(absent)
+
+def test_pack_key_round_trip():
+    rng = numpy.random.default_rng(0)
+    levels = {'year':rng.integers(1975,2020,1000), 'st_case':rng.integers(0,2**24,1000), 'veh_no':rng.integers(0,999,1000),
+              'per_no':rng.integers(0,999,1000)}
+    keys = util.pack_key(**levels)
+    unpacked = util.unpack_key(keys)
+    for level in levels:
+        numpy.testing.assert_array_equal(unpacked[level], levels[level])
+
+    # the keys sort in the same order as the levels
+    order = numpy.lexsort([levels[level] for level in reversed(list(levels))])
+    assert (numpy.diff(keys[order]) >= 0).all()
+
+@pytest.mark.parametrize('num_selected', [0, 1, 50, 2000])
+def test_keys_isin_matches_multiindex_isin(num_selected):
+    rng = numpy.random.default_rng(num_selected)
+    df_vehicle = synthetic_vehicles(rng, 1000)
+    crash_index = synthetic_crash_index(rng, df_vehicle, num_selected)
+    expected = df_vehicle.index.droplevel('veh_no').isin(crash_index)
+    numpy.testing.assert_array_equal(util.keys_isin(util.row_keys(df_vehicle.index), util.row_keys(crash_index)), expected)
+
+@pytest.mark.parametrize('num_selected', [0, 1, 50, 2000])
+def test_crash_rows_matches_multiindex_isin(num_selected):
+    rng = numpy.random.default_rng(num_selected)
+    df_vehicle = synthetic_vehicles(rng, 1000)
+    crash_index = synthetic_crash_index(rng, df_vehicle, num_selected)
+    expected = df_vehicle[df_vehicle.index.droplevel('veh_no').isin(crash_index)]
+    pandas.testing.assert_frame_equal(util.crash_rows(df_vehicle, util.crash_row_index(df_vehicle), crash_index), expected)
+
+def test_crash_rows_of_empty_frame():
+    rng = numpy.random.default_rng(0)
+    df_vehicle = synthetic_vehicles(rng, 100)
+    crash_index = synthetic_crash_index(rng, df_vehicle, 10)
+    df_empty = df_vehicle.iloc[:0]
+    pandas.testing.assert_frame_equal(util.crash_rows(df_empty, util.crash_row_index(df_empty), crash_index), df_empty)
+
+# synthetic accident, vehicle, and driver frames for the crashes of df_vehicle, with missing values in each of the variables checked by
+# accident_missing_data. Some crashes have no vehicles, some vehicles have no driver, and some drivers are children
+def synthetic_crashes(rng, df_vehicle, mireps=3):
+    crashes = df_vehicle.index.droplevel('veh_no').unique()
+    no_vehicles = pandas.MultiIndex.from_arrays([rng.integers(1983,1994,20), rng.integers(60000,70000,20)], names=['year','st_case'])
+    acc_index = crashes.append(no_vehicles).unique()
+    df_accident = pandas.DataFrame({c:rng.integers(1,20,len(acc_index)).astype(float) for c in ['state','day_week','hour']}, index=acc_index)
+    df_vehicle = df_vehicle.copy()
+    for c in ['prev_acc','prev_sus','prev_dwi','prev_spd','prev_oth']:
+        df_vehicle[c] = rng.integers(0,3,len(df_vehicle.index)).astype(float)
+    df_driver = pandas.DataFrame({'drinking':rng.choice([0,1,8,9],len(df_vehicle.index)).astype(float),
+                                  'alcohol_test_result':rng.choice([0,5,12],len(df_vehicle.index)).astype(float),
+                                  'age':rng.integers(10,80,len(df_vehicle.index)).astype(float),
+                                  'sex':rng.integers(1,3,len(df_vehicle.index)).astype(float),
+                                  **{'mibac' + str(mirep):rng.choice([0,5,12],len(df_vehicle.index)).astype(float) for mirep in range(1,mireps+1)}},
+                                 index=df_vehicle.index)
+    for df in [df_accident, df_vehicle, df_driver]:
+        for c in df.columns:
+            df.loc[rng.random(len(df.index))<0.03, c] = numpy.nan
+    df_driver = df_driver[rng.random(len(df_driver.index))>0.05]
+    return df_accident, df_vehicle, df_driver
+
+# the missing data of each crash as identified before they were encoded as bitmasks: null checks of each variable, merged from the
+# drivers to the vehicles to the crashes, and combined over each crash
+def reference_missing_data(df_accident, df_vehicle, df_driver, veh_drink_status_missing):
+    df_dr_miss = pandas.DataFrame(index=df_driver.index)
+    df_dr_miss['miss_age'] = (df_driver['age'].isnull()) | (df_driver['age'] < 13)
+    df_dr_miss['miss_sex'] = df_driver['sex'].isnull()
+    df_veh_miss = pandas.DataFrame(index=df_vehicle.index)
+    df_veh_miss['miss_minor_blemishes'] = (df_vehicle['prev_acc'].isnull() | df_vehicle['prev_spd'].isnull() | df_vehicle['prev_oth'].isnull())
+    df_veh_miss['miss_major_blemishes'] = (df_vehicle['prev_sus'].isnull() | df_vehicle['prev_dwi'].isnull())
+    df_veh_miss['miss_any_blemishes'] = (df_veh_miss['miss_minor_blemishes'] | df_veh_miss['miss_major_blemishes'])
+    df_veh_miss['miss_drinking_status'] = veh_drink_status_missing
+    df_acc_miss = pandas.DataFrame(index=df_accident.index)
+    df_acc_miss['miss_hour'] = df_accident['hour'].isnull()
+    df_acc_miss['miss_day_week'] = df_accident['day_week'].isnull()
+    df_acc_miss['miss_state'] = df_accident['state'].isnull()
+    df_miss = df_acc_miss.merge(df_veh_miss.merge(df_dr_miss,how='left',on=['year','st_case','veh_no']),how='left',
+                                on=['year','st_case']).groupby(['year','st_case']).any()
+    df_miss['miss_any_excl_drink_stat'] = df_miss.drop(columns=['miss_drinking_status']).any(axis='columns')
+    df_miss['miss_any'] = df_miss.any(axis='columns')
+    return df_miss
+
+@pytest.mark.parametrize('drinking_definition,mireps', [('police_report_primary',False), ('bac_test_primary',False),
+                                                        ('bac_test_only',3)])
+def test_accident_missing_data_matches_null_checks(drinking_definition, mireps):
+    rng = numpy.random.default_rng(0)
+    df_accident, df_vehicle, df_driver = synthetic_crashes(rng, synthetic_vehicles(rng, 1000))
+    veh_drink_status_missing = pandas.DataFrame(util.veh_dr_drinking_status(df_vehicle, df_driver, drinking_definition, 0.1, mireps, 
+                                                                            drop_below_threshold=False)).isnull().any(axis='columns')
+    expected = reference_missing_data(df_accident, df_vehicle, df_driver, veh_drink_status_missing)
+    assert expected.any().all() # every type of missing data occurs
+    pandas.testing.assert_frame_equal(util.accident_missing_data(df_accident, df_vehicle, df_driver, drinking_definition, 0.1, mireps), expected)
+
+def test_accident_missing_data_given_drink_status_missing():
+    rng = numpy.random.default_rng(1)
+    df_accident, df_vehicle, df_driver = synthetic_crashes(rng, synthetic_vehicles(rng, 1000))
+    veh_drink_status_missing = pandas.Series(rng.random(len(df_vehicle.index))<0.05, index=df_vehicle.index)
+    expected = reference_missing_data(df_accident, df_vehicle, df_driver, veh_drink_status_missing)
+    
+    # the drink status can be given for a superset of the vehicles, in another order (as selected from a wider sample)
+    veh_drink_status_missing = pandas.concat([veh_drink_status_missing, pandas.Series([True], index=pandas.MultiIndex.from_tuples(
+                                              [(1983,99999,1)], names=['year','st_case','veh_no']))]).sample(frac=1, random_state=0)
+    result = util.accident_missing_data(df_accident, df_vehicle, df_driver, 'any_evidence', 0.1, False, veh_drink_status_missing)
+    pandas.testing.assert_frame_equal(result, expected)
+
+def test_cache_prunes_stale_samples(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    analytic_sample = pandas.DataFrame({'hour':[1.0,2.0]}, index=pandas.MultiIndex.from_tuples([(1983,1),(1983,2)], names=['year','st_case']))
+    util._store_cached_analytic_sample('a'*64, analytic_sample, '0'*64, cache_dir)
+    util._store_cached_analytic_sample('b'*64, analytic_sample, '0'*64, cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+    
+    # samples of other data fingerprints or cache versions are removed when a sample is written
+    util._store_cached_analytic_sample('c'*64, analytic_sample, '1'*64, cache_dir)
+    assert os.listdir(cache_dir) == [util._cache_file_prefix('1'*64) + 'c'*64 + '.parquet']
+    monkeypatch.setattr(util, 'ANALYTIC_SAMPLE_CACHE_VERSION', util.ANALYTIC_SAMPLE_CACHE_VERSION + 1)
+    util._store_cached_analytic_sample('c'*64, analytic_sample, '1'*64, cache_dir)
+    assert os.listdir(cache_dir) == [util._cache_file_prefix('1'*64) + 'c'*64 + '.parquet']
+    pandas.testing.assert_frame_equal(util._load_cached_analytic_sample('c'*64, '1'*64, cache_dir), analytic_sample)
+    assert util._load_cached_analytic_sample('c'*64, '0'*64, cache_dir) is None